@@ -18,6 +18,7 @@ import re
         # 'priority': int,
         'rate': int,
         'burst': int,
+        'weight': float,  # share of dispatch among projects, 1 by default
         'updatetime': int,
     }
 }
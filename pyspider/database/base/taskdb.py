@@ -69,6 +69,15 @@ class TaskDB(object):
     def get_task(self, project, taskid, fields=None):
         raise NotImplementedError
 
+    def get_tasks(self, project, taskids, fields=None):
+        '''
+        return a iterator of tasks in taskids, missing tasks are skipped
+        '''
+        for taskid in taskids:
+            task = self.get_task(project, taskid, fields)
+            if task:
+                yield task
+
     def status_count(self, project):
         '''
         return a dict
@@ -81,9 +90,29 @@ class TaskDB(object):
     def update(self, project, taskid, obj={}, **kwargs):
         raise NotImplementedError
 
+    def insert_many(self, project, tasks):
+        '''
+        insert a list of tasks, every task should have a taskid
+        '''
+        for task in tasks:
+            self.insert(project, task['taskid'], task)
+
+    def update_many(self, project, tasks):
+        '''
+        update a list of tasks, every task should have a taskid
+        '''
+        for task in tasks:
+            self.update(project, task['taskid'], task)
+
     def drop(self, project):
         raise NotImplementedError
 
+    def copy(self):
+        '''
+        return a taskdb instance which could be used in another thread
+        '''
+        return self
+
     @staticmethod
     def status_to_string(status):
         return {
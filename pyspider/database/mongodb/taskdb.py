@@ -70,6 +70,19 @@ class TaskDB(SplitTableMixin, BaseTaskDB):
             return ret
         return self._parse(ret)
 
+    def get_tasks(self, project, taskids, fields=None):
+        if project not in self.projects:
+            self._list_project()
+        if project not in self.projects:
+            return
+        taskids = list(taskids)
+        if not taskids:
+            return
+        collection_name = self._collection_name(project)
+        for task in self.database[collection_name].find({'taskid': {'$in': taskids}},
+                                                        fields=fields):
+            yield self._parse(task)
+
     def status_count(self, project):
         if project not in self.projects:
             self._list_project()
@@ -108,3 +121,31 @@ class TaskDB(SplitTableMixin, BaseTaskDB):
             {"$set": self._stringify(obj)},
             upsert=True
         )
+
+    def _bulk_update(self, project, objs):
+        collection_name = self._collection_name(project)
+        bulk = self.database[collection_name].initialize_unordered_bulk_op()
+        for obj in objs:
+            bulk.find({'taskid': obj['taskid']}).upsert().update({"$set": self._stringify(obj)})
+        return bulk.execute()
+
+    def insert_many(self, project, tasks):
+        objs = []
+        now = time.time()
+        for task in tasks:
+            obj = dict(task)
+            obj['project'] = project
+            obj['updatetime'] = now
+            objs.append(obj)
+        if objs:
+            return self._bulk_update(project, objs)
+
+    def update_many(self, project, tasks):
+        objs = []
+        now = time.time()
+        for task in tasks:
+            obj = dict(task)
+            obj['updatetime'] = now
+            objs.append(obj)
+        if objs:
+            return self._bulk_update(project, objs)
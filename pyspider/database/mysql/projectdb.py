@@ -33,8 +33,15 @@ class ProjectDB(MySQLMixin, BaseProjectDB, BaseDB):
             `comments` varchar(1024),
             `rate` float(11, 4),
             `burst` float(11, 4),
+            `weight` float(11, 4),
             `updatetime` double(16, 4)
             ) ENGINE=MyISAM CHARSET=utf8''' % self.escape(self.__tablename__))
+        # projectdb created before weight was added
+        columns = [x[0] for x in self._execute('SHOW COLUMNS FROM %s'
+                                               % self.escape(self.__tablename__))]
+        if 'weight' not in columns:
+            self._execute('ALTER TABLE %s ADD `weight` float(11, 4) AFTER `burst`'
+                          % self.escape(self.__tablename__))
 
     def insert(self, name, obj={}):
         obj = dict(obj)
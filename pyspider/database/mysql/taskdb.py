@@ -18,9 +18,12 @@ from mysqlbase import MySQLMixin, SplitTableMixin
 
 class TaskDB(MySQLMixin, SplitTableMixin, BaseTaskDB, BaseDB):
     __tablename__ = ''
+    BULK_ROWS = 500
 
     def __init__(self, host='localhost', port=3306, database='taskdb',
                  user='root', passwd=None):
+        self.connect_kwargs = dict(host=host, port=port, database=database,
+                                   user=user, passwd=passwd)
         self.database_name = database
         self.conn = mysql.connector.connect(user=user, password=passwd,
                                             host=host, port=port, autocommit=True)
@@ -29,6 +32,9 @@ class TaskDB(MySQLMixin, SplitTableMixin, BaseTaskDB, BaseDB):
         self.conn.database = database
         self._list_project()
 
+    def copy(self):
+        return self.__class__(**self.connect_kwargs)
+
     def _create_project(self, project):
         assert re.match(r'^\w+$', project) is not None
         tablename = self._tablename(project)
@@ -95,6 +101,19 @@ class TaskDB(MySQLMixin, SplitTableMixin, BaseTaskDB, BaseDB):
             return self._parse(each)
         return None
 
+    def get_tasks(self, project, taskids, fields=None):
+        if project not in self.projects:
+            self._list_project()
+        if project not in self.projects:
+            return
+        taskids = list(taskids)
+        if not taskids:
+            return
+        tablename = self._tablename(project)
+        where = "`taskid` IN (%s)" % ', '.join([self.placeholder, ] * len(taskids))
+        for each in self._select2dic(tablename, what=fields, where=where, where_values=taskids):
+            yield self._parse(each)
+
     def status_count(self, project):
         result = dict()
         if project not in self.projects:
@@ -133,3 +152,56 @@ class TaskDB(MySQLMixin, SplitTableMixin, BaseTaskDB, BaseDB):
             where_values=(taskid, ),
             **self._stringify(obj)
         )
+
+    def _insert_rows(self, tablename, rows, on_duplicate_update=False):
+        # rows with the same columns are sent in one multi-row INSERT
+        groups = {}
+        for row in rows:
+            groups.setdefault(tuple(sorted(row.iterkeys())), []).append(row)
+
+        for keys, rows in groups.iteritems():
+            _keys = ", ".join(self.escape(k) for k in keys)
+            _row = "(%s)" % ", ".join([self.placeholder, ] * len(keys))
+            for i in range(0, len(rows), self.BULK_ROWS):
+                chunk = rows[i:i + self.BULK_ROWS]
+                sql_query = "INSERT INTO %s (%s) VALUES %s" % (
+                    self.escape(tablename), _keys, ", ".join([_row, ] * len(chunk)))
+                if on_duplicate_update:
+                    sql_query += " ON DUPLICATE KEY UPDATE %s" % ", ".join(
+                        "%s = VALUES(%s)" % (self.escape(k), self.escape(k)) for k in keys)
+                values = []
+                for row in chunk:
+                    values.extend(row[k] for k in keys)
+                self._execute(sql_query, values)
+
+    def insert_many(self, project, tasks):
+        if project not in self.projects:
+            self._list_project()
+        if project not in self.projects:
+            self._create_project(project)
+            self._list_project()
+        tablename = self._tablename(project)
+        now = time.time()
+        rows = []
+        for task in tasks:
+            obj = dict(task)
+            obj['project'] = project
+            obj['updatetime'] = now
+            rows.append(self._stringify(obj))
+        self._insert_rows(tablename, rows)
+
+    def update_many(self, project, tasks):
+        '''
+        tasks are written with INSERT ... ON DUPLICATE KEY UPDATE,
+        a task not exists in taskdb will been inserted.
+        '''
+        if project not in self.projects:
+            raise LookupError
+        tablename = self._tablename(project)
+        now = time.time()
+        rows = []
+        for task in tasks:
+            obj = dict(task)
+            obj['updatetime'] = now
+            rows.append(self._stringify(obj))
+        self._insert_rows(tablename, rows, on_duplicate_update=True)
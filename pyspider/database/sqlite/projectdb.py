@@ -24,8 +24,12 @@ class ProjectDB(SQLiteMixin, BaseProjectDB, BaseDB):
                 name PRIMARY KEY,
                 `group`,
                 status, script, comments,
-                rate, burst, updatetime
+                rate, burst, weight, updatetime
                 )''' % self.__tablename__)
+        # projectdb created before weight was added
+        columns = [x[1] for x in self._execute('PRAGMA table_info(`%s`)' % self.__tablename__)]
+        if 'weight' not in columns:
+            self._execute('ALTER TABLE `%s` ADD COLUMN weight' % self.__tablename__)
 
     def insert(self, name, obj={}):
         obj = dict(obj)
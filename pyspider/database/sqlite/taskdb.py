@@ -24,6 +24,9 @@ class TaskDB(SQLiteMixin, SplitTableMixin, BaseTaskDB, BaseDB):
         self.conn = None
         self._list_project()
 
+    def copy(self):
+        return self.__class__(self.path)
+
     def _create_project(self, project):
         assert re.match(r'^\w+$', project) is not None
         tablename = self._tablename(project)
@@ -82,6 +85,19 @@ class TaskDB(SQLiteMixin, SplitTableMixin, BaseTaskDB, BaseDB):
             return self._parse(each)
         return None
 
+    def get_tasks(self, project, taskids, fields=None):
+        if project not in self.projects:
+            self._list_project()
+        if project not in self.projects:
+            return
+        taskids = list(taskids)
+        if not taskids:
+            return
+        tablename = self._tablename(project)
+        where = "`taskid` IN (%s)" % ', '.join([self.placeholder, ] * len(taskids))
+        for each in self._select2dic(tablename, what=fields, where=where, where_values=taskids):
+            yield self._parse(each)
+
     def status_count(self, project):
         '''
         return a dict
@@ -119,3 +135,40 @@ class TaskDB(SQLiteMixin, SplitTableMixin, BaseTaskDB, BaseDB):
             tablename, where="`taskid` = %s" % self.placeholder, where_values=(taskid, ),
             **self._stringify(obj)
         )
+
+    def insert_many(self, project, tasks):
+        if project not in self.projects:
+            self._create_project(project)
+            self._list_project()
+        tablename = self._tablename(project)
+        now = time.time()
+        self._execute('BEGIN')
+        try:
+            for task in tasks:
+                obj = dict(task)
+                obj['project'] = project
+                obj['updatetime'] = now
+                self._insert(tablename, **self._stringify(obj))
+        except:
+            self._execute('ROLLBACK')
+            raise
+        self._execute('COMMIT')
+
+    def update_many(self, project, tasks):
+        if project not in self.projects:
+            raise LookupError
+        tablename = self._tablename(project)
+        now = time.time()
+        self._execute('BEGIN')
+        try:
+            for task in tasks:
+                obj = dict(task)
+                obj['updatetime'] = now
+                self._update(
+                    tablename, where="`taskid` = %s" % self.placeholder,
+                    where_values=(obj['taskid'], ), **self._stringify(obj)
+                )
+        except:
+            self._execute('ROLLBACK')
+            raise
+        self._execute('COMMIT')
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set et sw=4 ts=4 sts=4 ff=unix fenc=utf8:
+# Author: Binux<i@binux.me>
+#         http://binux.me
+# Created on 2014-12-19 10:36:05
+
+import time
+import Queue
+import logging
+import threading
+import multiprocessing
+
+import tornado.ioloop
+from pyspider.libs import utils
+logger = logging.getLogger('fetcher')
+
+
+def merge_counter(result, other, counts=None):
+    '''
+    add values of nested counter dict other into result, number of values added
+    to each key is counted in counts if given
+    '''
+    for key, value in other.iteritems():
+        if isinstance(value, dict):
+            merge_counter(result.setdefault(key, {}), value,
+                          None if counts is None else counts.setdefault(key, {}))
+        else:
+            result[key] = result.get(key, 0) + value
+            if counts is not None:
+                counts[key] = counts.get(key, 0) + 1
+    return result
+
+
+def divide_counter(result, counts):
+    '''
+    divide values of nested counter dict result by counts
+    '''
+    for key, value in result.iteritems():
+        if isinstance(value, dict):
+            divide_counter(value, counts[key])
+        else:
+            result[key] = float(value) / counts[key]
+    return result
+
+
+class FetcherSupervisor(object):
+
+    '''
+    run fetchers in worker processes, each with its own ioloop and sharing inqueue
+    and outqueue of the fetcher. counters of workers are reported every
+    REPORT_INTERVAL and served with a single xmlrpc endpoint. dead workers are
+    restarted.
+
+    new_fetcher is called in worker process to build the Fetcher, and with
+    async=False to build the Fetcher of sync_fetch with the same settings.
+    '''
+
+    REPORT_INTERVAL = 1
+    # a worker exited within FAST_CRASH_TIME after started is restarted after
+    # RESTART_DELAY, doubled every time up to RESTART_MAX_DELAY. slot is given up
+    # after FAST_CRASH_LIMIT fast crashes in a row.
+    FAST_CRASH_TIME = 10
+    FAST_CRASH_LIMIT = 5
+    RESTART_DELAY = 1
+    RESTART_MAX_DELAY = 60
+    counter_types = ('sum', 'avg')
+
+    def __init__(self, new_fetcher, workers=2):
+        self.new_fetcher = new_fetcher
+        self.workers = workers
+
+        self._quit = False
+        self._stop = multiprocessing.Event()
+        self._report_queue = multiprocessing.Queue()
+        self._reports = dict()
+        self._processes = [None] * workers
+        self._started = [0] * workers
+        self._crashes = [0] * workers
+        self._restart_at = [None] * workers
+        self._sync_fetcher = None
+        self._sync_lock = threading.Lock()
+
+    def _worker(self, index):
+        # don't reuse ioloop of parent
+        tornado.ioloop.IOLoop.clear_instance()
+        fetcher = self.new_fetcher()
+
+        def report():
+            if self._stop.is_set():
+                fetcher.quit()
+                return
+            counter = dict()
+            for _time, cnt in fetcher._cnt.iteritems():
+                for _type in self.counter_types:
+                    counter[(_time, _type)] = cnt.to_dict(_type)
+            try:
+                self._report_queue.put_nowait((index, {
+                    'size': fetcher.size(),
+                    'counter': counter,
+                    'hosts': fetcher._host_stats.to_dict(),
+                    'time': time.time(),
+                }))
+            except Queue.Full:
+                pass
+        tornado.ioloop.PeriodicCallback(report, self.REPORT_INTERVAL * 1000).start()
+        fetcher.run()
+
+    def _start_worker(self, index):
+        process = multiprocessing.Process(target=self._worker, args=(index, ))
+        process.daemon = True
+        process.start()
+        self._processes[index] = process
+        self._started[index] = time.time()
+        logger.info('fetcher worker %d started, pid: %d', index, process.pid)
+
+    def run(self):
+        for i in range(self.workers):
+            self._start_worker(i)
+
+        while not self._quit:
+            try:
+                index, report = self._report_queue.get(timeout=self.REPORT_INTERVAL)
+                self._reports[index] = report
+            except Queue.Empty:
+                pass
+            except KeyboardInterrupt:
+                break
+            if not self._quit:
+                self._check_workers()
+
+        self._stop.set()
+        for process in self._processes:
+            if process is None:
+                continue
+            process.join(self.REPORT_INTERVAL * 5)
+            if process.is_alive():
+                process.terminate()
+        logger.info("fetcher supervisor exiting...")
+
+    def _check_workers(self):
+        '''
+        restart dead workers, with backoff when they keep crashing on start
+        '''
+        now = time.time()
+        for i, process in enumerate(self._processes):
+            if process is None or process.is_alive():
+                continue
+            if self._restart_at[i] is None:
+                self._reports.pop(i, None)
+                if now - self._started[i] < self.FAST_CRASH_TIME:
+                    self._crashes[i] += 1
+                else:
+                    self._crashes[i] = 1
+                if self._crashes[i] > self.FAST_CRASH_LIMIT:
+                    logger.error('fetcher worker %d exited with %r, %d crashes in a row, '
+                                 'giving up', i, process.exitcode, self._crashes[i])
+                    self._processes[i] = None
+                    continue
+                delay = 0
+                if self._crashes[i] > 1:
+                    delay = min(self.RESTART_DELAY * 2 ** (self._crashes[i] - 2),
+                                self.RESTART_MAX_DELAY)
+                logger.error('fetcher worker %d exited with %r, restarting in %.1fs',
+                             i, process.exitcode, delay)
+                self._restart_at[i] = now + delay
+            if self._restart_at[i] <= now:
+                self._restart_at[i] = None
+                self._start_worker(i)
+
+    def quit(self):
+        self._quit = True
+        self._stop.set()
+
+    def size(self):
+        return sum(x['size'] for x in self._reports.itervalues())
+
+    def counter(self, _time, _type):
+        '''
+        sums are added, avgs are averaged over workers reported them
+        '''
+        result = dict()
+        counts = dict() if _type == 'avg' else None
+        for report in self._reports.values():
+            merge_counter(result, report['counter'].get((_time, _type), {}), counts)
+        if counts is not None:
+            divide_counter(result, counts)
+        return result
+
+    def host_stats(self):
+        from pyspider.fetcher.tornado_fetcher import host_stats
+        sums = dict()
+        for report in self._reports.values():
+            merge_counter(sums, report.get('hosts', {}))
+        return host_stats(sums)
+
+    def workers_info(self):
+        result = []
+        for i, process in enumerate(self._processes):
+            report = self._reports.get(i, {})
+            result.append({
+                'pid': process.pid if process else None,
+                'alive': bool(process and process.is_alive()),
+                'size': report.get('size', 0),
+                'last_report': report.get('time', 0),
+            })
+        return result
+
+    def sync_fetch(self, task):
+        with self._sync_lock:
+            if self._sync_fetcher is None:
+                self._sync_fetcher = self.new_fetcher(async=False)
+            return self._sync_fetcher.fetch(utils.decode_unicode_obj(task))[1]
+
+    def xmlrpc_run(self, port=24444, bind='127.0.0.1', logRequests=False):
+        import umsgpack
+        from xmlrpclib import Binary
+        from pyspider.libs.rpc import ThreadingXMLRPCServer
+
+        server = ThreadingXMLRPCServer((bind, port), allow_none=True, logRequests=logRequests)
+        server.register_introspection_functions()
+        server.register_multicall_functions()
+
+        server.register_function(self.quit, '_quit')
+        server.register_function(self.size)
+        server.register_function(self.workers_info, 'workers')
+
+        def sync_fetch(task):
+            result = self.sync_fetch(task)
+            result = Binary(umsgpack.packb(result))
+            return result
+        server.register_function(sync_fetch, 'fetch')
+        server.register_function(self.counter, 'counter')
+        server.register_function(self.host_stats, 'host_stats')
+
+        server.timeout = 0.5
+        while not self._quit:
+            server.handle_request()
+        server.server_close()
@@ -5,15 +5,20 @@
 #         http://binux.me
 # Created on 2012-12-17 11:07:19
 
+import os
 import time
 import json
 import Queue
+import pycurl
 import logging
+import urlparse
+import tempfile
 import threading
 import cookie_utils
 import tornado.ioloop
 import tornado.httputil
 import tornado.httpclient
+from collections import OrderedDict
 from tornado.curl_httpclient import CurlAsyncHTTPClient
 from tornado.simple_httpclient import SimpleAsyncHTTPClient
 from pyspider.libs import utils, dataurl, counter
@@ -22,6 +27,28 @@ logger = logging.getLogger('fetcher')
 
 class MyCurlAsyncHTTPClient(CurlAsyncHTTPClient):
 
+    def initialize(self, io_loop, max_clients=10, defaults=None,
+                   max_host_connections=0, dns_cache_timeout=60):
+        super(MyCurlAsyncHTTPClient, self).initialize(io_loop, max_clients, defaults)
+        # connections are shared by curls in a multi handle and kept alive for reuse,
+        # requests are queued in curl when max_host_connections of the host is reached
+        if max_host_connections:
+            self._multi.setopt(pycurl.M_MAX_HOST_CONNECTIONS, max_host_connections)
+        for curl in self._curls:
+            curl.setopt(pycurl.DNS_CACHE_TIMEOUT, dns_cache_timeout)
+
+    def _finish(self, curl, curl_error=None, curl_message=None):
+        # tls time and connection reuse are not in time_info of tornado, they are
+        # read before curl is released and stored in request of response
+        if curl.info:
+            # unwrap _RequestProxy as HTTPResponse does
+            request = getattr(curl.info['request'], 'request', curl.info['request'])
+            request.curl_info = {
+                'appconnect': curl.getinfo(pycurl.APPCONNECT_TIME),
+                'num_connects': curl.getinfo(pycurl.NUM_CONNECTS),
+            }
+        super(MyCurlAsyncHTTPClient, self)._finish(curl, curl_error, curl_message)
+
     def free_size(self):
         return len(self._free_list)
 
@@ -37,6 +64,153 @@ class MySimpleAsyncHTTPClient(SimpleAsyncHTTPClient):
     def size(self):
         return len(self.active)
 
+class BodyBuffer(object):
+
+    '''
+    response body written by curl. buffer is presized by content-length up to
+    RESERVE_LIMIT, body is truncated at max_size and spilled to a temporary file
+    after spill_size.
+    '''
+
+    # content-length is sent by server, larger buffer grows as data arrives
+    RESERVE_LIMIT = 1024 * 1024
+    SPILL_PREFIX = 'pyspider-body-'
+
+    def __init__(self, max_size=None, spill_size=None, spill_dir=None):
+        self.max_size = max_size
+        self.spill_size = spill_size
+        self.spill_dir = spill_dir
+        self.buffer = bytearray()
+        self.length = 0
+        self.file = None
+        self.truncated = False
+
+    def reserve(self, size):
+        if self.max_size:
+            size = min(size, self.max_size)
+        if self.spill_size and size > self.spill_size:
+            return
+        size = min(size, self.RESERVE_LIMIT)
+        if size > len(self.buffer):
+            self.buffer.extend(bytearray(size - len(self.buffer)))
+
+    def write(self, chunk):
+        '''
+        return False if body is over max_size
+        '''
+        if self.max_size and self.length + len(chunk) > self.max_size:
+            chunk = chunk[:self.max_size - self.length]
+            self.truncated = True
+        if self.file is None and self.spill_size and self.length + len(chunk) > self.spill_size:
+            self.file = tempfile.NamedTemporaryFile(prefix=self.SPILL_PREFIX, dir=self.spill_dir,
+                                                    delete=False)
+            self.file.write(buffer(self.buffer, 0, self.length))
+            self.buffer = None
+        if self.file is not None:
+            self.file.write(chunk)
+        else:
+            self.buffer[self.length:self.length + len(chunk)] = chunk
+        self.length += len(chunk)
+        return not self.truncated
+
+    def getvalue(self):
+        if self.file is not None:
+            return ''
+        del self.buffer[self.length:]
+        return str(self.buffer)
+
+    def close(self):
+        '''
+        return path of spilled file
+        '''
+        if self.file is None:
+            return None
+        self.file.close()
+        return self.file.name
+
+
+def response_time_info(response):
+    '''
+    seconds spent in each phase of a curl response: dns, connect, tls and wait (from
+    request sent to first byte), reused is True when no new connection is made.
+    '''
+    time_info = getattr(response, 'time_info', None)
+    curl_info = getattr(response.request, 'curl_info', None)
+    if not time_info or not curl_info:
+        return None
+    return {
+        'dns': time_info['namelookup'],
+        'connect': max(time_info['connect'] - time_info['namelookup'], 0),
+        'tls': max(curl_info['appconnect'] - time_info['connect'], 0)
+        if curl_info['appconnect'] else 0,
+        'wait': max(time_info['starttransfer'] - time_info['pretransfer'], 0),
+        'reused': curl_info['num_connects'] == 0,
+    }
+
+
+class HostStats(object):
+
+    '''
+    time of phases and connection reuse of hosts in recent window, least recently
+    fetched hosts are dropped when there are more than size hosts.
+    '''
+
+    fields = ('requests', 'reused', 'dns', 'connect', 'tls', 'wait')
+
+    def __init__(self, size=1000, window_size=30, window_interval=10):
+        self.size = size
+        self.window_size = window_size
+        self.window_interval = window_interval
+        self.hosts = OrderedDict()
+        # read by xmlrpc thread
+        self.mutex = threading.Lock()
+
+    def event(self, host, time_info):
+        with self.mutex:
+            counters = self.hosts.pop(host, None)
+            if counters is None:
+                counters = dict((x, counter.TimebaseAverageWindowCounter(
+                    self.window_size, self.window_interval)) for x in self.fields)
+                if len(self.hosts) >= self.size:
+                    self.hosts.popitem(last=False)
+            self.hosts[host] = counters
+            counters['requests'].event(1)
+            if time_info['reused']:
+                counters['reused'].event(1)
+            for phase in ('dns', 'connect', 'tls', 'wait'):
+                counters[phase].event(time_info[phase])
+
+    def __len__(self):
+        return len(self.hosts)
+
+    def to_dict(self):
+        '''
+        sums of hosts in window, {host: {'requests': n, 'dns': seconds, ...}}
+        '''
+        with self.mutex:
+            return dict((host, dict((k, v.sum) for k, v in counters.iteritems()))
+                        for host, counters in self.hosts.iteritems())
+
+
+def host_stats(sums):
+    '''
+    average time of phases and connection reuse of each host from sums of HostStats,
+    {host: {'requests': n, 'reused': n, 'dns': seconds, ...}}
+    '''
+    result = {}
+    for host, value in sums.iteritems():
+        requests = value.get('requests', 0)
+        if not requests:
+            continue
+        stats = result[host] = {
+            'requests': requests,
+            'reused': value.get('reused', 0),
+        }
+        for phase in ('dns', 'connect', 'tls', 'wait'):
+            stats[phase] = float(value.get(phase, 0)) / requests
+    return result
+
+
 fetcher_output = {
     "status_code": int,
     "orig_url": str,
@@ -55,24 +229,64 @@ class Fetcher(object):
         'timeout': 120,
     }
     phantomjs_proxy = None
-
-    def __init__(self, inqueue, outqueue, poolsize=100, proxy=None, async=True):
+    # bodies over max_body_size are truncated or aborted by body_overflow, no limit
+    # by default. bodies over spill_size are saved in a temporary file and sent as
+    # content_file.
+    max_body_size = None
+    body_overflow = 'truncate'
+    spill_size = None
+    spill_dir = None
+    # spilled bodies are removed by processor when read, those not read, e.g. of
+    # dropped results, are removed after SPILL_MAX_AGE
+    SPILL_MAX_AGE = 24 * 60 * 60
+    # contents larger than blob_threshold are put into blob_store and sent to
+    # processor as content_blob handle
+    blob_store = None
+    blob_threshold = 64 * 1024
+    GC_INTERVAL = 60
+    # connections kept to a host at most, 0 is unlimited. dns results are cached
+    # for dns_cache_timeout seconds
+    max_host_connections = 0
+    dns_cache_timeout = 60
+    # hosts kept in host_stats
+    HOST_STATS_SIZE = 1000
+
+    def __init__(self, inqueue, outqueue, poolsize=100, proxy=None, async=True,
+                 prefetch=10, max_host_connections=None, dns_cache_timeout=None):
         self.inqueue = inqueue
         self.outqueue = outqueue
 
         self.poolsize = poolsize
+        # tasks taken from inqueue beyond poolsize, queued in http_client to start
+        # as soon as a connection is free
+        self.prefetch = prefetch
+        self._slots = threading.Semaphore(poolsize + prefetch)
         self._running = False
         self._quit = False
         self.proxy = proxy
         self.async = async
-
+        if max_host_connections is not None:
+            self.max_host_connections = max_host_connections
+        if dns_cache_timeout is not None:
+            self.dns_cache_timeout = dns_cache_timeout
+
+        client_options = {
+            'max_clients': self.poolsize,
+            'max_host_connections': self.max_host_connections,
+            'dns_cache_timeout': self.dns_cache_timeout,
+        }
         if async:
-            self.http_client = MyCurlAsyncHTTPClient(max_clients=self.poolsize)
+            self.http_client = MyCurlAsyncHTTPClient(**client_options)
         else:
             self.http_client = tornado.httpclient.HTTPClient(
-                MyCurlAsyncHTTPClient, max_clients=self.poolsize
+                MyCurlAsyncHTTPClient, **client_options
             )
 
+        self._blob_queue = None
+        self._sync_lock = threading.Lock()
+        self._gc_lock = threading.Lock()
+        self._host_stats = HostStats(self.HOST_STATS_SIZE)
+
         self._cnt = {
             '5m': counter.CounterManager(
                 lambda: counter.TimebaseAverageWindowCounter(30, 10)),
@@ -80,13 +294,91 @@ class Fetcher(object):
                 lambda: counter.TimebaseAverageWindowCounter(60, 60)),
         }
 
+    def _put_blob(self, result):
+        # result is copied, it's still used by on_result in ioloop
+        result = dict(result)
+        if result.get('content_file'):
+            result['content_blob'] = self.blob_store.put_file(result.pop('content_file'))
+        elif len(result.get('content') or '') > self.blob_threshold:
+            result['content_blob'] = self.blob_store.put(result['content'])
+            result['content'] = ''
+        return result
+
+    def _blob_sender(self):
+        """
+        results are put into blob store and sent in this thread, blobs are not
+        written in ioloop
+        """
+        while True:
+            task, result = self._blob_queue.get()
+            try:
+                self.outqueue.put((task, self._put_blob(result)))
+            except Exception as e:
+                logger.exception(e)
+                self._remove_content_file(result)
+
+    def _spill_dir(self):
+        return self.spill_dir or (self.blob_store and self.blob_store.path) or None
+
+    def _gc_spill_files(self):
+        """
+        remove spilled bodies older than SPILL_MAX_AGE
+        """
+        spill_dir = self._spill_dir() or tempfile.gettempdir()
+        if not os.path.isdir(spill_dir):
+            return 0
+        deadline = time.time() - self.SPILL_MAX_AGE
+        cnt = 0
+        for filename in os.listdir(spill_dir):
+            if not filename.startswith(BodyBuffer.SPILL_PREFIX):
+                continue
+            path = os.path.join(spill_dir, filename)
+            try:
+                if os.path.getmtime(path) < deadline:
+                    os.remove(path)
+                    cnt += 1
+            except OSError:
+                pass
+        if cnt:
+            logger.info('%d spilled bodies removed from %s', cnt, spill_dir)
+        return cnt
+
+    @staticmethod
+    def _remove_content_file(result):
+        path = result.get('content_file')
+        if path and os.path.exists(path):
+            os.remove(path)
+
+    def _gc(self):
+        """
+        remove expired blobs and spilled bodies, skipped when last gc is still running
+        """
+        if not self._gc_lock.acquire(False):
+            return
+        try:
+            if self.blob_store:
+                self.blob_store.gc()
+            self._gc_spill_files()
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            self._gc_lock.release()
+
     def send_result(self, type, task, result):
         """type in ('data', 'http')"""
         if self.outqueue:
             try:
-                self.outqueue.put((task, result))
+                if self.blob_store:
+                    if self._blob_queue is None:
+                        # blocks ioloop as outqueue.put when processor is busy
+                        self._blob_queue = Queue.Queue(maxsize=self.poolsize)
+                        utils.run_in_thread(self._blob_sender)
+                    self._blob_queue.put((task, result))
+                else:
+                    self.outqueue.put((task, result))
             except Exception as e:
                 logger.exception(e)
+                self._remove_content_file(result)
 
     def fetch(self, task, callback=None):
         url = task.get('url', 'data:,')
@@ -110,7 +402,13 @@ class Fetcher(object):
             _result['result'] = result
             wait_result.notify()
             wait_result.release()
-        self.fetch(task, callback=callback)
+        # called from xmlrpc threads, http client is only used in ioloop thread
+        if self.async:
+            tornado.ioloop.IOLoop.instance().add_callback(
+                lambda: self.fetch(task, callback=callback))
+        else:
+            with self._sync_lock:
+                self.fetch(task, callback=callback)
 
         wait_result.acquire()
         while 'result' not in _result:
@@ -197,10 +495,25 @@ class Fetcher(object):
             cookie = fetch['cookies']
             del fetch['cookies']
 
+        max_body_size = task_fetch.get('max_body_size', self.max_body_size)
+        body_overflow = task_fetch.get('body_overflow', self.body_overflow)
+        body = BodyBuffer(max_body_size, task_fetch.get('spill_size', self.spill_size),
+                          self._spill_dir())
+        status_line = []
+
         def handle_response(response):
             response.headers = final_headers
             session.extract_cookies_to_jar(request, cookie_headers)
-            if response.error and not isinstance(response.error, tornado.httpclient.HTTPError):
+            content_file = body.close()
+            time_info = response_time_info(response)
+            if body.truncated and body_overflow == 'truncate' and status_line:
+                # transfer is stopped by write_function, it's not an error
+                response.code = status_line[-1].code
+                response.error = None
+            elif body.truncated:
+                response.error = Exception('body larger than max_body_size: %d' % max_body_size)
+            if response.error and (body.truncated or not isinstance(
+                    response.error, tornado.httpclient.HTTPError)):
                 result = {
                     'status_code': 599,
                     'error': "%r" % response.error,
@@ -209,19 +522,33 @@ class Fetcher(object):
                     'orig_url': url,
                     'url': url,
                 }
+                if time_info:
+                    result['time_info'] = time_info
+                if content_file:
+                    os.remove(content_file)
                 callback('http', task, result)
                 self.on_result('http', task, result)
                 return task, result
             result = {}
             result['orig_url'] = url
-            result['content'] = response.body or ''
+            result['content'] = body.getvalue()
+            if content_file:
+                result['content_file'] = content_file
+            result['content_size'] = body.length
+            if body.truncated:
+                result['truncated'] = True
             result['headers'] = dict(response.headers)
             result['status_code'] = response.code
             result['url'] = response.effective_url or url
             result['cookies'] = session.to_dict()
             result['time'] = time.time() - start_time
+            if time_info:
+                result['time_info'] = time_info
             result['save'] = task_fetch.get('save')
-            if 200 <= response.code < 300:
+            if body.truncated:
+                logger.warning("[%d] %s %.2fs truncated at %d bytes", response.code, url,
+                               result['time'], max_body_size)
+            elif 200 <= response.code < 300:
                 logger.info("[%d] %s %.2fs", response.code, url, result['time'])
             else:
                 logger.warning("[%d] %s %.2fs", response.code, url, result['time'])
@@ -233,11 +560,27 @@ class Fetcher(object):
             line = line.strip()
             if line.startswith("HTTP/"):
                 final_headers.clear()
+                status_line.append(tornado.httputil.parse_response_start_line(line))
                 return
             if not line:
                 return
             final_headers.parse_line(line)
             cookie_headers.parse_line(line)
+            if line.lower().startswith('content-length:'):
+                try:
+                    body.reserve(int(line.split(':', 1)[1]))
+                except ValueError:
+                    pass
+
+        def write_function(chunk):
+            # returning 0 aborts the transfer
+            if not body.write(chunk):
+                return 0
+
+        def prepare_curl_callback(curl):
+            curl.setopt(pycurl.WRITEFUNCTION, write_function)
+
+        fetch['prepare_curl_callback'] = prepare_curl_callback
 
         start_time = time.time()
         session = cookie_utils.CookieSession()
@@ -255,7 +598,12 @@ class Fetcher(object):
             else:
                 return handle_response(self.http_client.fetch(request))
         except tornado.httpclient.HTTPError as e:
-            return handle_response(e.response)
+            response = e.response
+            if response is None:
+                # curl errors, e.g. transfer aborted by write_function, have no response
+                response = tornado.httpclient.HTTPResponse(
+                    request, e.code, error=e, request_time=time.time() - start_time)
+            return handle_response(response)
         except Exception as e:
             raise
             result = {
@@ -362,30 +710,56 @@ class Fetcher(object):
             self.on_result('phantomjs', task, result)
             return task, result
 
-    def run(self):
-        def queue_loop():
-            if not self.outqueue or not self.inqueue:
-                return
-            while not self._quit:
-                try:
-                    if self.outqueue.full():
-                        break
-                    if self.http_client.free_size() <= 0:
-                        break
-                    task = self.inqueue.get_nowait()
-                    # FIXME: decode unicode_obj should used after data selete from
-                    # database, it's used here for performance
-                    task = utils.decode_unicode_obj(task)
-                    self.fetch(task)
-                except Queue.Empty:
-                    break
-                except KeyboardInterrupt:
-                    break
-                except Exception as e:
-                    logger.exception(e)
+    def _intake(self):
+        '''
+        read tasks from inqueue in a thread and hand them over to ioloop, at most
+        poolsize + prefetch tasks are in flight
+        '''
+        ioloop = tornado.ioloop.IOLoop.instance()
+        while not self._quit:
+            # wait for a free slot, released when a fetch is done or quit
+            self._slots.acquire()
+            try:
+                while self.outqueue.full() and not self._quit:
+                    time.sleep(0.1)
+                task = self.inqueue.get(timeout=1)
+            except Queue.Empty:
+                self._slots.release()
+                continue
+            except Exception as e:
+                self._slots.release()
+                if self._quit:
                     break
+                logger.exception(e)
+                time.sleep(1)
+                continue
+            ioloop.add_callback(self._on_intake, task)
+
+    def _on_intake(self, task):
+        released = []
 
-        tornado.ioloop.PeriodicCallback(queue_loop, 100).start()
+        def callback(type, task, result):
+            if not released:
+                released.append(True)
+                self._slots.release()
+            self.send_result(type, task, result)
+
+        try:
+            # FIXME: decode unicode_obj should used after data selete from
+            # database, it's used here for performance
+            task = utils.decode_unicode_obj(task)
+            self.fetch(task, callback=callback)
+        except Exception as e:
+            logger.exception(e)
+            if not released:
+                released.append(True)
+                self._slots.release()
+
+    def run(self):
+        if self.outqueue and self.inqueue:
+            utils.run_in_thread(self._intake)
+        tornado.ioloop.PeriodicCallback(lambda: utils.run_in_thread(self._gc),
+                                        self.GC_INTERVAL * 1000).start()
         self._running = True
         try:
             tornado.ioloop.IOLoop.instance().start()
@@ -397,17 +771,21 @@ class Fetcher(object):
     def size(self):
         return self.http_client.size()
 
+    def host_stats(self):
+        return host_stats(self._host_stats.to_dict())
+
     def quit(self):
         self._running = False
         self._quit = True
+        self._slots.release()
         tornado.ioloop.IOLoop.instance().stop()
 
     def xmlrpc_run(self, port=24444, bind='127.0.0.1', logRequests=False):
         import umsgpack
-        from SimpleXMLRPCServer import SimpleXMLRPCServer
         from xmlrpclib import Binary
+        from pyspider.libs.rpc import ThreadingXMLRPCServer
 
-        server = SimpleXMLRPCServer((bind, port), allow_none=True, logRequests=logRequests)
+        server = ThreadingXMLRPCServer((bind, port), allow_none=True, logRequests=logRequests)
         server.register_introspection_functions()
         server.register_multicall_functions()
 
@@ -423,6 +801,7 @@ class Fetcher(object):
         def dump_counter(_time, _type):
             return self._cnt[_time].to_dict(_type)
         server.register_function(dump_counter, 'counter')
+        server.register_function(self.host_stats, 'host_stats')
 
         server.timeout = 0.5
         while not self._quit:
@@ -440,12 +819,20 @@ class Fetcher(object):
             status_code = (int(status_code) / 100 * 100)
         self._cnt['5m'].event((task.get('project'), status_code), +1)
         self._cnt['1h'].event((task.get('project'), status_code), +1)
+        if result.get('truncated'):
+            self._cnt['5m'].event((task.get('project'), 'truncated'), +1)
+            self._cnt['1h'].event((task.get('project'), 'truncated'), +1)
 
         if type == 'http' and result.get('time'):
-            content_len = len(result.get('content', ''))
+            # content could be spilled to file
+            content_len = result.get('content_size', len(result.get('content', '')))
             self._cnt['5m'].event((task.get('project'), 'speed'),
                                   float(content_len) / result.get('time'))
             self._cnt['1h'].event((task.get('project'), 'speed'),
                                   float(content_len) / result.get('time'))
             self._cnt['5m'].event((task.get('project'), 'time'), result.get('time'))
             self._cnt['1h'].event((task.get('project'), 'time'), result.get('time'))
+
+        if type == 'http' and result.get('time_info'):
+            self._host_stats.event(urlparse.urlsplit(result.get('orig_url') or '').netloc,
+                                   result['time_info'])
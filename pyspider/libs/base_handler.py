@@ -6,6 +6,7 @@
 # Created on 2014-02-16 23:12:48
 
 import sys
+import math
 import inspect
 import functools
 import fractions
@@ -84,6 +85,20 @@ class NOTSET(object):
     pass
 
 
+def cron_due(interval, tick, last_tick=None):
+    '''
+    if a cronjob of interval should run at tick. a tick covers (last_tick, tick] when
+    ticks missed by scheduler are coalesced, otherwise tick should be a multiple
+    of interval.
+    '''
+    # tolerance in unit of interval, float ticks of sub-second interval are not exact
+    eps = 1e-3
+    k = math.floor(float(tick) / interval + eps)
+    if last_tick is None:
+        return float(tick) / interval - k < eps
+    return k > math.floor(float(last_tick) / interval + eps)
+
+
 def every(minutes=NOTSET, seconds=NOTSET):
     def wrapper(func):
         @functools.wraps(func)
@@ -91,7 +106,8 @@ def every(minutes=NOTSET, seconds=NOTSET):
             if (
                     response.save
                     and 'tick' in response.save
-                    and response.save['tick'] % (minutes * 60 + seconds) != 0
+                    and not cron_due(minutes * 60 + seconds, response.save['tick'],
+                                     response.save.get('last_tick'))
             ):
                 return None
             function = func.__get__(self, self.__class__)
@@ -127,10 +143,15 @@ class BaseHandlerMeta(type):
         for each in attrs.values():
             if inspect.isfunction(each) and getattr(each, 'is_cronjob', False):
                 cron_jobs.append(each)
-                min_tick = fractions.gcd(min_tick, each.tick)
+                # Fraction for sub-second ticks, like 0.1s
+                min_tick = fractions.gcd(
+                    min_tick, fractions.Fraction(each.tick).limit_denominator(1000))
         newcls = type.__new__(cls, name, bases, attrs)
         newcls.cron_jobs = cron_jobs
-        newcls.min_tick = min_tick
+        if min_tick and min_tick.denominator != 1:
+            newcls.min_tick = float(min_tick)
+        else:
+            newcls.min_tick = int(min_tick)
         return newcls
 
 
@@ -228,7 +249,8 @@ class BaseHandler(object):
             kwargs.setdefault('method', 'POST')
 
         schedule = {}
-        for key in ('priority', 'retries', 'exetime', 'age', 'itag', 'force_update'):
+        for key in ('priority', 'retries', 'exetime', 'age', 'itag', 'force_update',
+                    'host_rate', 'host_burst', 'host_concurrency'):
             if key in kwargs and kwargs[key] is not None:
                 schedule[key] = kwargs[key]
         if schedule:
@@ -249,7 +271,10 @@ class BaseHandler(object):
                 'js_run_at',
                 'js_script',
                 'load_images',
-                'fetch_type'
+                'fetch_type',
+                'max_body_size',
+                'body_overflow',
+                'spill_size',
         ):
             if key in kwargs and kwargs[key] is not None:
                 fetch[key] = kwargs[key]
@@ -294,11 +319,18 @@ class BaseHandler(object):
           js_script
           load_images
 
+          max_body_size
+          body_overflow
+          spill_size
+
           priority
           retries
           exetime
           age
           itag
+          host_rate
+          host_burst
+          host_concurrency
 
           save
           taskid
@@ -348,4 +380,6 @@ class BaseHandler(object):
         for each in response.save:
             if each == 'min_tick':
                 result[each] = self.min_tick
+            elif each == 'retry_policy':
+                result[each] = getattr(self, 'crawl_config', {}).get('retry_policy')
         self.crawl('data:,on_get_info', save=result)
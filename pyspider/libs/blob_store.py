@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set et sw=4 ts=4 sts=4 ff=unix fenc=utf8:
+# Author: Binux<i@binux.me>
+#         http://binux.me
+# Created on 2014-12-19 17:24:48
+
+import os
+import time
+import mmap
+import shutil
+import hashlib
+import logging
+import tempfile
+
+logger = logging.getLogger('blob_store')
+
+
+def blob_path(path, key):
+    return os.path.join(path, key[:2], key)
+
+
+def open_blob(handle):
+    '''
+    read-only mmap of blob by handle, content is not copied until it's sliced.
+    it's an empty string for empty blob, which can't be mapped.
+    '''
+    with open(blob_path(handle['path'], handle['key']), 'rb') as fp:
+        if not os.fstat(fp.fileno()).st_size:
+            return ''
+        return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class BlobStore(object):
+
+    '''
+    content addressed blobs in a directory, blob of sha1 hex key is stored in
+    <path>/<key[:2]>/<key>. blobs are removed by gc after max_age seconds since
+    last put, which should be much longer than results could wait in queue. a blob
+    is not removed by consumer as it may be shared by results of same content.
+
+    handle of a blob, {'path': path, 'key': key, 'size': size}, is sent between
+    components sharing the directory instead of the content.
+    '''
+
+    def __init__(self, path, max_age=24 * 60 * 60):
+        self.path = path
+        self.max_age = max_age
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+    def _blob_path(self, key):
+        return blob_path(self.path, key)
+
+    def _handle(self, key, size):
+        return {'path': self.path, 'key': key, 'size': size}
+
+    def _store(self, key, tmp_path):
+        path = self._blob_path(key)
+        if os.path.exists(path):
+            # same content, only refresh time for gc
+            os.remove(tmp_path)
+            os.utime(path, None)
+            return
+        if not os.path.exists(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass
+        shutil.move(tmp_path, path)
+
+    def put(self, data):
+        '''
+        store data, return handle
+        '''
+        key = hashlib.sha1(data).hexdigest()
+        if os.path.exists(self._blob_path(key)):
+            os.utime(self._blob_path(key), None)
+            return self._handle(key, len(data))
+        fd, tmp_path = tempfile.mkstemp(prefix='.blob-', dir=self.path)
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data)
+        self._store(key, tmp_path)
+        return self._handle(key, len(data))
+
+    def put_file(self, filename):
+        '''
+        move file into store, return handle
+        '''
+        sha1 = hashlib.sha1()
+        size = 0
+        with open(filename, 'rb') as fp:
+            while True:
+                data = fp.read(65536)
+                if not data:
+                    break
+                sha1.update(data)
+                size += len(data)
+        key = sha1.hexdigest()
+        self._store(key, filename)
+        return self._handle(key, size)
+
+    def open(self, key):
+        return open_blob(self._handle(key, None))
+
+    def get(self, key):
+        buf = self.open(key)
+        try:
+            return buf[:]
+        finally:
+            if isinstance(buf, mmap.mmap):
+                buf.close()
+
+    def gc(self, max_age=None):
+        '''
+        remove blobs not put in max_age seconds, return number of removed
+        '''
+        deadline = time.time() - (max_age or self.max_age)
+        cnt = 0
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    if os.path.getmtime(path) < deadline:
+                        os.remove(path)
+                        cnt += 1
+                except OSError:
+                    pass
+        if cnt:
+            logger.info('%d blobs removed from %s', cnt, self.path)
+        return cnt
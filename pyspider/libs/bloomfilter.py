@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set et sw=4 ts=4 sts=4 ff=unix fenc=utf8:
+# Author: Binux<i@binux.me>
+#         http://binux.me
+# Created on 2014-12-10 21:03:15
+
+import math
+import time
+import struct
+import cPickle
+import hashlib
+import logging
+
+
+class BloomFilter(object):
+
+    '''
+    bloom filter with fixed capacity, positions are generated by double hashing
+    the md5 digest of key.
+    '''
+
+    def __init__(self, capacity=100000, error_rate=0.001):
+        assert 0 < error_rate < 1, "error_rate should between 0 and 1"
+        assert capacity > 0, "capacity should > 0"
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_hashes = int(math.ceil(math.log(1.0 / error_rate, 2)))
+        self.num_bits = int(math.ceil(
+            capacity * abs(math.log(error_rate)) / (math.log(2) ** 2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf8')
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        for i in xrange(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def __contains__(self, key):
+        bits = self.bits
+        for pos in self._positions(key):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def add(self, key):
+        '''
+        add key to filter, return True if key was (probably) in filter already
+        '''
+        bits = self.bits
+        found = True
+        for pos in self._positions(key):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                found = False
+                bits[pos >> 3] |= 1 << (pos & 7)
+        if not found:
+            self.count += 1
+        return found
+
+    def __len__(self):
+        return self.count
+
+    def full(self):
+        return self.count >= self.capacity
+
+
+class ScalableBloomFilter(object):
+
+    '''
+    bloom filter which grows when full, by appending a larger filter with a tighter
+    error rate to keep the overall error rate near error_rate.
+    '''
+
+    def __init__(self, initial_capacity=100000, error_rate=0.001, scale=2, ratio=0.9):
+        self.initial_capacity = initial_capacity
+        self.error_rate = error_rate
+        self.scale = scale
+        self.ratio = ratio
+        self.filters = []
+
+    def __contains__(self, key):
+        for f in reversed(self.filters):
+            if key in f:
+                return True
+        return False
+
+    def add(self, key):
+        if key in self:
+            return True
+        if not self.filters or self.filters[-1].full():
+            num = len(self.filters)
+            self.filters.append(BloomFilter(
+                capacity=self.initial_capacity * (self.scale ** num),
+                error_rate=self.error_rate * (1 - self.ratio) * (self.ratio ** num)))
+        self.filters[-1].add(key)
+        return False
+
+    def __len__(self):
+        return sum(len(f) for f in self.filters)
+
+    @property
+    def capacity(self):
+        return sum(f.capacity for f in self.filters)
+
+
+class RotatingBloomFilter(object):
+
+    '''
+    scalable bloom filter forgets keys added more than 2 * period seconds ago.
+
+    keys are added to current generation, current generation becomes previous
+    generation after period seconds, and previous generation is dropped.
+    '''
+
+    def __init__(self, period=24 * 60 * 60, **kwargs):
+        self.period = period
+        self.kwargs = kwargs
+        self.current = ScalableBloomFilter(**kwargs)
+        self.previous = None
+        self.start_time = time.time()
+
+    def _check_rotate(self):
+        now = time.time()
+        if now - self.start_time < self.period:
+            return
+        if now - self.start_time < 2 * self.period:
+            self.previous = self.current
+        else:
+            self.previous = None
+        self.current = ScalableBloomFilter(**self.kwargs)
+        self.start_time = now
+
+    def __contains__(self, key):
+        self._check_rotate()
+        if key in self.current:
+            return True
+        if self.previous is not None and key in self.previous:
+            return True
+        return False
+
+    def add(self, key):
+        if key in self:
+            return True
+        return self.current.add(key)
+
+    def __len__(self):
+        return len(self.current) + (len(self.previous) if self.previous else 0)
+
+    def dump(self, filename):
+        try:
+            cPickle.dump(self, open(filename, 'wb'), cPickle.HIGHEST_PROTOCOL)
+        except:
+            logging.error("can't dump bloom filter to file: %s" % filename)
+            return False
+        return True
+
+    @classmethod
+    def load(cls, filename):
+        try:
+            ret = cPickle.load(open(filename, 'rb'))
+        except:
+            logging.debug("can't load bloom filter from file: %s" % filename)
+            return None
+        if not isinstance(ret, cls):
+            return None
+        ret._check_rotate()
+        return ret
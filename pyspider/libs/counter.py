@@ -6,6 +6,7 @@
 # Created on 2012-11-14 17:09:50
 
 import time
+import bisect
 import cPickle
 import logging
 from collections import deque
@@ -134,6 +135,45 @@ class TimebaseAverageWindowCounter(BaseCounter):
         pass
 
 
+class HistogramCounter(BaseCounter):
+
+    '''
+    count of values in each bucket, bucket i holds values <= bounds[i]
+    '''
+
+    def __init__(self, bounds=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.cnt = 0
+        self.total = 0
+
+    def event(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.cnt += 1
+        self.total += value
+
+    value = event
+
+    @property
+    def avg(self):
+        if not self.cnt:
+            return 0
+        return float(self.total) / self.cnt
+
+    @property
+    def sum(self):
+        return self.total
+
+    @property
+    def histogram(self):
+        result = dict(('%g' % b, c) for b, c in zip(self.bounds, self.counts))
+        result['+inf'] = self.counts[-1]
+        return result
+
+    def empty(self):
+        return self.cnt == 0
+
+
 class CounterValue(DictMixin):
 
     def __init__(self, manager, keys):
@@ -228,6 +268,12 @@ class CounterManager(DictMixin):
         else:
             return CounterValue(self, key)
 
+    def __delitem__(self, key):
+        key = (key, )
+        for _key in self.counters.keys():
+            if _key[:len(key)] == key:
+                del self.counters[_key]
+
     def keys(self):
         result = set()
         for key in self.counters:
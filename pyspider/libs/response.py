@@ -5,13 +5,18 @@
 #         http://binux.me
 # Created on 2012-11-02 11:16:02
 
+import os
 import json
+import logging
 import chardet
 from pyquery import PyQuery
 from requests.structures import CaseInsensitiveDict
 from requests.utils import get_encoding_from_headers, get_encodings_from_content
 from requests import HTTPError
 
+from pyspider.libs.blob_store import blob_path, open_blob
+logger = logging.getLogger('response')
+
 
 class Response(object):
 
@@ -21,14 +26,41 @@ class Response(object):
         self.orig_url = None
         self.headers = CaseInsensitiveDict()
         self.content = ''
+        self.content_blob = None
+        self._buffer = None
         self.cookies = {}
         self.error = None
         self.save = None
         self.time = 0
+        self.truncated = False
 
     def __repr__(self):
         return '<Response [%d]>' % self.status_code
 
+    @property
+    def content_buffer(self):
+        """Content of the response, content in blob store is mapped without copy."""
+        if self._content is not None:
+            return self._content
+        if self._buffer is None:
+            try:
+                self._buffer = open_blob(self.content_blob)
+            except (IOError, OSError) as e:
+                logger.error('content blob %s: %r', self.content_blob['key'], e)
+                self.error = 'content blob missing: %s' % self.content_blob['key']
+                self._buffer = ''
+        return self._buffer
+
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = self.content_buffer[:]
+        return self._content
+
+    @content.setter
+    def content(self, value):
+        self._content = value
+
     def __bool__(self):
         """Returns true if :attr:`status_code` is 'OK'."""
         return self.ok
@@ -160,8 +192,22 @@ def rebuild_response(r):
     response.url = r.get('url', '')
     response.headers = CaseInsensitiveDict(r.get('headers', {}))
     response.content = r.get('content', '')
+    if r.get('content_file'):
+        # large body spilled to file by fetcher
+        with open(r['content_file'], 'rb') as fp:
+            response.content = fp.read()
+        os.remove(r['content_file'])
+    elif r.get('content_blob'):
+        # loaded from blob store when it's used
+        response.content = None
+        response.content_blob = r['content_blob']
+    response.truncated = r.get('truncated', False)
     response.cookies = r.get('cookies', {})
     response.error = r.get('error')
+    if response.content_blob and not response.error and not os.path.exists(
+            blob_path(response.content_blob['path'], response.content_blob['key'])):
+        # removed by gc before processed
+        response.error = 'content blob missing: %s' % response.content_blob['key']
     response.time = r.get('time', 0)
     response.orig_url = r.get('orig_url', response.url)
     response.save = r.get('save')
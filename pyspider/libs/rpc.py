@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set et sw=4 ts=4 sts=4 ff=unix fenc=utf8:
+# Author: Binux<i@binux.me>
+#         http://binux.me
+# Created on 2014-12-15 21:14:37
+
+import time
+import socket
+import httplib
+import logging
+import urlparse
+import threading
+import SocketServer
+from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+
+import umsgpack
+
+from pyspider.libs import counter
+logger = logging.getLogger('rpc')
+
+
+class _LimitedReader(object):
+
+    '''
+    file-like object reads at most length bytes from fp
+    '''
+
+    def __init__(self, fp, length):
+        self.fp = fp
+        self.remaining = length
+
+    def read(self, n=-1):
+        if n < 0 or n > self.remaining:
+            n = self.remaining
+        data = self.fp.read(n)
+        self.remaining -= len(data)
+        return data
+
+
+class RequestHandler(SimpleXMLRPCRequestHandler):
+
+    '''
+    POST to a path registered by register_stream is read as a stream of msgpack
+    frames, others are handled as xmlrpc.
+    '''
+
+    def do_POST(self):
+        func = self.server.stream_handlers.get(self.path)
+        if func is None:
+            return SimpleXMLRPCRequestHandler.do_POST(self)
+
+        try:
+            length = int(self.headers['content-length'])
+        except (KeyError, TypeError, ValueError):
+            self.send_error(411)
+            return
+        reader = _LimitedReader(self.rfile, length)
+
+        def frames():
+            while reader.remaining:
+                yield umsgpack.unpack(reader)
+
+        start = time.time()
+        try:
+            result = func(frames())
+            code = 200
+        except umsgpack.UnpackException as e:
+            result = {'error': 'invalid msgpack frame: %r' % e}
+            code = 400
+        except Exception as e:
+            logger.exception(e)
+            result = {'error': '%r' % e}
+            code = 500
+        self.server.record(self.path, time.time() - start)
+        # the rest of body is dropped
+        while reader.read(65536):
+            pass
+
+        body = umsgpack.packb(result)
+        self.send_response(code)
+        self.send_header("Content-type", "application/x-msgpack")
+        self.send_header("Content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ThreadingXMLRPCServer(SocketServer.ThreadingMixIn, SimpleXMLRPCServer):
+
+    '''
+    xmlrpc server handles requests in at most max_workers threads, with msgpack
+    streaming endpoints. latency of each method is available by rpc_stats.
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, addr, requestHandler=RequestHandler, max_workers=10, **kwargs):
+        SimpleXMLRPCServer.__init__(self, addr, requestHandler=requestHandler, **kwargs)
+        self.stream_handlers = dict()
+        self.workers = threading.BoundedSemaphore(max_workers)
+        self.latency = counter.CounterManager(lambda: counter.AverageWindowCounter(100))
+        self.calls = counter.CounterManager(counter.TotalCounter)
+        self.register_function(self.rpc_stats, 'rpc_stats')
+
+    def process_request(self, request, client_address):
+        # wait for a free worker before accepting next request
+        self.workers.acquire()
+        try:
+            SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+        except:
+            self.workers.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            self.workers.release()
+
+    def _dispatch(self, method, params):
+        start = time.time()
+        try:
+            return SimpleXMLRPCServer._dispatch(self, method, params)
+        finally:
+            self.record(method, time.time() - start)
+
+    def record(self, method, cost):
+        self.latency.event(method, cost)
+        self.calls.event(method, 1)
+
+    def rpc_stats(self):
+        '''
+        calls, average and max seconds of last 100 calls of each method
+        '''
+        result = dict()
+        for method in self.calls.keys():
+            latency = self.latency[method]
+            result[method] = {
+                'calls': self.calls[method].sum,
+                'avg': latency.avg,
+                'max': max(latency.values),
+            }
+        return result
+
+    def register_stream(self, func, path):
+        '''
+        func is called with an iterator of unpacked frames, result is sent back packed
+        '''
+        self.stream_handlers[path] = func
+
+
+def post_frames(url, frames, timeout=None):
+    '''
+    post objects as msgpack frames to a stream endpoint, return unpacked result
+    '''
+    url = urlparse.urlsplit(url)
+    body = ''.join(umsgpack.packb(x) for x in frames)
+    conn = httplib.HTTPConnection(url.hostname, url.port or 80,
+                                  timeout=timeout or socket.getdefaulttimeout())
+    try:
+        conn.request('POST', url.path or '/', body, {'Content-Type': 'application/x-msgpack'})
+        response = conn.getresponse()
+        result = umsgpack.unpackb(response.read())
+    finally:
+        conn.close()
+    if response.status != 200:
+        raise Exception('%s %s' % (response.status, result.get('error')))
+    return result
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set et sw=4 ts=4 sts=4 ff=unix fenc=utf8:
+# Author: Binux<i@binux.me>
+#         http://binux.me
+# Created on 2014-12-14 15:32:06
+
+import bisect
+import hashlib
+
+
+class HashRing(object):
+
+    '''
+    consistent hashing ring, every node is placed on ring `replicas` times
+    '''
+
+    def __init__(self, nodes, replicas=100):
+        self.nodes = list(nodes)
+        self.replicas = replicas
+        self.ring = []
+        for node in self.nodes:
+            for i in range(replicas):
+                self.ring.append((self._hash('%s-%d' % (node, i)), node))
+        self.ring.sort()
+        self.keys = [x[0] for x in self.ring]
+
+    @staticmethod
+    def _hash(key):
+        if isinstance(key, unicode):
+            key = key.encode('utf8')
+        return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+    def get_node(self, key):
+        if not self.ring:
+            return None
+        i = bisect.bisect(self.keys, self._hash(key))
+        if i == len(self.ring):
+            i = 0
+        return self.ring[i][1]
+
+
+_rings = {}
+
+
+def shard_of(project, shards):
+    '''
+    index of scheduler shard which owns project
+    '''
+    if shards <= 1:
+        return 0
+    if shards not in _rings:
+        _rings[shards] = HashRing(range(shards))
+    return _rings[shards].get_node(project)
+
+
+class ShardedQueue(object):
+
+    '''
+    put messages into queue of the scheduler shard owns message['project'], a list
+    of tasks is split by shard.
+    '''
+
+    def __init__(self, queues):
+        self.queues = list(queues)
+
+    def _queue(self, obj):
+        return self.queues[shard_of(obj['project'], len(self.queues))]
+
+    def _split(self, obj):
+        if not isinstance(obj, (list, tuple)):
+            return [(self._queue(obj), obj)]
+        batches = {}
+        for each in obj:
+            batches.setdefault(shard_of(each['project'], len(self.queues)), []).append(each)
+        return [(self.queues[i], batch) for i, batch in batches.iteritems()]
+
+    def put(self, obj, block=True, timeout=None):
+        for queue, message in self._split(obj):
+            queue.put(message, block, timeout)
+
+    def put_nowait(self, obj):
+        for queue, message in self._split(obj):
+            queue.put_nowait(message)
+
+    def qsize(self):
+        return sum(x.qsize() for x in self.queues)
+
+    def empty(self):
+        return all(x.empty() for x in self.queues)
+
+
+class ShardedSchedulerRPC(object):
+
+    '''
+    xmlrpc client of sharded schedulers, calls are routed to the owner of project
+    or sent to every shard with results merged.
+    '''
+
+    def __init__(self, rpcs):
+        self.rpcs = list(rpcs)
+
+    def _rpc(self, project):
+        return self.rpcs[shard_of(project, len(self.rpcs))]
+
+    def _merge_dict(self, method, *args):
+        result = {}
+        for rpc in self.rpcs:
+            result.update(getattr(rpc, method)(*args))
+        return result
+
+    def _quit(self):
+        for rpc in self.rpcs:
+            rpc._quit()
+
+    def size(self):
+        return sum(rpc.size() for rpc in self.rpcs)
+
+    def counter(self, _time, _type):
+        return self._merge_dict('counter', _time, _type)
+
+    def loading_progress(self):
+        return self._merge_dict('loading_progress')
+
+    def dispatch_stats(self):
+        return self._merge_dict('dispatch_stats')
+
+    @staticmethod
+    def _merge_latency(result, other):
+        """
+        merge {method: {calls, avg, max, ...}} of other into result
+        """
+        for method, stats in other.iteritems():
+            if method not in result:
+                result[method] = stats
+                continue
+            merged = result[method]
+            calls = merged['calls'] + stats['calls']
+            if calls:
+                for key in ('avg', 'items'):
+                    if key in merged:
+                        merged[key] = (merged[key] * merged['calls']
+                                       + stats[key] * stats['calls']) / float(calls)
+            if 'max' in merged:
+                merged['max'] = max(merged['max'], stats['max'])
+            if 'histogram' in merged:
+                for bucket, cnt in stats['histogram'].iteritems():
+                    merged['histogram'][bucket] = merged['histogram'].get(bucket, 0) + cnt
+            merged['calls'] = calls
+        return result
+
+    def rpc_stats(self):
+        result = dict()
+        for rpc in self.rpcs:
+            self._merge_latency(result, rpc.rpc_stats())
+        return result
+
+    def stats(self):
+        result = {'phases': {}, 'taskdb': {}, 'profiling': ''}
+        for rpc in self.rpcs:
+            stats = rpc.stats()
+            self._merge_latency(result['phases'], stats['phases'])
+            self._merge_latency(result['taskdb'], stats['taskdb'])
+            result['profiling'] = result['profiling'] or stats['profiling']
+        return result
+
+    def profile(self, seconds=60):
+        return ', '.join(rpc.profile(seconds) for rpc in self.rpcs)
+
+    def newtask(self, task):
+        return self._rpc(task['project']).newtask(task)
+
+    def newtasks(self, tasks):
+        shards = dict()
+        for task in tasks:
+            shards.setdefault(shard_of(task['project'], len(self.rpcs)), []).append(task)
+        return sum(self.rpcs[i].newtasks(x) for i, x in shards.iteritems())
+
+    def update_project(self):
+        for rpc in self.rpcs:
+            rpc.update_project()
+
+    def get_active_tasks(self, project=None, limit=100, since=None):
+        args = (project or '', limit)
+        if since is not None:
+            args += (since, )
+        if project:
+            return self._rpc(project).get_active_tasks(*args)
+        result = []
+        for rpc in self.rpcs:
+            result.extend(rpc.get_active_tasks(*args))
+        result.sort(key=lambda x: x[0], reverse=True)
+        return result[:limit]
@@ -5,11 +5,13 @@
 #         http://binux.me
 # Created on 2014-02-16 22:59:56
 
+import os
 import sys
 import time
 import Queue
 import logging
 from pyspider.libs import utils
+from pyspider.libs.bloomfilter import RotatingBloomFilter
 from pyspider.libs.response import rebuild_response
 from project_module import ProjectLoader, ProjectFinder
 logger = logging.getLogger("processor")
@@ -53,18 +55,32 @@ class Processor(object):
 
     RESULT_LOGS_LIMIT = 1000
     RESULT_RESULT_LIMIT = 100
+    # follows of a response are sent to newtask_queue in lists of at most
+    NEWTASK_BATCH_SIZE = 100
 
-    def __init__(self, projectdb, inqueue, status_queue, newtask_queue, result_queue):
+    # follows without age and itag are ignored by scheduler within default age (30 days),
+    # so they can be filtered for a rotate period shorter than it.
+    BLOOM_FILTER_PERIOD = 7 * 24 * 60 * 60
+    BLOOM_FILTER_CAPACITY = 100000
+    BLOOM_FILTER_ERROR_RATE = 0.0001
+    BLOOM_FILTER_DUMP_INTERVAL = 60
+
+    def __init__(self, projectdb, inqueue, status_queue, newtask_queue, result_queue,
+                 bloom_filter=False, data_path='./data'):
         self.inqueue = inqueue
         self.status_queue = status_queue
         self.newtask_queue = newtask_queue
         self.result_queue = result_queue
         self.projectdb = projectdb
+        self.bloom_filter = bloom_filter
+        self.data_path = data_path
 
         self._quit = False
         self._exceptions = 10
         self.projects = {}
         self.last_check_projects = 0
+        self._bloom_filters = {}
+        self._last_dump_bloom_filters = time.time()
 
         self.enable_projects_import()
 
@@ -119,6 +135,86 @@ class Processor(object):
     def _update_project(self, project):
         self.projects[project['name']] = build_module(project, dict(
             result_queue=self.result_queue))
+        if self.bloom_filter:
+            self._check_bloom_filter(project)
+
+    def _bloom_filter_path(self, project):
+        return os.path.join(self.data_path, 'processor.bloom.%s' % project)
+
+    @staticmethod
+    def _bloom_filter_tag(project):
+        # follows of old script are not sent by new script, they are forgotten when
+        # script is changed or project is recreated
+        return utils.md5string(project.get('script') or '')
+
+    def _check_bloom_filter(self, project):
+        """
+        drop bloom filter of project marked to delete or of other script
+        """
+        name = project['name']
+        deleted = 'delete' in self.projectdb.split_group(project.get('group'))
+        if name in self._bloom_filters and not deleted and \
+                self._bloom_filters[name].tag == self._bloom_filter_tag(project):
+            return
+        self._bloom_filters.pop(name, None)
+        if deleted and os.path.exists(self._bloom_filter_path(name)):
+            os.remove(self._bloom_filter_path(name))
+
+    def _get_bloom_filter(self, project):
+        if project not in self._bloom_filters:
+            tag = self._bloom_filter_tag(self.projects[project]['info'])
+            bloom_filter = RotatingBloomFilter.load(self._bloom_filter_path(project))
+            if bloom_filter is None or getattr(bloom_filter, 'tag', None) != tag:
+                bloom_filter = RotatingBloomFilter(
+                    period=self.BLOOM_FILTER_PERIOD,
+                    initial_capacity=self.BLOOM_FILTER_CAPACITY,
+                    error_rate=self.BLOOM_FILTER_ERROR_RATE)
+                bloom_filter.tag = tag
+            self._bloom_filters[project] = bloom_filter
+        return self._bloom_filters[project]
+
+    def _dump_bloom_filters(self):
+        for project, bloom_filter in self._bloom_filters.iteritems():
+            bloom_filter.dump(self._bloom_filter_path(project))
+        self._last_dump_bloom_filters = time.time()
+
+    def _try_dump_bloom_filters(self):
+        if time.time() - self._last_dump_bloom_filters > self.BLOOM_FILTER_DUMP_INTERVAL:
+            self._dump_bloom_filters()
+
+    def _follow_filterable(self, task):
+        """
+        follows with age, itag or force_update are always sent. follows of a project
+        not running are dropped by scheduler, they are not marked as seen.
+        """
+        if not self.bloom_filter:
+            return False
+        if task['url'] == 'data:,on_get_info':
+            return False
+        project = self.projects.get(task['project'])
+        if not project or project['info'].get('status') not in ('RUNNING', 'DEBUG'):
+            return False
+        schedule = task.get('schedule', {})
+        for key in ('age', 'itag', 'force_update'):
+            if schedule.get(key) is not None:
+                return False
+        return True
+
+    def _follow_seen(self, task):
+        """
+        return True when a follow had been sent before, and the scheduler will ignore it.
+        """
+        if not self._follow_filterable(task):
+            return False
+        return task['taskid'] in self._get_bloom_filter(task['project'])
+
+    def _follow_sent(self, tasks):
+        """
+        follows are marked as seen only after they are sent to newtask_queue
+        """
+        for task in tasks:
+            if self._follow_filterable(task):
+                self._get_bloom_filter(task['project']).add(task['taskid'])
 
     def on_task(self, task, response):
         start_time = time.time()
@@ -148,6 +244,7 @@ class Processor(object):
                         'status_code': response.status_code,
                         'headers': dict(response.headers),
                         'encoding': response.encoding,
+                        'truncated': response.truncated,
                         'content': (
                             response.content[:500]
                             if not response.isok() or ret.exception else
@@ -161,6 +258,8 @@ class Processor(object):
                         'result': unicode(ret.result)[:self.RESULT_RESULT_LIMIT],
                         'logs': ret.logstr()[-self.RESULT_LOGS_LIMIT:],
                         'exception': ret.exception,
+                        'exception_type': (type(ret.exception).__name__
+                                           if ret.exception else None),
                     },
                 },
             }
@@ -169,10 +268,17 @@ class Processor(object):
             # it's used here for performance.
             self.status_queue.put(utils.unicode_obj(status_pack))
 
+        follows = []
         for newtask in ret.follows:
+            if self._follow_seen(newtask):
+                logger.debug('ignore seen follow %(project)s:%(taskid)s %(url)s', newtask)
+                continue
+            follows.append(newtask)
+        for i in range(0, len(follows), self.NEWTASK_BATCH_SIZE):
             # FIXME: unicode_obj should used in scheduler before store to database
             # it's used here for performance.
-            self.newtask_queue.put(utils.unicode_obj(newtask))
+            self.newtask_queue.put(utils.unicode_obj(follows[i:i + self.NEWTASK_BATCH_SIZE]))
+            self._follow_sent(follows[i:i + self.NEWTASK_BATCH_SIZE])
 
         for project, msg, url in ret.messages:
             self.inqueue.put(({
@@ -207,6 +313,8 @@ class Processor(object):
                 task, response = self.inqueue.get(timeout=1)
                 self._check_projects(task)
                 self.on_task(task, response)
+                if self.bloom_filter:
+                    self._try_dump_bloom_filters()
                 self._exceptions = 0
             except Queue.Empty as e:
                 continue
@@ -220,3 +328,5 @@ class Processor(object):
                 continue
 
         logger.info("processor exiting...")
+        if self.bloom_filter:
+            self._dump_bloom_filters()
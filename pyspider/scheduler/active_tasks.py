@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set et sw=4 ts=4 sts=4 ff=unix fenc=utf8:
+# Author: Binux<i@binux.me>
+#         http://binux.me
+# Created on 2014-12-16 16:20:43
+
+import copy
+import time
+from collections import deque
+
+
+class ActiveTasks(object):
+
+    '''
+    recent task events of all projects
+
+    events are kept as tuples of the fields shown in webui, copied when added, in
+    a ring buffer of size and a ring of project_size for each project. queries
+    walk a snapshot of the ring from the newest and stop after limit or at the
+    cursor, `since`, they could be run from rpc threads.
+    '''
+
+    fields = ('taskid', 'project', 'status', 'url', 'lastcrawltime', 'track')
+
+    def __init__(self, size=1000):
+        self.ring = deque(maxlen=size)
+        self.projects = dict()
+
+    def add_project(self, project, project_size=100):
+        if project in self.projects and self.projects[project].maxlen == project_size:
+            return
+        self.projects[project] = deque(self.projects.get(project, ()), maxlen=project_size)
+
+    def drop_project(self, project):
+        self.projects.pop(project, None)
+
+    def add(self, task, updatetime=None):
+        if task['project'] not in self.projects:
+            return
+        # track is changed by scheduler after added
+        record = (updatetime or time.time(), ) + tuple(
+            copy.deepcopy(task.get(x)) if x == 'track' else task.get(x) for x in self.fields)
+        self.ring.append(record)
+        self.projects[task['project']].append(record)
+
+    def _to_dict(self, record):
+        return record[0], dict((k, v) for k, v in zip(self.fields, record[1:])
+                               if v is not None)
+
+    def get(self, project=None, limit=100, since=None):
+        '''
+        [(updatetime, task), ...] newest first, only events after since if set
+        '''
+        if project:
+            records = self.projects.get(project, ())
+        else:
+            records = self.ring
+        result = []
+        # deques could be appended by main thread while walking
+        for record in reversed(list(records)):
+            if len(result) >= limit:
+                break
+            if since is not None and record[0] <= since:
+                break
+            # project deleted
+            if record[2] not in self.projects:
+                continue
+            result.append(self._to_dict(record))
+        return result
+
+    def __len__(self):
+        return len(self.ring)
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set et sw=4 ts=4 sts=4 ff=unix fenc=utf8:
+# Author: Binux<i@binux.me>
+#         http://binux.me
+# Created on 2014-12-17 11:08:52
+
+import copy
+import time
+import random
+
+# delay of n-th retry is first_delay when n == 0, else delay * factor ** (n - 1), capped
+# by max_delay. with a list of delays, n-th retry waits delays[n], retries after the
+# list wait the last one multiplied by factor each time. a class may also set retries
+# to retry less than task's retries, and jitter to override jitter of the policy.
+DEFAULT_POLICY = {
+    'no_retry': ['404', '410'],
+    'jitter': 0.1,
+    'classes': {
+        # 0, 1h, 24h, 48h, 96h... as before retry policies
+        'default': {'delays': [0, 60 * 60, 24 * 60 * 60], 'factor': 2, 'jitter': 0},
+        # timeout and connection errors are transient
+        '599': {'first_delay': 30, 'delay': 60, 'factor': 2, 'max_delay': 60 * 60},
+        '5xx': {'first_delay': 60, 'delay': 10 * 60, 'factor': 2,
+                'max_delay': 6 * 60 * 60},
+    },
+    'circuit_breaker': {'threshold': 10, 'cooldown': 5 * 60},
+}
+
+
+def error_classes(track):
+    '''
+    classes of error in track of status pack, most specific first: status code of
+    fetch like '404', family like '4xx', exception type of process like 'ValueError'
+    '''
+    result = []
+    fetch = track.get('fetch') or {}
+    process = track.get('process') or {}
+    if not fetch.get('ok', True):
+        status_code = fetch.get('status_code')
+        if status_code:
+            result.append(str(status_code))
+            result.append('%dxx' % (int(status_code) / 100))
+    elif not process.get('ok', True) and process.get('exception_type'):
+        result.append(process['exception_type'])
+    result.append('default')
+    return result
+
+
+class RetryPolicy(object):
+
+    '''
+    decide whether and when a failed task is retried by class of the error
+
+    config is merged into DEFAULT_POLICY, could be set by `retry_policy` in crawl_config
+    of project, e.g. {'no_retry': [403], 'classes': {'5xx': {'retries': 1}}}
+    '''
+
+    def __init__(self, config=None):
+        self.config = config
+        policy = copy.deepcopy(DEFAULT_POLICY)
+        config = config or {}
+        if 'no_retry' in config:
+            policy['no_retry'] = config['no_retry']
+        if 'jitter' in config:
+            policy['jitter'] = config['jitter']
+        for cls, value in (config.get('classes') or {}).iteritems():
+            cls = str(cls)
+            if cls in policy['classes'] and value is not None:
+                policy['classes'][cls].update(value)
+            else:
+                policy['classes'][cls] = value
+        policy['circuit_breaker'].update(config.get('circuit_breaker') or {})
+
+        self.no_retry = set(str(x) for x in policy['no_retry'])
+        self.jitter = policy['jitter']
+        self.classes = dict((k, v) for k, v in policy['classes'].iteritems() if v)
+        self.breaker_threshold = policy['circuit_breaker']['threshold']
+        self.breaker_cooldown = policy['circuit_breaker']['cooldown']
+
+    def classify(self, track):
+        for cls in error_classes(track):
+            if cls in self.no_retry or cls in self.classes:
+                return cls
+        return 'default'
+
+    def next_retry(self, track, retried, retries):
+        '''
+        return (error class, seconds before next retry), seconds is None when the
+        task should not be retried any more.
+        '''
+        cls = self.classify(track)
+        if cls in self.no_retry:
+            return cls, None
+        config = self.classes.get(cls, self.classes.get('default', {}))
+        if retried >= min(retries, config.get('retries', retries)):
+            return cls, None
+        delays = config.get('delays')
+        if delays:
+            if retried < len(delays):
+                delay = delays[retried]
+            else:
+                delay = delays[-1] * config.get('factor', 1) ** (retried - len(delays) + 1)
+        elif retried == 0:
+            delay = config.get('first_delay', 0)
+        else:
+            delay = config.get('delay', 0) * config.get('factor', 1) ** (retried - 1)
+        delay = min(delay, config.get('max_delay', delay))
+        jitter = config.get('jitter', self.jitter)
+        if jitter:
+            delay *= 1 + random.uniform(-jitter, jitter)
+        return cls, delay
+
+
+class CircuitBreaker(object):
+
+    '''
+    opened for cooldown seconds after threshold failures in a row
+    '''
+
+    def __init__(self, threshold=10, cooldown=5 * 60):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0
+        self.last_failure = 0
+
+    def failure(self):
+        '''
+        return True if breaker is opened by this failure
+        '''
+        self.failures += 1
+        self.last_failure = time.time()
+        if self.threshold and self.failures >= self.threshold:
+            self.failures = 0
+            self.open_until = time.time() + self.cooldown
+            return True
+        return False
+
+    def is_open(self):
+        return self.open_until > time.time()
+
+    def expired(self):
+        '''
+        closed and no failure in cooldown seconds, could be forgotten
+        '''
+        now = time.time()
+        return self.open_until <= now and self.last_failure + self.cooldown <= now
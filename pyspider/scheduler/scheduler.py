@@ -7,16 +7,76 @@
 
 
 import os
+import math
 import time
+import fcntl
+import heapq
+import types
+import cProfile
 import Queue
+import select
+import bisect
+import hashlib
 import logging
-from collections import deque
+import urlparse
+import binascii
+from collections import deque, OrderedDict
 
-from pyspider.libs import counter
+from pyspider.libs import counter, utils
+from pyspider.libs.shard import shard_of
 from task_queue import TaskQueue
+from active_tasks import ActiveTasks
+from retry_policy import RetryPolicy, CircuitBreaker
 logger = logging.getLogger('scheduler')
 
 
+def unpack_message(message):
+    '''
+    messages in status_queue and newtask_queue are a task or a list of tasks
+    '''
+    if isinstance(message, (list, tuple)):
+        return message
+    return (message, )
+
+
+class _TimedProxy(object):
+
+    '''
+    time every method call of obj into latency[method], iterations of returned
+    generators are counted into the call
+    '''
+
+    def __init__(self, obj, latency):
+        self._obj = obj
+        self._latency = latency
+
+    def _iter_timed(self, name, generator, cost):
+        try:
+            while True:
+                start = time.time()
+                try:
+                    item = next(generator)
+                finally:
+                    cost += time.time() - start
+                yield item
+        finally:
+            self._latency.event(name, cost)
+
+    def __getattr__(self, name):
+        attr = getattr(self._obj, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            ret = attr(*args, **kwargs)
+            if isinstance(ret, types.GeneratorType):
+                return self._iter_timed(name, ret, time.time() - start)
+            self._latency.event(name, time.time() - start)
+            return ret
+        return wrapper
+
+
 class Scheduler(object):
     UPDATE_PROJECT_INTERVAL = 5 * 60
     default_schedule = {
@@ -29,28 +89,84 @@ class Scheduler(object):
     LOOP_LIMIT = 1000
     LOOP_INTERVAL = 0.1
     ACTIVE_TASKS = 100
+    ACTIVE_TASKS_BUFFER = 1000
     INQUEUE_LIMIT = 0
+    INMEMORY_LIMIT = 0
+    # known_tasks index takes about 150 bytes of memory for each task, index of a
+    # project with more tasks than the limit is dropped and newtasks are checked
+    # with taskdb. 0 to disable the index.
+    KNOWN_TASKS_LIMIT = 1000000
     EXCEPTION_LIMIT = 3
     DELETE_TIME = 24 * 60 * 60
+    FLUSH_INTERVAL = 1
+    WRITE_BUFFER_LIMIT = 5000
+    # a task failed to be written this many times while other writes succeeded is
+    # dropped from write buffer
+    WRITE_RETRY_LIMIT = 3
+    LOAD_PAGE_SIZE = 1000
+    DISPATCH_QUANTUM = LOOP_LIMIT / 10
+    LOAD_QUEUE_SIZE = 100
+    # failed loading is retried after 10s, doubled every failure up to 10min
+    LOAD_RETRY_INTERVAL = 10
+    LOAD_RETRY_MAX_INTERVAL = 10 * 60
+    SNAPSHOT_INTERVAL = 5 * 60
+    INGEST_QUEUE_SIZE = 100
+    PROFILE_MAX_TIME = 5 * 60
+    # circuit breakers of failing hosts, least recently failed one is dropped when
+    # over the limit, expired ones are swept every minute
+    BREAKERS_LIMIT = 10000
 
     def __init__(self, taskdb, projectdb, newtask_queue, status_queue,
-                 out_queue, data_path='./data', resultdb=None):
-        self.taskdb = taskdb
+                 out_queue, data_path='./data', resultdb=None, shard=0, shards=1):
+        # latency of taskdb calls by method
+        self._db_latency = counter.CounterManager(counter.HistogramCounter)
+        self.taskdb = _TimedProxy(taskdb, self._db_latency) if taskdb else taskdb
         self.projectdb = projectdb
         self.resultdb = resultdb
         self.newtask_queue = newtask_queue
         self.status_queue = status_queue
         self.out_queue = out_queue
         self.data_path = data_path
+        self.shard = shard
+        self.shards = shards
 
         self._send_buffer = deque()
+        # batches of tasks from newtasks rpc
+        self._ingest_queue = Queue.Queue(maxsize=self.INGEST_QUEUE_SIZE)
+        self._write_buffer = dict()
+        # (project, taskid): failed writes of a buffered task
+        self._write_failures = dict()
+        self._write_failed = False
+        self._last_flush = time.time()
         self._quit = False
         self._exceptions = 0
         self.projects = dict()
+        self.active_tasks = ActiveTasks(self.ACTIVE_TASKS_BUFFER)
         self._force_update_project = False
         self._last_update_project = 0
         self.task_queue = dict()
-        self._last_tick = int(time.time())
+        self.known_tasks = dict()
+        self._loading = dict()
+        self._dispatch_next = None
+        self._dispatch_stats = dict()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        for fd in (self._wakeup_r, self._wakeup_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        # project: (min_tick, next_tick, last_tick), and heap of (next_tick, project)
+        self._cron_jobs = dict()
+        self._cron_heap = []
+        self._last_snapshot = time.time()
+        # wall time and items of each phase of main loop
+        self._phase_time = counter.CounterManager(lambda: counter.AverageWindowCounter(100))
+        self._phase_items = counter.CounterManager(lambda: counter.AverageWindowCounter(100))
+        self._phase_calls = counter.CounterManager(counter.TotalCounter)
+        self._profiler = None
+        self._profile_until = 0
+        self._profile_path = None
+        # project: RetryPolicy, (project, host): CircuitBreaker
+        self._retry_policies = dict()
+        self._breakers = OrderedDict()
+        self._last_check_breakers = 0
 
         self._cnt = {
             "5m": counter.CounterManager(
@@ -62,11 +178,28 @@ class Scheduler(object):
             "all": counter.CounterManager(
                 lambda: counter.TotalCounter()),
         }
-        self._cnt['1h'].load(os.path.join(self.data_path, 'scheduler.1h'))
-        self._cnt['1d'].load(os.path.join(self.data_path, 'scheduler.1d'))
-        self._cnt['all'].load(os.path.join(self.data_path, 'scheduler.all'))
+        self._cnt['1h'].load(self._counter_path('1h'))
+        self._cnt['1d'].load(self._counter_path('1d'))
+        self._cnt['all'].load(self._counter_path('all'))
+        if self.shards > 1:
+            # projects moved to other shards
+            for cnt in self._cnt.itervalues():
+                for project in cnt.keys():
+                    if not self.own_project(project):
+                        del cnt[project]
         self._last_dump_cnt = 0
 
+    def _counter_path(self, name):
+        if self.shards > 1:
+            return os.path.join(self.data_path, 'scheduler.%d.%s' % (self.shard, name))
+        return os.path.join(self.data_path, 'scheduler.%s' % name)
+
+    def own_project(self, project):
+        """
+        if project is in the slice of this shard
+        """
+        return shard_of(project, self.shards) == self.shard
+
     def _load_projects(self):
         self.projects = dict()
         for project in self.projectdb.get_all():
@@ -88,11 +221,13 @@ class Scheduler(object):
         self._last_update_project = now
 
     def _update_project(self, project):
+        if self.shards > 1 and not self.own_project(project['name']):
+            return
         if project['name'] not in self.projects:
             self.projects[project['name']] = {}
         self.projects[project['name']].update(project)
-        if not self.projects[project['name']].get('active_tasks', None):
-            self.projects[project['name']]['active_tasks'] = deque(maxlen=self.ACTIVE_TASKS)
+        self.active_tasks.add_project(project['name'], self.ACTIVE_TASKS)
+        self._update_cronjob(project['name'])
 
         # load task queue when project is running and delete task_queue when project is stoped
         if project['status'] in ('RUNNING', 'DEBUG'):
@@ -109,7 +244,7 @@ class Scheduler(object):
                 'url': 'data:,_on_get_info',
                 'status': self.taskdb.ACTIVE,
                 'fetch': {
-                    'save': ['min_tick', ],
+                    'save': ['min_tick', 'retry_policy'],
                 },
                 'process': {
                     'callback': '_on_get_info',
@@ -117,26 +252,45 @@ class Scheduler(object):
                 'project_updatetime': self.projects[project['name']].get('updatetime', 0),
             })
         else:
-            if project['name'] in self.task_queue:
-                self.task_queue[project['name']].rate = 0
-                self.task_queue[project['name']].burst = 0
-                del self.task_queue[project['name']]
+            self._drop_task_queue(project['name'])
 
-    scheduler_task_fields = ['taskid', 'project', 'schedule', ]
+    def _drop_task_queue(self, project):
+        if project in self.task_queue:
+            self.task_queue[project].rate = 0
+            self.task_queue[project].burst = 0
+            self.task_queue[project].close()
+            del self.task_queue[project]
+        self.known_tasks.pop(project, None)
+        self._dispatch_stats.pop(project, None)
+        if project in self._loading:
+            self._loading.pop(project)['stop'] = True
+        for path in self._snapshot_path(project):
+            if os.path.exists(path):
+                os.remove(path)
+
+    scheduler_task_fields = ['taskid', 'project', 'url', 'schedule', 'lastcrawltime', ]
+    index_task_fields = ['taskid', 'lastcrawltime', ]
 
     def _load_tasks(self, project):
         """
-        loading tasks from database
+        start loading tasks from database in a loader thread, tasks are put into
+        task queue page by page in _check_loading, project can dispatch tasks
+        before loading finished.
+
+        when task queue is restored from snapshot, active tasks are still read from
+        database, those missing from a stale snapshot are put into task queue.
         """
-        self.task_queue[project] = TaskQueue(rate=0, burst=0)
-        for task in self.taskdb.load_tasks(
-                self.taskdb.ACTIVE, project, self.scheduler_task_fields
-        ):
-            taskid = task['taskid']
-            _schedule = task.get('schedule', self.default_schedule)
-            priority = _schedule.get('priority', self.default_schedule['priority'])
-            exetime = _schedule.get('exetime', self.default_schedule['exetime'])
-            self.task_queue[project].put(taskid, priority, exetime)
+        self.task_queue[project] = TaskQueue(
+            rate=0, burst=0, memory_limit=self.INMEMORY_LIMIT,
+            spill_path=os.path.join(self.data_path, 'task_queue.%s.db' % project))
+        self._dispatch_stats[project] = {
+            'weight': self._project_weight(project),
+            'deficit': 0,
+            'rounds': 0,
+            'skipped': 0,
+            'dispatched': 0,
+            'last_dispatch': 0,
+        }
 
         if self.projects[project]['status'] in ('RUNNING', 'DEBUG'):
             self.task_queue[project].rate = self.projects[project]['rate']
@@ -145,8 +299,20 @@ class Scheduler(object):
             self.task_queue[project].rate = 0
             self.task_queue[project].burst = 0
 
+        restored = False
+        if self.SNAPSHOT_INTERVAL:
+            snapshot_path, journal_path = self._snapshot_path(project)
+            restored = self.task_queue[project].restore(snapshot_path, journal_path)
+            if restored:
+                logger.info("project: %s restored %d tasks from snapshot",
+                            project, len(self.task_queue[project]))
+            else:
+                for path in (snapshot_path, journal_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+
+        status_count = self.taskdb.status_count(project)
         if project not in self._cnt['all']:
-            status_count = self.taskdb.status_count(project)
             self._cnt['all'].value(
                 (project, 'success'),
                 status_count.get(self.taskdb.SUCCESS, 0)
@@ -155,7 +321,162 @@ class Scheduler(object):
                 (project, 'failed'),
                 status_count.get(self.taskdb.FAILED, 0) + status_count.get(self.taskdb.BAD, 0)
             )
-        self._cnt['all'].value((project, 'pending'), len(self.task_queue[project]))
+
+        # known_tasks index is not available until loading finished, changes
+        # made before that are kept in updates and applied to the index.
+        self.known_tasks.pop(project, None)
+        loading = {
+            'queue': Queue.Queue(maxsize=self.LOAD_QUEUE_SIZE),
+            'stop': False,
+            'start_time': time.time(),
+            'total': status_count.get(self.taskdb.ACTIVE, 0),
+            'loaded': len(self.task_queue[project]) if restored else 0,
+            'indexed': 0,
+            'updates': dict(),
+            'restored': restored,
+            # active tasks not in restored task queue
+            'missing': 0,
+            'attempts': 0,
+            'retry_at': 0,
+        }
+        self._loading[project] = loading
+        utils.run_in_thread(self._task_loader, project, loading)
+
+    def _task_loader(self, project, loading):
+        """
+        loader thread, read tasks with its own taskdb connection and send them
+        to main loop in pages.
+        """
+        def put(item):
+            while not loading['stop']:
+                try:
+                    loading['queue'].put(item, timeout=1)
+                    self.wakeup()
+                    return True
+                except Queue.Full:
+                    continue
+            return False
+
+        try:
+            taskdb = self.taskdb.copy()
+            known_tasks = dict() if self.KNOWN_TASKS_LIMIT else None
+            page = []
+            for task in taskdb.load_tasks(taskdb.ACTIVE, project, self.scheduler_task_fields):
+                if known_tasks is not None:
+                    known_tasks[self._task_digest(task['taskid'])] = (
+                        taskdb.ACTIVE, task.get('lastcrawltime'))
+                    if len(known_tasks) > self.KNOWN_TASKS_LIMIT:
+                        known_tasks = None
+                page.append(task)
+                if len(page) >= self.LOAD_PAGE_SIZE:
+                    if not put(('tasks', page)):
+                        return
+                    page = []
+            if page and not put(('tasks', page)):
+                return
+            for status in (taskdb.SUCCESS, taskdb.FAILED, taskdb.BAD):
+                if known_tasks is None:
+                    break
+                for task in taskdb.load_tasks(status, project, self.index_task_fields):
+                    known_tasks[self._task_digest(task['taskid'])] = (status,
+                                                                      task.get('lastcrawltime'))
+                    loading['indexed'] += 1
+                    if loading['stop']:
+                        return
+                    if len(known_tasks) > self.KNOWN_TASKS_LIMIT:
+                        known_tasks = None
+                        break
+            put(('done', known_tasks))
+        except Exception as e:
+            logger.exception(e)
+            put(('error', None))
+
+    def _check_loading(self):
+        """
+        put tasks loaded by loader threads into task queue
+        """
+        cnt = 0
+        for project, loading in self._loading.items():
+            if loading['retry_at']:
+                if loading['retry_at'] > time.time():
+                    continue
+                logger.info("project: %s retry loading", project)
+                loading['retry_at'] = 0
+                loading['indexed'] = 0
+                loading['queue'] = Queue.Queue(maxsize=self.LOAD_QUEUE_SIZE)
+                utils.run_in_thread(self._task_loader, project, loading)
+                continue
+            while cnt < self.LOOP_LIMIT * 10:
+                try:
+                    _type, data = loading['queue'].get_nowait()
+                except Queue.Empty:
+                    break
+
+                if _type == 'tasks':
+                    task_queue = self.task_queue[project]
+                    for task in data:
+                        taskid = task['taskid']
+                        # changed by scheduler after it was read
+                        if self._task_digest(taskid) in loading['updates']:
+                            continue
+                        # tasks in queue are restored or put by failed loading
+                        if loading['restored'] or loading['attempts']:
+                            if taskid in task_queue:
+                                continue
+                            loading['loaded'] += 1
+                            if loading['restored']:
+                                loading['missing'] += 1
+                        _schedule = task.get('schedule', self.default_schedule)
+                        priority = _schedule.get('priority', self.default_schedule['priority'])
+                        exetime = _schedule.get('exetime', self.default_schedule['exetime'])
+                        task_queue.put(taskid, priority, exetime, host=self._task_host(task))
+                    if not (loading['restored'] or loading['attempts']):
+                        loading['loaded'] += len(data)
+                    cnt += len(data)
+                    continue
+
+                if _type == 'error':
+                    # tasks put are kept in queue and changes are still kept in updates
+                    loading['attempts'] += 1
+                    delay = min(self.LOAD_RETRY_INTERVAL * 2 ** (loading['attempts'] - 1),
+                                self.LOAD_RETRY_MAX_INTERVAL)
+                    loading['retry_at'] = time.time() + delay
+                    logger.error("project: %s loading failed, retry in %ds", project, delay)
+                    break
+
+                del self._loading[project]
+                if _type == 'done':
+                    if data is not None:
+                        data.update(loading['updates'])
+                    if data is not None and len(data) <= self.KNOWN_TASKS_LIMIT:
+                        self.known_tasks[project] = data
+                    elif self.KNOWN_TASKS_LIMIT:
+                        logger.info("project: %s has more than %d tasks, known_tasks index "
+                                    "disabled", project, self.KNOWN_TASKS_LIMIT)
+                    logger.info("project: %s loaded %d tasks in %.2fs", project,
+                                loading['loaded'], time.time() - loading['start_time'])
+                    if loading['missing']:
+                        logger.warning("project: %s %d active tasks missing from snapshot "
+                                       "are loaded", project, loading['missing'])
+                    if not loading['restored']:
+                        self._snapshot(project)
+                self._cnt['all'].value((project, 'pending'), len(self.task_queue[project]))
+                break
+        return cnt
+
+    def loading_progress(self):
+        """
+        progress of projects loading tasks
+        """
+        result = dict()
+        for project, loading in self._loading.iteritems():
+            result[project] = {
+                'total': loading['total'],
+                'loaded': loading['loaded'],
+                'indexed': loading['indexed'],
+                'time': time.time() - loading['start_time'],
+            }
+        return result
 
     def task_verify(self, task):
         for each in ('taskid', 'project', 'url', ):
@@ -167,18 +488,213 @@ class Scheduler(object):
             return False
         return True
 
+    @staticmethod
+    def _task_digest(taskid):
+        """
+        16 bytes key of taskid for known_tasks index, taskid generated by md5string
+        is unhexlified, others are hashed.
+        """
+        if len(taskid) == 32:
+            try:
+                digest = binascii.unhexlify(taskid)
+                if binascii.hexlify(digest) == taskid:
+                    return digest
+            except TypeError:
+                pass
+        if isinstance(taskid, unicode):
+            taskid = taskid.encode('utf8')
+        return hashlib.md5(taskid).digest()
+
+    def _update_known_task(self, task):
+        known_tasks = self.known_tasks.get(task['project'])
+        if known_tasks is None:
+            if task['project'] in self._loading:
+                known_tasks = self._loading[task['project']]['updates']
+            else:
+                return
+        key = self._task_digest(task['taskid'])
+        status, lastcrawltime = known_tasks.get(key, (None, None))
+        known_tasks[key] = (task.get('status', status), task.get('lastcrawltime', lastcrawltime))
+        if len(known_tasks) > self.KNOWN_TASKS_LIMIT and task['project'] in self.known_tasks:
+            logger.info("project: %s has more than %d tasks, known_tasks index disabled",
+                        task['project'], self.KNOWN_TASKS_LIMIT)
+            del self.known_tasks[task['project']]
+
+    def _need_check_old_task(self, task, known):
+        """
+        check with status and lastcrawltime in known_tasks index, return False when
+        task can be ignored without loading it from taskdb.
+        """
+        _schedule = task.get('schedule', self.default_schedule)
+        if _schedule.get('itag') or _schedule.get('force_update'):
+            return True
+        lastcrawltime = known[1]
+        schedule_age = _schedule.get('age', self.default_schedule['age'])
+        return schedule_age + (lastcrawltime or 0) < time.time()
+
     def insert_task(self, task):
-        return self.taskdb.insert(task['project'], task['taskid'], task)
+        self._update_known_task(task)
+        self._write_buffer[(task['project'], task['taskid'])] = ('insert', dict(task))
+        if len(self._write_buffer) >= self.WRITE_BUFFER_LIMIT and not self._write_failed:
+            self._flush_tasks()
 
     def update_task(self, task):
-        return self.taskdb.update(task['project'], task['taskid'], task)
+        self._update_known_task(task)
+        key = (task['project'], task['taskid'])
+        if key in self._write_buffer:
+            self._write_buffer[key][1].update(task)
+        else:
+            self._write_buffer[key] = ('update', dict(task))
+        if len(self._write_buffer) >= self.WRITE_BUFFER_LIMIT and not self._write_failed:
+            self._flush_tasks()
+
+    def _write_blocked(self):
+        """
+        write buffer is full and taskdb is failing, stop reading newtask_queue and
+        status_queue until a flush succeeds.
+        """
+        return self._write_failed and len(self._write_buffer) >= self.WRITE_BUFFER_LIMIT
+
+    def _write_tasks(self, op, project, tasks):
+        if op == 'insert':
+            self.taskdb.insert_many(project, tasks)
+        else:
+            self.taskdb.update_many(project, tasks)
+
+    def _flush_tasks(self):
+        """
+        write buffered inserts and updates to taskdb, in bulk for each project
+        """
+        self._last_flush = time.time()
+        if not self._write_buffer:
+            self._write_failed = False
+            return
+        groups = dict()
+        for key, entry in self._write_buffer.iteritems():
+            groups.setdefault((entry[0], key[0]), []).append((key, entry))
+
+        # entries are removed only after they are written. when a bulk write fails,
+        # tasks are written one by one to find out the rejected ones, those are kept
+        # in buffer and retried in next flush.
+        written = 0
+        failed = []
+        for (op, project), entries in sorted(groups.iteritems()):
+            try:
+                self._write_tasks(op, project, [entry[1] for key, entry in entries])
+                done = entries
+            except Exception as e:
+                logger.error('flush %d %ss of %s failed: %r', len(entries), op, project, e)
+                done = []
+                for key, entry in entries:
+                    if len(entries) > 1:
+                        try:
+                            self._write_tasks(op, project, [entry[1], ])
+                            done.append((key, entry))
+                            continue
+                        except Exception as e:
+                            logger.debug('%s %s:%s failed: %r', op, project, key[1], e)
+                    failed.append((key, entry, e))
+            written += len(done)
+            for key, entry in done:
+                self._write_failures.pop(key, None)
+                # not replaced by a newer write
+                if self._write_buffer.get(key) is entry:
+                    del self._write_buffer[key]
+
+        # when nothing can be written, taskdb is failing rather than the tasks
+        self._write_failed = bool(failed)
+        if not written:
+            return
+        for key, entry, e in failed:
+            self._write_failures[key] = self._write_failures.get(key, 0) + 1
+            if self._write_failures[key] >= self.WRITE_RETRY_LIMIT:
+                logger.error('drop %s of %s:%s after %d failures: %r', entry[0], key[0],
+                             key[1], self._write_failures[key], e)
+                del self._write_failures[key]
+                if self._write_buffer.get(key) is entry:
+                    del self._write_buffer[key]
+
+    def _try_flush_tasks(self):
+        if time.time() - self._last_flush >= self.FLUSH_INTERVAL:
+            self._flush_tasks()
+
+    json_task_fields = ('schedule', 'fetch', 'process', 'track')
+
+    def _merge_pending(self, project, taskid, task, fields=None):
+        """
+        apply buffered, not yet flushed writes to a task loaded from taskdb
+        """
+        op, pending = self._write_buffer[(project, taskid)]
+        if op == 'insert':
+            task = dict()
+            for key in fields or pending.iterkeys():
+                value = pending.get(key)
+                if value is None and key in self.json_task_fields:
+                    value = {}
+                task[key] = value
+        else:
+            for key, value in pending.iteritems():
+                if fields is None or key in fields:
+                    task[key] = value
+        return task
+
+    def get_task(self, project, taskid, fields=None):
+        """
+        get task from taskdb, with writes still in buffer merged
+        """
+        key = (project, taskid)
+        if key in self._write_buffer and self._write_buffer[key][0] == 'insert':
+            return self._merge_pending(project, taskid, None, fields)
+        task = self.taskdb.get_task(project, taskid, fields=fields)
+        if task and key in self._write_buffer:
+            task = self._merge_pending(project, taskid, task, fields)
+        return task
+
+    def get_tasks(self, project, taskids, fields=None):
+        """
+        get tasks from taskdb in one query, with writes still in buffer merged
+        """
+        result = dict()
+        query = []
+        for taskid in taskids:
+            pending = self._write_buffer.get((project, taskid))
+            if pending and pending[0] == 'insert':
+                result[taskid] = self._merge_pending(project, taskid, None, fields)
+            else:
+                query.append(taskid)
+        if query:
+            for task in self.taskdb.get_tasks(project, query, fields=fields):
+                taskid = task['taskid']
+                if (project, taskid) in self._write_buffer:
+                    task = self._merge_pending(project, taskid, task, fields)
+                result[taskid] = task
+        return result
+
+    def _task_host(self, task):
+        """
+        netloc of task url if host_rate or host_concurrency is set in schedule, the
+        limits are updated to task queue of project.
+        """
+        _schedule = task.get('schedule') or {}
+        host_rate = _schedule.get('host_rate')
+        host_concurrency = _schedule.get('host_concurrency')
+        if not host_rate and not host_concurrency:
+            return None
+        host = urlparse.urlsplit(task.get('url') or '').netloc.lower()
+        if not host:
+            return None
+        self.task_queue[task['project']].update_host(
+            host, rate=host_rate or 0, burst=_schedule.get('host_burst'),
+            concurrency=host_concurrency or 0)
+        return host
 
     def put_task(self, task):
         _schedule = task.get('schedule', self.default_schedule)
         self.task_queue[task['project']].put(
             task['taskid'],
             priority=_schedule.get('priority', self.default_schedule['priority']),
-            exetime=_schedule.get('exetime', self.default_schedule['exetime'])
+            exetime=_schedule.get('exetime', self.default_schedule['exetime']),
+            host=self._task_host(task),
         )
 
     def send_task(self, task, force=True):
@@ -191,15 +707,17 @@ class Scheduler(object):
                 raise
 
     def _check_task_done(self):
+        if self._write_blocked():
+            return 0
         cnt = 0
         try:
             while cnt < self.LOOP_LIMIT:
-                task = self.status_queue.get_nowait()
-                if not self.task_verify(task):
-                    continue
-                self.task_queue[task['project']].done(task['taskid'])
-                task = self.on_task_status(task)
-                cnt += 1
+                for task in unpack_message(self.status_queue.get_nowait()):
+                    cnt += 1
+                    if not self.task_verify(task):
+                        continue
+                    self.task_queue[task['project']].done(task['taskid'])
+                    task = self.on_task_status(task)
         except Queue.Empty:
             pass
         return cnt
@@ -207,81 +725,144 @@ class Scheduler(object):
     merge_task_fields = ['taskid', 'project', 'url', 'status', 'schedule', 'lastcrawltime']
 
     def _check_request(self):
-        cnt = 0
+        if self._write_blocked():
+            return 0
+        tasks = []
         try:
-            processed_task_cache = set()
-            while cnt < self.LOOP_LIMIT:
-                task = self.newtask_queue.get_nowait()
-                if not self.task_verify(task):
-                    continue
+            while len(tasks) < self.LOOP_LIMIT:
+                tasks.extend(unpack_message(self.newtask_queue.get_nowait()))
+        except Queue.Empty:
+            pass
+        try:
+            while len(tasks) < self.LOOP_LIMIT * 10:
+                tasks.extend(self._ingest_queue.get_nowait())
+        except Queue.Empty:
+            pass
+        if tasks:
+            self._on_new_tasks(tasks)
+        return len(tasks)
 
-                # check _on_get_info result here
-                if task['url'] == 'data:,on_get_info':
-                    self.projects[task['project']].update(task['fetch'].get('save', {}))
-                    logger.info(
-                        '%s on_get_info %r', task['project'], task['fetch'].get('save', {})
-                    )
-                    continue
+    def _on_new_tasks(self, tasks):
+        """
+        insert or update a batch of new tasks, tasks need to be merged with old ones
+        are fetched with one query per project.
+        """
+        processed_task_cache = set()
+        check_tasks = dict()
+        for task in tasks:
+            if not self.task_verify(task):
+                continue
+
+            # check _on_get_info result here
+            if task['url'] == 'data:,on_get_info':
+                self.projects[task['project']].update(task['fetch'].get('save', {}))
+                self._update_cronjob(task['project'])
+                logger.info(
+                    '%s on_get_info %r', task['project'], task['fetch'].get('save', {})
+                )
+                continue
 
-                if (
-                        self.INQUEUE_LIMIT
-                        and len(self.task_queue[task['project']]) >= self.INQUEUE_LIMIT
-                ):
-                    logger.debug('overflow task %(project)s:%(taskid)s %(url)s', task)
+            if (
+                    self.INQUEUE_LIMIT
+                    and len(self.task_queue[task['project']]) >= self.INQUEUE_LIMIT
+            ):
+                logger.debug('overflow task %(project)s:%(taskid)s %(url)s', task)
+                continue
+            if task['taskid'] in self.task_queue[task['project']]:
+                if not task.get('schedule', {}).get('force_update', False):
+                    logger.debug('ignore newtask %(project)s:%(taskid)s %(url)s', task)
                     continue
-                if task['taskid'] in self.task_queue[task['project']]:
-                    if not task.get('schedule', {}).get('force_update', False):
-                        logger.debug('ignore newtask %(project)s:%(taskid)s %(url)s', task)
-                        continue
-                cache_key = "%(project)s:%(taskid)s" % task
-                if cache_key in processed_task_cache:
-                    logger.debug('processed newtask %(project)s:%(taskid)s %(url)s', task)
+            cache_key = "%(project)s:%(taskid)s" % task
+            if cache_key in processed_task_cache:
+                logger.debug('processed newtask %(project)s:%(taskid)s %(url)s', task)
+                continue
+            processed_task_cache.add(cache_key)
+
+            # tasks not in known_tasks index are never seen, insert them directly.
+            known_tasks = self.known_tasks.get(task['project'])
+            if known_tasks is not None:
+                known = known_tasks.get(self._task_digest(task['taskid']))
+                if known is None:
+                    self.on_new_request(task)
+                    continue
+                if not self._need_check_old_task(task, known):
+                    logger.debug('ignore newtask %(project)s:%(taskid)s %(url)s', task)
                     continue
+            check_tasks.setdefault(task['project'], []).append(task)
 
-                oldtask = self.taskdb.get_task(task['project'], task['taskid'],
-                                               fields=self.merge_task_fields)
+        for project, _tasks in check_tasks.iteritems():
+            oldtasks = self.get_tasks(project, [x['taskid'] for x in _tasks],
+                                      fields=self.merge_task_fields)
+            for task in _tasks:
+                oldtask = oldtasks.get(task['taskid'])
                 if oldtask:
-                    task = self.on_old_request(task, oldtask)
+                    self.on_old_request(task, oldtask)
                 else:
-                    task = self.on_new_request(task)
-                processed_task_cache.add(cache_key)
-                cnt += 1
-        except Queue.Empty:
-            pass
-        return cnt
+                    self.on_new_request(task)
+
+    def newtasks(self, tasks):
+        """
+        put a batch of tasks from other threads, blocks when INGEST_QUEUE_SIZE batches
+        are waiting. return number of tasks accepted.
+        """
+        tasks = [x for x in tasks if self.task_verify(x)]
+        if tasks:
+            self._ingest_queue.put(tasks)
+            self.wakeup()
+        return len(tasks)
+
+    def _update_cronjob(self, project):
+        """
+        schedule next tick of project after min_tick or status changed
+        """
+        info = self.projects.get(project)
+        min_tick = info.get('min_tick', 0) if info else 0
+        if not min_tick or info['status'] not in ('DEBUG', 'RUNNING'):
+            self._cron_jobs.pop(project, None)
+            return
+        if project in self._cron_jobs and self._cron_jobs[project][0] == min_tick:
+            return
+        # ticks are multiples of min_tick
+        next_tick = (math.floor(time.time() / min_tick) + 1) * min_tick
+        self._cron_jobs[project] = (min_tick, next_tick, None)
+        heapq.heappush(self._cron_heap, (next_tick, project))
 
     def _check_cronjob(self):
         """
-        check projects cronjob tick, return True when a new tick is sended
+        send a tick to projects which are due, ticks missed in a stall are coalesced
+        into one covers (last_tick, tick]. return number of ticks sended.
         """
         now = time.time()
-        self._last_tick = int(self._last_tick)
-        if now - self._last_tick < 1:
-            return False
-        self._last_tick += 1
-        for project in self.projects.itervalues():
-            if project['status'] not in ('DEBUG', 'RUNNING'):
-                continue
-            if project.get('min_tick', 0) == 0:
-                continue
-            if self._last_tick % int(project['min_tick']) != 0:
+        cnt = 0
+        while self._cron_heap and self._cron_heap[0][0] <= now:
+            next_tick, project = heapq.heappop(self._cron_heap)
+            job = self._cron_jobs.get(project)
+            if job is None or job[1] != next_tick:
                 continue
+            min_tick, _, last_tick = job
+            tick = math.floor(now / min_tick) * min_tick
+            self._cron_jobs[project] = (min_tick, tick + min_tick, tick)
+            heapq.heappush(self._cron_heap, (tick + min_tick, project))
+
+            save = {'tick': int(tick) if tick == int(tick) else round(tick, 6)}
+            if last_tick is not None:
+                save['last_tick'] = int(last_tick) if last_tick == int(last_tick) \
+                    else round(last_tick, 6)
             self.send_task({
                 'taskid': '_on_cronjob',
-                'project': project['name'],
+                'project': project,
                 'url': 'data:,_on_cronjob',
                 'status': self.taskdb.ACTIVE,
                 'fetch': {
-                    'save': {
-                        'tick': self._last_tick,
-                    },
+                    'save': save,
                 },
                 'process': {
                     'callback': '_on_cronjob',
                 },
-                'project_updatetime': self.projects[project['name']].get('updatetime', 0),
+                'project_updatetime': self.projects[project].get('updatetime', 0),
             })
-        return True
+            cnt += 1
+        return cnt
 
     request_task_fields = [
         'taskid',
@@ -303,30 +884,82 @@ class Scheduler(object):
                 self._send_buffer.append(_task)
                 break
 
-        cnt_dict = dict()
-        for project, task_queue in self.task_queue.iteritems():
-            # task queue
-            self.task_queue[project].check_update()
-            cnt = 0
-            while cnt < self.LOOP_LIMIT / 10 and not self._send_buffer:
-                taskid = task_queue.get()
-                if not taskid:
-                    break
-                task = self.taskdb.get_task(project, taskid, fields=self.request_task_fields)
-                if not task:
-                    continue
+        for task_queue in self.task_queue.itervalues():
+            task_queue.check_update()
 
-                # inform processor project may updated
-                task['project_updatetime'] = self.projects[project].get('updatetime', 0)
-                task = self.on_select_task(task)
-                cnt += 1
-            cnt_dict[project] = cnt
+        # deficit round robin, every project gets a quantum of DISPATCH_QUANTUM scaled
+        # by its weight each round. when out_queue is full, next round starts from
+        # the first project not served.
+        cnt_dict = dict()
+        projects = sorted(self.task_queue)
+        start = bisect.bisect_left(projects, self._dispatch_next or '')
+        projects = projects[start:] + projects[:start]
+        max_weight = max([self._project_weight(x) for x in projects] or [1])
+        self._dispatch_next = None
+        for i, project in enumerate(projects):
+            if self._send_buffer:
+                self._dispatch_next = project
+                for each in projects[i:]:
+                    self._dispatch_stats[each]['skipped'] += 1
+                break
+            quantum = self.DISPATCH_QUANTUM * self._project_weight(project) / max_weight
+            cnt_dict[project] = self._dispatch_project(project, quantum)
         return cnt_dict
 
+    def _project_weight(self, project):
+        weight = self.projects.get(project, {}).get('weight')
+        if not weight or weight <= 0:
+            return 1.0
+        return float(weight)
+
+    def _dispatch_project(self, project, quantum):
+        """
+        select tasks of project within its deficit, return number of tasks sended
+        """
+        task_queue = self.task_queue[project]
+        stats = self._dispatch_stats[project]
+        deficit = stats['deficit'] + quantum
+        taskids = task_queue.get_many(int(deficit))
+        if len(taskids) < int(deficit):
+            # queue is empty or out of tokens, unused deficit is not saved
+            deficit = 0
+        else:
+            deficit -= len(taskids)
+        stats['deficit'] = deficit
+        stats['weight'] = self._project_weight(project)
+        stats['rounds'] += 1
+
+        # hydrate the whole batch with one query, keep the order of task queue
+        cnt = 0
+        tasks = self.get_tasks(project, taskids, fields=self.request_task_fields)
+        for taskid in taskids:
+            task = tasks.get(taskid)
+            if not task:
+                # restored from snapshot or journal but never written to taskdb, or
+                # deleted. done, or it comes back after every processing timeout
+                logger.warning('task not found in taskdb %s:%s, dropped', project, taskid)
+                task_queue.done(taskid)
+                continue
+
+            # inform processor project may updated
+            task['project_updatetime'] = self.projects[project].get('updatetime', 0)
+            task = self.on_select_task(task)
+            cnt += 1
+        if cnt:
+            stats['dispatched'] += cnt
+            stats['last_dispatch'] = time.time()
+        return cnt
+
+    def dispatch_stats(self):
+        """
+        dispatch statistics of each project
+        """
+        return dict((k, dict(v)) for k, v in self._dispatch_stats.iteritems())
+
     def _dump_cnt(self):
-        self._cnt['1h'].dump(os.path.join(self.data_path, 'scheduler.1h'))
-        self._cnt['1d'].dump(os.path.join(self.data_path, 'scheduler.1d'))
-        self._cnt['all'].dump(os.path.join(self.data_path, 'scheduler.all'))
+        self._cnt['1h'].dump(self._counter_path('1h'))
+        self._cnt['1d'].dump(self._counter_path('1d'))
+        self._cnt['all'].dump(self._counter_path('all'))
 
     def _try_dump_cnt(self):
         now = time.time()
@@ -334,6 +967,37 @@ class Scheduler(object):
             self._last_dump_cnt = now
             self._dump_cnt()
 
+    def _snapshot_path(self, project):
+        return (os.path.join(self.data_path, 'task_queue.%s.snapshot' % project),
+                os.path.join(self.data_path, 'task_queue.%s.journal' % project))
+
+    def _snapshot(self, project):
+        """
+        save task queue of project, changes after snapshot are journaled
+        """
+        if not self.SNAPSHOT_INTERVAL:
+            return False
+        loading = self._loading.get(project)
+        if loading and not loading['restored']:
+            # task queue is incomplete before loading finished
+            return False
+        try:
+            self.task_queue[project].snapshot(*self._snapshot_path(project))
+        except (IOError, OSError) as e:
+            logger.error("project: %s snapshot failed: %r", project, e)
+            return False
+        return True
+
+    def _try_snapshot(self):
+        now = time.time()
+        if not self.SNAPSHOT_INTERVAL or now - self._last_snapshot < self.SNAPSHOT_INTERVAL:
+            return
+        self._last_snapshot = now
+        # tasks in snapshot should be found in taskdb
+        self._flush_tasks()
+        for project in self.task_queue:
+            self._snapshot(project)
+
     def _check_delete(self):
         now = time.time()
         for project in self.projects.values():
@@ -345,11 +1009,18 @@ class Scheduler(object):
                 continue
 
             logger.warning("deleting project: %s!", project['name'])
-            if project['name'] in self.task_queue:
-                self.task_queue[project['name']].rate = 0
-                self.task_queue[project['name']].burst = 0
-                del self.task_queue[project['name']]
+            self._drop_task_queue(project['name'])
             del self.projects[project['name']]
+            self.active_tasks.drop_project(project['name'])
+            self._update_cronjob(project['name'])
+            self._retry_policies.pop(project['name'], None)
+            for key in self._breakers.keys():
+                if key[0] == project['name']:
+                    del self._breakers[key]
+            for key in self._write_buffer.keys():
+                if key[0] == project['name']:
+                    del self._write_buffer[key]
+                    self._write_failures.pop(key, None)
             self.taskdb.drop(project['name'])
             self.projectdb.drop(project['name'])
             if self.resultdb:
@@ -360,22 +1031,173 @@ class Scheduler(object):
 
     def quit(self):
         self._quit = True
+        self.wakeup()
+
+    def wakeup(self):
+        """
+        wake up main loop from other threads
+        """
+        try:
+            os.write(self._wakeup_w, 'x')
+        except OSError:
+            pass
+
+    @staticmethod
+    def _queue_fileno(queue):
+        """
+        file descriptor which is readable when queue has message, None if not supported
+        """
+        reader = getattr(queue, '_reader', None)
+        if reader is None:
+            return None
+        try:
+            return reader.fileno()
+        except (AttributeError, IOError, OSError):
+            return None
+
+    def _loop_timeout(self):
+        """
+        seconds before next timer of main loop: time queues, token buckets,
+        cronjob ticks, project updates, task flush, counter dump and profiling.
+        """
+        now = time.time()
+        timeout = self._last_update_project + self.UPDATE_PROJECT_INTERVAL - now
+        if self._cron_heap:
+            timeout = min(timeout, self._cron_heap[0][0] - now)
+        timeout = min(timeout, self._last_dump_cnt + 60 - now)
+        if self.SNAPSHOT_INTERVAL:
+            timeout = min(timeout, self._last_snapshot + self.SNAPSHOT_INTERVAL - now)
+        if self._profile_until:
+            timeout = min(timeout, self._profile_until - now)
+        for loading in self._loading.itervalues():
+            if loading['retry_at']:
+                timeout = min(timeout, loading['retry_at'] - now)
+        if self._write_buffer:
+            timeout = min(timeout, self._last_flush + self.FLUSH_INTERVAL - now)
+        if self._send_buffer:
+            # out_queue is full, nothing can be dispatched until it's retried
+            return max(min(timeout, self.LOOP_INTERVAL), 0)
+        for task_queue in self.task_queue.itervalues():
+            if timeout <= 0:
+                break
+            timeout = min(timeout, task_queue.wait_time())
+        return max(timeout, 0)
+
+    def _wait(self, timeout):
+        """
+        block until a message arrives in status_queue or newtask_queue, wakeup is
+        called or timeout. queues without file descriptor are polled every
+        LOOP_INTERVAL.
+        """
+        fds = [self._wakeup_r, ]
+        # queues are not read until write buffer is flushed
+        queues = () if self._write_blocked() else (self.status_queue, self.newtask_queue)
+        for queue in queues:
+            fd = self._queue_fileno(queue)
+            if fd is None:
+                timeout = min(timeout, self.LOOP_INTERVAL)
+            else:
+                fds.append(fd)
+        if timeout > 0:
+            try:
+                readable, _, _ = select.select(fds, [], [], timeout)
+            except select.error:
+                return
+            if self._wakeup_r not in readable:
+                return
+        try:
+            while os.read(self._wakeup_r, 4096):
+                pass
+        except OSError:
+            pass
+
+    def _phase(self, name, func, *args):
+        start = time.time()
+        ret = func(*args)
+        self._phase_time.event(name, time.time() - start)
+        self._phase_calls.event(name, 1)
+        if isinstance(ret, dict):
+            self._phase_items.event(name, sum(ret.itervalues()))
+        elif isinstance(ret, (int, long)):
+            self._phase_items.event(name, ret)
+        return ret
+
+    def stats(self):
+        """
+        wall time and items of main loop phases in last 100 loops, latency of taskdb
+        calls by method
+        """
+        phases = dict()
+        for name in self._phase_calls.keys():
+            cost = self._phase_time[name]
+            phases[name] = {
+                'calls': self._phase_calls[name].sum,
+                'avg': cost.avg,
+                'max': max(cost.values),
+                'items': self._phase_items[name].avg if name in self._phase_items else 0,
+            }
+        taskdb = dict()
+        for method in self._db_latency.keys():
+            latency = self._db_latency[method]
+            taskdb[method] = {
+                'calls': latency.cnt,
+                'avg': latency.avg,
+                'histogram': latency.histogram,
+            }
+        return {
+            'phases': phases,
+            'taskdb': taskdb,
+            'profiling': self._profile_path if self._profile_until else '',
+        }
+
+    def profile(self, seconds=60):
+        """
+        profile main loop for seconds, stats of cProfile is dumped to data_path
+        """
+        now = time.time()
+        if not self._profile_until:
+            self._profile_path = self._counter_path('%d.prof' % now)
+        self._profile_until = now + min(seconds, self.PROFILE_MAX_TIME)
+        self.wakeup()
+        return self._profile_path
+
+    def _try_profile(self, stop=False):
+        if self._profile_until and self._profiler is None and not stop:
+            logger.info('profiling to %s', self._profile_path)
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        elif self._profiler is not None and (
+                stop or time.time() >= self._profile_until):
+            self._profiler.disable()
+            self._profiler.dump_stats(self._profile_path)
+            logger.info('profile dumped to %s', self._profile_path)
+            self._profiler = None
+            self._profile_until = 0
 
     def run(self):
         logger.info("loading projects")
         self._load_projects()
 
+        busy = False
         while not self._quit:
             try:
-                time.sleep(self.LOOP_INTERVAL)
-                self._update_projects()
-                self._check_task_done()
-                self._check_request()
-                while self._check_cronjob():
-                    pass
-                self._check_select()
-                self._check_delete()
-                self._try_dump_cnt()
+                self._try_profile()
+                self._phase('wait', self._wait, 0 if busy else self._loop_timeout())
+                busy = False
+                self._phase('update_projects', self._update_projects)
+                if self._phase('check_loading', self._check_loading) >= self.LOOP_LIMIT * 10:
+                    busy = True
+                if self._phase('check_task_done', self._check_task_done) >= self.LOOP_LIMIT:
+                    busy = True
+                if self._phase('check_request', self._check_request) >= self.LOOP_LIMIT:
+                    busy = True
+                self._phase('check_cronjob', self._check_cronjob)
+                self._phase('check_select', self._check_select)
+                self._phase('check_delete', self._check_delete)
+                self._phase('check_breakers', self._check_breakers)
+                self._phase('flush_tasks', self._try_flush_tasks)
+                self._phase('dump_cnt', self._try_dump_cnt)
+                self._phase('snapshot', self._try_snapshot)
                 self._exceptions = 0
             except KeyboardInterrupt:
                 break
@@ -387,17 +1209,26 @@ class Scheduler(object):
                 continue
 
         logger.info("scheduler exiting...")
+        self._try_profile(stop=True)
+        self._flush_tasks()
         self._dump_cnt()
+        for project, task_queue in self.task_queue.iteritems():
+            self._snapshot(project)
+            task_queue.close()
 
     def xmlrpc_run(self, port=23333, bind='127.0.0.1', logRequests=False):
-        from SimpleXMLRPCServer import SimpleXMLRPCServer
+        from pyspider.libs.rpc import ThreadingXMLRPCServer
 
-        server = SimpleXMLRPCServer((bind, port), allow_none=True, logRequests=logRequests)
+        server = ThreadingXMLRPCServer((bind, port), allow_none=True, logRequests=logRequests)
         server.register_introspection_functions()
         server.register_multicall_functions()
 
         server.register_function(self.quit, '_quit')
         server.register_function(self.__len__, 'size')
+        server.register_function(self.loading_progress, 'loading_progress')
+        server.register_function(self.dispatch_stats, 'dispatch_stats')
+        server.register_function(self.stats, 'stats')
+        server.register_function(self.profile, 'profile')
 
         def dump_counter(_time, _type):
             return self._cnt[_time].to_dict(_type)
@@ -406,40 +1237,29 @@ class Scheduler(object):
         def new_task(task):
             if self.task_verify(task):
                 self.newtask_queue.put(task)
+                self.wakeup()
                 return True
             return False
         server.register_function(new_task, 'newtask')
+        server.register_function(self.newtasks, 'newtasks')
+
+        def ingest(frames):
+            accepted = total = 0
+            for tasks in frames:
+                if isinstance(tasks, dict):
+                    tasks = [tasks, ]
+                total += len(tasks)
+                accepted += self.newtasks(tasks)
+            return {'accepted': accepted, 'total': total}
+        server.register_stream(ingest, '/ingest')
 
         def update_project():
             self._force_update_project = True
+            self.wakeup()
         server.register_function(update_project, 'update_project')
 
-        def get_active_tasks(project=None, limit=100):
-            allowed_keys = set((
-                'taskid',
-                'project',
-                'status',
-                'url',
-                'lastcrawltime',
-                'updatetime',
-                'track',
-            ))
-
-            iters = [iter(x['active_tasks']) for k, x in self.projects.iteritems()
-                     if x and (k == project if project else True)]
-            tasks = [next(x, None) for x in iters]
-            result = []
-
-            while len(result) < limit and tasks and not all(x is None for x in tasks):
-                updatetime, task = t = max(tasks)
-                i = tasks.index(t)
-                tasks[i] = next(iters[i], None)
-                for key in task.keys():
-                    if key in allowed_keys:
-                        continue
-                    del task[key]
-                result.append(t)
-            return result
+        def get_active_tasks(project=None, limit=100, since=None):
+            return self.active_tasks.get(project, limit, since)
         server.register_function(get_active_tasks, 'get_active_tasks')
 
         server.timeout = 0.5
@@ -509,9 +1329,40 @@ class Scheduler(object):
             ret = self.on_task_done(task)
         else:
             ret = self.on_task_failed(task)
-        self.projects[task['project']]['active_tasks'].appendleft((time.time(), task))
+        self.active_tasks.add(task)
         return ret
 
+    def retry_policy(self, project):
+        '''
+        RetryPolicy of project, rebuilt when retry_policy in crawl_config changed
+        '''
+        config = self.projects.get(project, {}).get('retry_policy')
+        policy = self._retry_policies.get(project)
+        if policy is None or policy.config != config:
+            try:
+                policy = RetryPolicy(config)
+            except Exception as e:
+                logger.error('bad retry_policy of %s: %r', project, e)
+                policy = RetryPolicy()
+                policy.config = config
+            self._retry_policies[project] = policy
+        return policy
+
+    def _breaker_key(self, task):
+        return task['project'], urlparse.urlsplit(task.get('url') or '').netloc
+
+    def _check_breakers(self):
+        """
+        forget circuit breakers of hosts not failed in cooldown
+        """
+        now = time.time()
+        if now - self._last_check_breakers < 60:
+            return
+        self._last_check_breakers = now
+        for key, breaker in self._breakers.items():
+            if breaker.expired():
+                del self._breakers[key]
+
     def on_task_done(self, task):
         '''
         called by task_status
@@ -519,6 +1370,7 @@ class Scheduler(object):
         task['status'] = self.taskdb.SUCCESS
         task['lastcrawltime'] = time.time()
         self.update_task(task)
+        self._breakers.pop(self._breaker_key(task), None)
 
         project = task['project']
         self._cnt['5m'].event((project, 'success'), +1)
@@ -532,52 +1384,73 @@ class Scheduler(object):
         '''
         called by task_status
         '''
-        old_task = self.taskdb.get_task(task['project'], task['taskid'], fields=['schedule'])
+        old_task = self.get_task(task['project'], task['taskid'], fields=['schedule'])
         if old_task is None:
             logging.error('unknow status pack: %s' % task)
             return
         if not task.get('schedule'):
             task['schedule'] = old_task.get('schedule', {})
 
+        project = task['project']
         retries = task['schedule'].get('retries', self.default_schedule['retries'])
         retried = task['schedule'].get('retried', 0)
-        if retried == 0:
-            next_exetime = 0
-        elif retried == 1:
-            next_exetime = 1 * 60 * 60
-        else:
-            next_exetime = 6 * (2 ** retried) * 60 * 60
-
-        if retried >= retries:
+        policy = self.retry_policy(project)
+        error_class, next_exetime = policy.next_retry(task['track'], retried, retries)
+
+        # consecutive fetch failures of a host open its breaker, retries of the host
+        # are delayed until the breaker is closed again.
+        breaker = None
+        if not task['track']['fetch']['ok']:
+            key = self._breaker_key(task)
+            breaker = self._breakers.pop(key, None)
+            if breaker is None:
+                breaker = CircuitBreaker(policy.breaker_threshold, policy.breaker_cooldown)
+            self._breakers[key] = breaker
+            if len(self._breakers) > self.BREAKERS_LIMIT:
+                self._breakers.popitem(last=False)
+            if breaker.failure():
+                self._cnt['1h'].event((project, 'breaker_open'), +1)
+                self._cnt['1d'].event((project, 'breaker_open'), +1)
+                logger.warning('circuit breaker of %s %s opened for %ds',
+                               project, key[1], breaker.cooldown)
+
+        if next_exetime is None:
             task['status'] = self.taskdb.FAILED
             task['lastcrawltime'] = time.time()
             self.update_task(task)
 
-            project = task['project']
             self._cnt['5m'].event((project, 'failed'), +1)
             self._cnt['1h'].event((project, 'failed'), +1)
             self._cnt['1d'].event((project, 'failed'), +1)
             self._cnt['all'].event((project, 'failed'), +1).event((project, 'pending'), -1)
-            logger.info('task failed %(project)s:%(taskid)s %(url)s' % task)
+            if retried < retries:
+                self._cnt['1h'].event((project, 'no_retry', error_class), +1)
+                self._cnt['1d'].event((project, 'no_retry', error_class), +1)
+            logger.info('task failed (%s) %%(project)s:%%(taskid)s %%(url)s' % error_class,
+                        task)
             return task
         else:
+            exetime = time.time() + next_exetime
+            if breaker is not None and breaker.is_open():
+                exetime = max(exetime, breaker.open_until)
             task['schedule']['retried'] = retried + 1
-            task['schedule']['exetime'] = time.time() + next_exetime
+            task['schedule']['exetime'] = exetime
             task['lastcrawltime'] = time.time()
             self.update_task(task)
             self.put_task(task)
 
-            project = task['project']
             self._cnt['5m'].event((project, 'retry'), +1)
             self._cnt['1h'].event((project, 'retry'), +1)
             self._cnt['1d'].event((project, 'retry'), +1)
+            self._cnt['1h'].event((project, 'retry_by', error_class), +1)
+            self._cnt['1d'].event((project, 'retry_by', error_class), +1)
             # self._cnt['all'].event((project, 'retry'), +1)
-            logger.info('task retry %d/%d %%(project)s:%%(taskid)s %%(url)s' % (
-                retried, retries), task)
+            logger.info('task retry %d/%d (%s) %%(project)s:%%(taskid)s %%(url)s' % (
+                retried, retries, error_class), task)
             return task
 
     def on_select_task(self, task):
         logger.debug('select %(project)s:%(taskid)s %(url)s', task)
         self.send_task(task)
-        self.projects[task['project']]['active_tasks'].appendleft((time.time(), task))
+        self.active_tasks.add(task)
         return task
@@ -5,88 +5,382 @@
 #         http://binux.me
 # Created on 2014-02-07 13:12:10
 
+import os
 import time
 import heapq
-import Queue
+import cPickle
+import sqlite3
 import logging
 import threading
-from UserDict import DictMixin
+from array import array
 from token_bucket import Bucket
 
 
-class InQueueTask(DictMixin):
-    __slots__ = ('taskid', 'priority', 'exetime')
-    __getitem__ = lambda *x: getattr(*x)
-    __setitem__ = lambda *x: setattr(*x)
-    keys = lambda self: self.__slots__
-
-    def __init__(self, taskid, priority=0, exetime=0):
-        self.taskid = taskid
-        self.priority = priority
-        self.exetime = exetime
-
-    def __cmp__(self, other):
-        if self.exetime == 0 and other.exetime == 0:
-            return -cmp(self.priority, other.priority)
-        else:
-            return cmp(self.exetime, other.exetime)
+def compact_taskid(taskid):
+    '''
+    ascii unicode taskids loaded from database are stored as str, which is
+    a quarter of the size.
+    '''
+    if isinstance(taskid, unicode):
+        try:
+            return taskid.encode('ascii')
+        except UnicodeEncodeError:
+            pass
+    return taskid
 
 
-class PriorityTaskQueue(Queue.Queue):
+class PriorityTaskQueue(object):
 
     '''
-    TaskQueue
+    priority queue of taskids with compact storage
+
+    taskids are mapped to slots, priority, exetime and version of each slot are kept in
+    parallel arrays. heap entries are plain tuples of (key, seq, slot), an entry is stale
+    when its seq is not the version of the slot any more, it's dropped when poped (lazy
+    deletion). changing priority or exetime pushes a new entry and leaves the old one stale.
     '''
 
-    def _init(self, maxsize):
+    def __init__(self):
         self.queue = []
         self.queue_dict = dict()
+        self.taskids = []
+        self.priority = array('d')
+        self.exetime = array('d')
+        # double keeps seq exact up to 2**53
+        self.version = array('d')
+        self.free_slots = []
+        self.seq = 0
+
+    def _key(self, slot):
+        return -self.priority[slot]
+
+    def _push(self, slot):
+        self.seq += 1
+        self.version[slot] = self.seq
+        heapq.heappush(self.queue, (self._key(slot), self.seq, slot))
+        if len(self.queue) > 2 * len(self.queue_dict) + 1024:
+            self._compact()
+
+    def _compact(self):
+        version = self.version
+        self.queue = [x for x in self.queue
+                      if self.taskids[x[2]] is not None and version[x[2]] == x[1]]
+        heapq.heapify(self.queue)
 
-    def _qsize(self, len=len):
-        return len(self.queue)
+    def _alloc(self, taskid, priority, exetime):
+        if self.free_slots:
+            slot = self.free_slots.pop()
+            self.taskids[slot] = taskid
+            self.priority[slot] = priority
+            self.exetime[slot] = exetime
+        else:
+            slot = len(self.taskids)
+            self.taskids.append(taskid)
+            self.priority.append(priority)
+            self.exetime.append(exetime)
+            self.version.append(0)
+        self.queue_dict[taskid] = slot
+        return slot
+
+    def _free(self, slot):
+        del self.queue_dict[self.taskids[slot]]
+        self.taskids[slot] = None
+        self.free_slots.append(slot)
+
+    def _top_slot(self):
+        queue = self.queue
+        version = self.version
+        taskids = self.taskids
+        while queue:
+            key, seq, slot = queue[0]
+            if taskids[slot] is not None and version[slot] == seq:
+                return slot
+            heapq.heappop(queue)
+        return None
 
-    def _put(self, item, heappush=heapq.heappush):
-        heappush(self.queue, item)
-        self.queue_dict[item.taskid] = item
+    def put(self, taskid, priority=0, exetime=0):
+        '''
+        put a task into queue, a task already in queue only get higher priority
+        or earlier exetime.
+        '''
+        slot = self.queue_dict.get(taskid)
+        if slot is None:
+            slot = self._alloc(compact_taskid(taskid), priority, exetime)
+            self._push(slot)
+            return
+
+        old_key = self._key(slot)
+        if priority > self.priority[slot]:
+            self.priority[slot] = priority
+        if exetime < self.exetime[slot]:
+            self.exetime[slot] = exetime
+        if self._key(slot) != old_key:
+            self._push(slot)
 
-    def _get(self, heappop=heapq.heappop):
-        item = heappop(self.queue)
-        self.queue_dict.pop(item.taskid, None)
-        return item
+    def get(self):
+        '''
+        pop the top task, return (taskid, priority, exetime) or None when empty
+        '''
+        slot = self._top_slot()
+        if slot is None:
+            return None
+        heapq.heappop(self.queue)
+        ret = (self.taskids[slot], self.priority[slot], self.exetime[slot])
+        self._free(slot)
+        return ret
 
     @property
     def top(self):
-        return self.queue[0]
+        '''
+        (taskid, priority, exetime) of the top task or None when empty
+        '''
+        slot = self._top_slot()
+        if slot is None:
+            return None
+        return (self.taskids[slot], self.priority[slot], self.exetime[slot])
 
-    def resort(self):
-        self.mutex.acquire()
-        heapq.heapify(self.queue)
-        self.mutex.release()
+    def bottom(self, count):
+        '''
+        (taskid, priority, exetime) of at most count tasks at the bottom of queue
+        '''
+        slots = heapq.nlargest(count, self.queue_dict.itervalues(), key=self._key)
+        return [(self.taskids[x], self.priority[x], self.exetime[x]) for x in slots]
+
+    def remove(self, taskid):
+        slot = self.queue_dict.get(taskid)
+        if slot is None:
+            return False
+        self._free(slot)
+        return True
+
+    def qsize(self):
+        return len(self.queue_dict)
+
+    __len__ = qsize
 
     def __contains__(self, taskid):
         return taskid in self.queue_dict
 
     def __getitem__(self, taskid):
-        return self.queue_dict[taskid]
+        slot = self.queue_dict[taskid]
+        return (self.taskids[slot], self.priority[slot], self.exetime[slot])
+
+    def items(self):
+        '''
+        (taskid, priority, exetime) of tasks in queue, not in order
+        '''
+        for slot in self.queue_dict.itervalues():
+            yield (self.taskids[slot], self.priority[slot], self.exetime[slot])
+
+
+class TimeTaskQueue(PriorityTaskQueue):
+
+    '''
+    queue of taskids ordered by exetime
+    '''
+
+    def _key(self, slot):
+        return self.exetime[slot]
+
+
+class DiskTaskQueue(object):
+
+    '''
+    sqlite backed queue of taskids, for tasks spilled out of memory
+
+    the file is a cache of taskdb and is removed when closed, it's rebuilt by
+    loading tasks from taskdb after restart. writes are committed by flush().
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            os.remove(path)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.text_factory = str
+        self.conn.execute('PRAGMA synchronous = OFF')
+        self.conn.execute('PRAGMA journal_mode = MEMORY')
+        self.conn.execute('''CREATE TABLE taskqueue (
+            taskid PRIMARY KEY,
+            priority REAL,
+            exetime REAL,
+            host)''')
+        self.conn.execute('CREATE INDEX priority_index ON taskqueue (priority)')
+        self.size = 0
+        # cache of highest priority of ready tasks, False for unknown
+        self._top = False
+
+    def put(self, taskid, priority=0, exetime=0, host=None):
+        '''
+        same as PriorityTaskQueue, a task already in queue only get higher priority
+        or earlier exetime.
+        '''
+        taskid = compact_taskid(taskid)
+        cursor = self.conn.execute(
+            'UPDATE taskqueue SET priority = MAX(priority, ?), exetime = MIN(exetime, ?), '
+            'host = COALESCE(?, host) WHERE taskid = ?', (priority, exetime, host, taskid))
+        if not cursor.rowcount:
+            self.conn.execute('INSERT INTO taskqueue VALUES (?, ?, ?, ?)',
+                              (taskid, priority, exetime, host))
+            self.size += 1
+        if self._top is not False and exetime <= time.time():
+            if self._top is None or priority > self._top:
+                self._top = priority
+
+    def get(self, limit, min_priority=None, now=None):
+        '''
+        pop at most limit ready tasks in priority order, only tasks with priority
+        higher than min_priority if set. return list of (taskid, priority, exetime, host)
+        '''
+        if now is None:
+            now = time.time()
+        if min_priority is None:
+            min_priority = float('-inf')
+        items = self.conn.execute(
+            'SELECT taskid, priority, exetime, host FROM taskqueue '
+            'WHERE exetime <= ? AND priority > ? ORDER BY priority DESC LIMIT ?',
+            (now, min_priority, limit)).fetchall()
+        if items:
+            self.conn.executemany('DELETE FROM taskqueue WHERE taskid = ?',
+                                  [(x[0], ) for x in items])
+            self.size -= len(items)
+            self._top = False
+        return items
+
+    def top_priority(self, now=None):
+        '''
+        highest priority of ready tasks, None when no task is ready
+        '''
+        if self._top is False:
+            if now is None:
+                now = time.time()
+            self._top = self.conn.execute(
+                'SELECT MAX(priority) FROM taskqueue WHERE exetime <= ?',
+                (now, )).fetchone()[0]
+        return self._top
+
+    def flush(self):
+        '''
+        commit writes, forget cached top priority as delayed tasks may be ready now
+        '''
+        self.conn.commit()
+        self._top = False
+
+    def close(self):
+        self.conn.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def qsize(self):
+        return self.size
+
+    __len__ = qsize
+
+    def __contains__(self, taskid):
+        return self.conn.execute('SELECT 1 FROM taskqueue WHERE taskid = ?',
+                                 (compact_taskid(taskid), )).fetchone() is not None
+
+    def items(self):
+        '''
+        (taskid, priority, exetime, host) of all tasks on disk
+        '''
+        return self.conn.execute('SELECT taskid, priority, exetime, host FROM taskqueue')
+
+
+class HostQueue(object):
 
-    def __setitem__(self, taskid, item):
-        assert item.taskid == taskid
-        self.put(item)
+    '''
+    politeness of a host: token bucket, max tasks in processing and tasks parked
+    while the host is throttled
+    '''
+
+    def __init__(self, rate=0, burst=None, concurrency=0):
+        self.bucket = None
+        self.concurrency = 0
+        self.update(rate, burst, concurrency)
+        self.processing = 0
+        self.parked = PriorityTaskQueue()
+
+    def update(self, rate=0, burst=None, concurrency=0):
+        self.settings = (rate, burst, concurrency)
+        if rate:
+            burst = burst or max(rate, 1)
+            if self.bucket is None:
+                self.bucket = Bucket(rate=rate, burst=burst)
+            else:
+                self.bucket.rate = float(rate)
+                self.bucket.burst = float(burst)
+        else:
+            self.bucket = None
+        self.concurrency = concurrency or 0
+
+    def available(self):
+        '''
+        number of tasks could be sended to host now
+        '''
+        ret = float('inf')
+        if self.bucket is not None:
+            ret = int(self.bucket.get())
+        if self.concurrency:
+            ret = min(ret, self.concurrency - self.processing)
+        return max(ret, 0)
+
+    def acquire(self):
+        self.processing += 1
+        if self.bucket is not None:
+            self.bucket.desc()
+
+    def release(self):
+        if self.processing > 0:
+            self.processing -= 1
+
+    def wait_time(self):
+        '''
+        seconds before a parked task could be sended, inf when waiting for
+        processing tasks
+        '''
+        if self.concurrency and self.processing >= self.concurrency:
+            return float('inf')
+        if self.bucket is not None:
+            return self.bucket.wait_time()
+        return 0
 
 
 class TaskQueue(object):
 
     '''
     task queue for scheduler, have a priority queue and a time queue for delayed tasks
+
+    when memory_limit is set, tasks beyond memory_limit are spilled to a DiskTaskQueue
+    at spill_path, and moved back to memory in priority order as memory drains.
+
+    tasks put with a host configured by update_host are limited by HostQueue of the
+    host, tasks of throttled host are parked in the HostQueue until it's available.
+
+    state of queue can be saved by snapshot(), changes after that are appended to a
+    journal, restore() rebuilds the queue from both.
     '''
     processing_timeout = 10 * 60
+    refill_batch = 1000
+    SNAPSHOT_VERSION = 1
 
-    def __init__(self, rate=0, burst=0):
+    def __init__(self, rate=0, burst=0, memory_limit=0, spill_path=None):
         self.mutex = threading.Lock()
         self.priority_queue = PriorityTaskQueue()
-        self.time_queue = PriorityTaskQueue()
-        self.processing = PriorityTaskQueue()
+        self.time_queue = TimeTaskQueue()
+        self.processing = TimeTaskQueue()
+        # done tasks stay in processing until timeout
+        self.processing_done = set()
         self.bucket = Bucket(rate=rate, burst=burst)
+        self.memory_limit = memory_limit
+        self.spill_path = spill_path
+        self.disk_queue = None
+        self.hosts = dict()
+        # host of tasks in memory, processing or parked
+        self.task_host = dict()
+        self.parked_hosts = set()
+        self.parked_size = 0
+        self.journal = None
 
     @property
     def rate(self):
@@ -105,79 +399,422 @@ class TaskQueue(object):
         self.bucket.burst = value
 
     def check_update(self):
+        if self.journal is not None:
+            self.journal.flush()
         self._check_time_queue()
         self._check_processing()
+        if self.parked_hosts:
+            self._check_hosts()
+        if self.disk_queue is not None:
+            self.mutex.acquire()
+            self.disk_queue.flush()
+            self._check_disk_queue()
+            self.mutex.release()
+
+    def _check_disk_queue(self):
+        '''
+        move ready tasks back from disk, called with mutex held.
+
+        when memory is less than half full, refill it in priority order up to
+        memory_limit. otherwise tasks with higher priority than the top of memory, or
+        any ready task when no task in memory is ready, are swapped with the lowest
+        ones in memory.
+        '''
+        disk_queue = self.disk_queue
+        if not disk_queue:
+            return
+        top = disk_queue.top_priority()
+        if top is None:
+            return
+        in_memory = len(self.priority_queue) + len(self.time_queue)
+        room = max(self.memory_limit - in_memory, 0)
+        memory_top = self.priority_queue.top
+        if in_memory * 2 < self.memory_limit:
+            items = disk_queue.get(min(room, self.refill_batch))
+        elif memory_top is None or top > memory_top[1]:
+            items = disk_queue.get(min(self.refill_batch, self.memory_limit),
+                                   min_priority=memory_top and memory_top[1])
+            self._swap_out(len(items) - room)
+        else:
+            return
+        for taskid, priority, exetime, host in items:
+            if host is not None and host in self.hosts:
+                self.task_host[taskid] = host
+            self.priority_queue.put(taskid, priority)
+
+    def _swap_out(self, count):
+        '''
+        move count lowest priority tasks in memory to disk, delayed tasks of latest
+        exetime are moved when ready tasks are not enough. called with mutex held.
+        '''
+        for queue in (self.priority_queue, self.time_queue):
+            if count <= 0:
+                break
+            for taskid, priority, exetime in queue.bottom(count):
+                queue.remove(taskid)
+                host = self.task_host.get(taskid)
+                if taskid not in self.processing:
+                    self.task_host.pop(taskid, None)
+                self.disk_queue.put(taskid, priority, exetime, host)
+                count -= 1
+
+    def _check_hosts(self):
+        '''
+        move parked tasks of available hosts back to priority queue
+        '''
+        self.mutex.acquire()
+        for host in list(self.parked_hosts):
+            host_queue = self.hosts[host]
+            available = host_queue.available()
+            while available >= 1 and host_queue.parked.qsize():
+                taskid, priority, exetime = host_queue.parked.get()
+                self.priority_queue.put(taskid, priority)
+                self.parked_size -= 1
+                available -= 1
+            if not host_queue.parked.qsize():
+                self.parked_hosts.discard(host)
+        self.mutex.release()
+
+    def update_host(self, host, rate=0, burst=None, concurrency=0):
+        '''
+        set limits of host, rate and burst of token bucket, max tasks in processing.
+        it's called for every task put with host, only changes are journaled.
+        '''
+        if host in self.hosts and self.hosts[host].settings == (rate, burst, concurrency):
+            return
+        self._journal_write(('host', host, rate, burst, concurrency))
+        if host in self.hosts:
+            self.hosts[host].update(rate, burst, concurrency)
+        else:
+            self.hosts[host] = HostQueue(rate, burst, concurrency)
+
+    def _release_host(self, taskid):
+        host = self.task_host.get(taskid)
+        if host is not None:
+            self.hosts[host].release()
+
+    def _forget_host(self, taskid):
+        host = self.task_host.get(taskid)
+        if host is None:
+            return
+        if taskid in self.priority_queue or taskid in self.time_queue \
+                or taskid in self.hosts[host].parked:
+            return
+        del self.task_host[taskid]
+
+    def _spill(self):
+        if self.disk_queue is None:
+            logging.info("[task_queue: spill] %s", self.spill_path)
+            self.disk_queue = DiskTaskQueue(self.spill_path)
+        return self.disk_queue
 
     def _check_time_queue(self):
         now = time.time()
         self.mutex.acquire()
-        while self.time_queue.qsize() and self.time_queue.top.exetime < now:
-            task = self.time_queue.get()
-            task.exetime = 0
-            self.priority_queue.put(task)
+        while self.time_queue.qsize() and self.time_queue.top[2] < now:
+            taskid, priority, exetime = self.time_queue.get()
+            self.priority_queue.put(taskid, priority)
         self.mutex.release()
 
     def _check_processing(self):
         now = time.time()
         self.mutex.acquire()
-        while self.processing.qsize() and self.processing.top.exetime < now:
-            task = self.processing.get()
-            if task.taskid is None:
+        while self.processing.qsize() and self.processing.top[2] < now:
+            taskid, priority, exetime = self.processing.get()
+            if taskid in self.processing_done:
+                self.processing_done.discard(taskid)
+                self._forget_host(taskid)
                 continue
-            task.exetime = 0
-            self.priority_queue.put(task)
-            logging.info("[processing: retry] %s" % task.taskid)
+            self._release_host(taskid)
+            self.priority_queue.put(taskid, priority)
+            logging.info("[processing: retry] %s" % taskid)
         self.mutex.release()
 
-    def put(self, taskid, priority=0, exetime=0):
+    def put(self, taskid, priority=0, exetime=0, host=None):
         now = time.time()
         self.mutex.acquire()
-        if taskid in self.priority_queue:
-            task = self.priority_queue[taskid]
-            if priority > task.priority:
-                task.priority = priority
+        if host is not None and host not in self.hosts:
+            host = None
+        self._journal_write(('put', taskid, priority, exetime, host))
+        parked_host = self.task_host.get(taskid)
+        if parked_host is not None and taskid in self.hosts[parked_host].parked:
+            self.hosts[parked_host].parked.put(taskid, priority)
+            host = None
+        elif taskid in self.priority_queue:
+            self.priority_queue.put(taskid, priority)
         elif taskid in self.time_queue:
-            task = self.time_queue[taskid]
-            if priority > task.priority:
-                task.priority = priority
-            if exetime < task.exetime:
-                task.exetime = exetime
+            self.time_queue.put(taskid, priority, exetime)
+        elif self.disk_queue and taskid in self.disk_queue:
+            self.disk_queue.put(taskid, priority, exetime, host)
+            host = None
+        elif (
+                self.memory_limit and self.spill_path
+                and len(self.priority_queue) + len(self.time_queue) >= self.memory_limit
+        ):
+            self._spill().put(taskid, priority, exetime, host)
+            host = None
+        elif exetime and exetime > now:
+            self.time_queue.put(taskid, priority, exetime)
         else:
-            task = InQueueTask(taskid, priority)
-            if exetime and exetime > now:
-                task.exetime = exetime
-                self.time_queue.put(task)
-            else:
-                self.priority_queue.put(task)
+            self.priority_queue.put(taskid, priority)
+        if host is not None:
+            self.task_host[taskid] = host
         self.mutex.release()
 
     def get(self):
-        if self.bucket.get() < 1:
-            return None
+        taskids = self.get_many(1)
+        return taskids[0] if taskids else None
+
+    def get_many(self, limit):
+        '''
+        get at most limit tasks in priority order within tokens of bucket, tokens are
+        acquired once for the batch and unused ones are given back.
+        '''
+        tokens = self.bucket.acquire(limit)
+        if not tokens:
+            return []
+        now = time.time()
+        deadline = now + self.processing_timeout
+        taskids = []
+        self.mutex.acquire()
+        self._check_disk_queue()
+        while len(taskids) < tokens:
+            item = self.priority_queue.get()
+            if item is None:
+                if not self.disk_queue:
+                    break
+                self._check_disk_queue()
+                item = self.priority_queue.get()
+                if item is None:
+                    break
+            taskid, priority, exetime = item
+            host = self.task_host.get(taskid)
+            if host is not None:
+                host_queue = self.hosts[host]
+                if host_queue.available() < 1:
+                    # host is throttled, park it and try next task
+                    host_queue.parked.put(taskid, priority)
+                    self.parked_hosts.add(host)
+                    self.parked_size += 1
+                    continue
+                host_queue.acquire()
+            if taskid in self.processing:
+                if taskid not in self.processing_done:
+                    self._release_host(taskid)
+                self.processing.remove(taskid)
+            self.processing_done.discard(taskid)
+            self.processing.put(taskid, priority, deadline)
+            self._journal_write(('get', taskid, priority, deadline))
+            taskids.append(taskid)
+        self.mutex.release()
+        if len(taskids) < tokens:
+            self.bucket.release(tokens - len(taskids))
+        return taskids
+
+    def done(self, taskid):
+        if taskid in self.processing and taskid not in self.processing_done:
+            self.processing_done.add(taskid)
+            self._release_host(taskid)
+            self._journal_write(('done', taskid))
+
+    def wait_time(self):
+        '''
+        seconds before a task could be got, or timed out tasks should be checked
+        '''
         now = time.time()
+        ret = float('inf')
+        if self.priority_queue.qsize() or (
+                self.disk_queue and self.disk_queue.top_priority() is not None):
+            ret = self.bucket.wait_time()
+        top = self.time_queue.top
+        if top is not None:
+            ret = min(ret, top[2] - now)
+        top = self.processing.top
+        if top is not None:
+            ret = min(ret, top[2] - now)
+        for host in self.parked_hosts:
+            ret = min(ret, self.hosts[host].wait_time())
+        return max(ret, 0)
+
+    def close(self):
+        '''
+        remove spilled tasks from disk and close journal
+        '''
+        self.mutex.acquire()
+        if self.disk_queue is not None:
+            self.disk_queue.close()
+            self.disk_queue = None
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        self.mutex.release()
+
+    def _journal_write(self, record):
+        if self.journal is not None:
+            cPickle.dump(record, self.journal, cPickle.HIGHEST_PROTOCOL)
+
+    def snapshot(self, path, journal_path):
+        '''
+        write state of queue to path and start a new journal at journal_path.
+        parked and spilled tasks are saved as queued tasks.
+        '''
         self.mutex.acquire()
         try:
-            task = self.priority_queue.get_nowait()
-            self.bucket.desc()
-        except Queue.Empty:
+            queue = []
+            for taskid, priority, exetime in self.priority_queue.items():
+                queue.append((taskid, priority, exetime, self.task_host.get(taskid)))
+            for taskid, priority, exetime in self.time_queue.items():
+                queue.append((taskid, priority, exetime, self.task_host.get(taskid)))
+            for host, host_queue in self.hosts.iteritems():
+                for taskid, priority, exetime in host_queue.parked.items():
+                    queue.append((taskid, priority, exetime, host))
+            if self.disk_queue is not None:
+                queue.extend(self.disk_queue.items())
+
+            processing = []
+            for taskid, priority, deadline in self.processing.items():
+                processing.append((taskid, priority, deadline,
+                                   taskid in self.processing_done, self.task_host.get(taskid)))
+
+            hosts = dict()
+            for host, host_queue in self.hosts.iteritems():
+                if host_queue.bucket is not None:
+                    hosts[host] = (host_queue.bucket.rate, host_queue.bucket.burst,
+                                   host_queue.concurrency)
+                else:
+                    hosts[host] = (0, None, host_queue.concurrency)
+
+            state = {
+                'version': self.SNAPSHOT_VERSION,
+                'id': '%r' % time.time(),
+                'bucket': self.bucket.bucket,
+                'hosts': hosts,
+                'queue': queue,
+                'processing': processing,
+            }
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as fp:
+                cPickle.dump(state, fp, cPickle.HIGHEST_PROTOCOL)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.rename(tmp_path, path)
+
+            if self.journal is not None:
+                self.journal.close()
+            self.journal = open(journal_path, 'wb')
+            cPickle.dump(('snapshot', state['id']), self.journal, cPickle.HIGHEST_PROTOCOL)
+            self.journal.flush()
+        finally:
             self.mutex.release()
-            return None
-        task.exetime = now + self.processing_timeout
-        self.processing.put(task)
+        return len(queue)
+
+    @staticmethod
+    def _replay_journal(journal_path, snapshot_id, queue, processing, hosts):
+        '''
+        apply records of journal written after snapshot to state, return offset of
+        the last valid record, None if journal is not of the snapshot.
+        '''
+        with open(journal_path, 'rb') as fp:
+            try:
+                if cPickle.load(fp) != ('snapshot', snapshot_id):
+                    return None
+            except Exception:
+                return None
+            offset = fp.tell()
+            while True:
+                try:
+                    record = cPickle.load(fp)
+                except Exception:
+                    # EOF or the record was partially written
+                    break
+                offset = fp.tell()
+                if record[0] == 'put':
+                    _, taskid, priority, exetime, host = record
+                    if taskid in queue:
+                        item = queue[taskid]
+                        queue[taskid] = (max(item[0], priority), min(item[1], exetime),
+                                         host or item[2])
+                    else:
+                        queue[taskid] = (priority, exetime, host)
+                elif record[0] == 'get':
+                    _, taskid, priority, deadline = record
+                    item = queue.pop(taskid, None)
+                    host = item[2] if item else None
+                    if host is None and taskid in processing:
+                        host = processing[taskid][3]
+                    processing[taskid] = (priority, deadline, False, host)
+                elif record[0] == 'done':
+                    item = processing.get(record[1])
+                    if item:
+                        processing[record[1]] = item[:2] + (True, ) + item[3:]
+                elif record[0] == 'host':
+                    hosts[record[1]] = record[2:]
+        return offset
+
+    def restore(self, path, journal_path):
+        '''
+        rebuild queue from snapshot at path and journal at journal_path, journal is
+        reopened for appending. return False when snapshot is missing or invalid.
+        '''
+        try:
+            with open(path, 'rb') as fp:
+                state = cPickle.load(fp)
+            if state['version'] != self.SNAPSHOT_VERSION:
+                raise ValueError('snapshot version %r' % state['version'])
+        except Exception as e:
+            if os.path.exists(path):
+                logging.error("[task_queue: snapshot] %s invalid: %r", path, e)
+            return False
+
+        queue = dict((x[0], tuple(x[1:])) for x in state['queue'])
+        processing = dict((x[0], tuple(x[1:])) for x in state['processing'])
+        hosts = dict(state['hosts'])
+        offset = None
+        if os.path.exists(journal_path):
+            offset = self._replay_journal(journal_path, state['id'], queue, processing, hosts)
+
+        for host, (rate, burst, concurrency) in hosts.iteritems():
+            self.update_host(host, rate, burst, concurrency)
+        for taskid, (priority, exetime, host) in queue.iteritems():
+            self.put(taskid, priority, exetime, host)
+        self.mutex.acquire()
+        for taskid, (priority, deadline, done, host) in processing.iteritems():
+            self.processing.put(taskid, priority, deadline)
+            if host in self.hosts:
+                self.task_host[taskid] = host
+            if done:
+                self.processing_done.add(taskid)
+            elif host in self.hosts:
+                self.hosts[host].processing += 1
         self.mutex.release()
-        return task.taskid
+        self.bucket.set(min(state['bucket'], self.bucket.burst))
 
-    def done(self, taskid):
-        if taskid in self.processing:
-            self.processing[taskid].taskid = None
+        if offset is None:
+            # journal is stale, snapshot alone is the latest state
+            self.journal = open(journal_path, 'wb')
+            cPickle.dump(('snapshot', state['id']), self.journal, cPickle.HIGHEST_PROTOCOL)
+        else:
+            # drop partially written record at tail
+            self.journal = open(journal_path, 'r+b')
+            self.journal.truncate(offset)
+            self.journal.seek(offset)
+        return True
 
     def __len__(self):
-        return self.priority_queue.qsize() + self.time_queue.qsize()
+        ret = self.priority_queue.qsize() + self.time_queue.qsize() + self.parked_size
+        if self.disk_queue is not None:
+            ret += self.disk_queue.qsize()
+        return ret
 
     def __contains__(self, taskid):
         if taskid in self.priority_queue or taskid in self.time_queue:
             return True
-        if taskid in self.processing and self.processing[taskid].taskid:
+        if self.disk_queue and taskid in self.disk_queue:
+            return True
+        host = self.task_host.get(taskid)
+        if host is not None and taskid in self.hosts[host].parked:
+            return True
+        if taskid in self.processing and taskid not in self.processing_done:
             return True
         return False
 
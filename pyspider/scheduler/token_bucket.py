@@ -30,21 +30,54 @@ class Bucket(object):
         self.bucket = self.burst
         self.last_update = time.time()
 
+    def _refill(self, now):
+        # fractions of token are kept, they add up to the exact rate
+        if self.bucket < self.burst:
+            self.bucket = min(self.burst, self.bucket + self.rate * (now - self.last_update))
+        self.last_update = now
+
     def get(self):
-        now = time.time()
-        if self.bucket >= self.burst:
-            self.last_update = now
-            return self.bucket
-        bucket = self.rate * (now - self.last_update)
         self.mutex.acquire()
-        if bucket > 1:
-            self.bucket += bucket
-            if self.bucket > self.burst:
-                self.bucket = self.burst
-            self.last_update = now
+        self._refill(time.time())
         self.mutex.release()
         return self.bucket
 
+    def acquire(self, n=1):
+        '''
+        take at most n whole tokens, return number of tokens granted
+        '''
+        self.mutex.acquire()
+        self._refill(time.time())
+        granted = max(0, min(int(n), int(self.bucket)))
+        self.bucket -= granted
+        self.mutex.release()
+        return granted
+
+    def release(self, n=1):
+        '''
+        give back unused tokens of acquire
+        '''
+        self.mutex.acquire()
+        self.bucket = min(self.burst, self.bucket + n)
+        self.mutex.release()
+
+    def wait_time(self, n=1):
+        '''
+        seconds before n tokens are available
+        '''
+        bucket = self.get()
+        if bucket >= n:
+            return 0
+        if self.rate <= 0 or n > self.burst:
+            return float('inf')
+        return (n - bucket) / self.rate
+
+    def next_time(self, n=1):
+        '''
+        timestamp when n tokens are available
+        '''
+        return time.time() + self.wait_time(n)
+
     def set(self, value):
         self.bucket = value
 
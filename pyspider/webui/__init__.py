@@ -10,3 +10,4 @@ import index
 import debug
 import task
 import result
+import stats
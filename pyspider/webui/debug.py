@@ -158,6 +158,7 @@ def save(project):
             'status': 'TODO',
             'rate': app.config.get('max_rate', 1),
             'burst': app.config.get('max_burst', 3),
+            'weight': 1,
         }
         projectdb.insert(project, info)
 
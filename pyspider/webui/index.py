@@ -9,7 +9,7 @@ from app import app
 from flask import render_template, request, json
 from flask.ext import login
 
-index_fields = ['name', 'group', 'status', 'comments', 'rate', 'burst', ]
+index_fields = ['name', 'group', 'status', 'comments', 'rate', 'burst', 'weight', ]
 
 
 @app.route('/')
@@ -32,7 +32,7 @@ def project_update():
             and not login.current_user.is_active():
         return app.login_response
 
-    if name not in ('group', 'status', 'rate'):
+    if name not in ('group', 'status', 'rate', 'weight'):
         return 'unknow field: %s' % name, 400
     if name == 'rate':
         value = value.split('/')
@@ -44,6 +44,16 @@ def project_update():
             'rate': min(rate, app.config.get('max_rate', rate)),
             'burst': min(burst, app.config.get('max_burst', burst)),
         }
+    elif name == 'weight':
+        try:
+            weight = float(value)
+        except ValueError:
+            return 'format error: weight', 400
+        if weight <= 0:
+            return 'weight should > 0', 400
+        update = {
+            'weight': weight,
+        }
     else:
         update = {
             name: value
@@ -53,6 +53,21 @@ $(function() {
     url: "/update"
   });
 
+  $(".project-weight>span").editable({
+    name: 'weight',
+    pk: function(e) {
+      return $(this).parents('tr').data("name");
+    },
+    validate: function(value) {
+      if (!$.isNumeric(value) || value <= 0)
+        return "format error: weight";
+    },
+    highlight: false,
+    emptytext: '1',
+    placement: 'right',
+    url: "/update"
+  });
+
   $('.project-create').on('click', function() {
     var result = prompt('Create new project:');
     if (result && result.search(/[^\w]/) == -1) {
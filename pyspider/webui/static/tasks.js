@@ -0,0 +1,30 @@
+// vim: set et sw=2 ts=2 sts=2 ff=unix fenc=utf8:
+// Author: Binux<i@binux.me>
+//         http://binux.me
+// Created on 2014-12-16 17:32:05
+
+$(function() {
+  var tasks = $(".tasks");
+  var cursor = tasks.data("cursor");
+
+  // poll tasks updated after cursor, newer ones replace old items of same task
+  function poll() {
+    $.get("/tasks", {
+      project: tasks.data("project"),
+      limit: tasks.data("limit"),
+      since: cursor,
+      fragment: 1
+    }, function(data, status, xhr) {
+      cursor = xhr.getResponseHeader("X-Cursor") || cursor;
+      var items = $($.parseHTML($.trim(data)));
+      items.filter("li").each(function() {
+        tasks.children("li[data-task='" + $(this).data("task") + "']").remove();
+      });
+      tasks.prepend(items);
+      tasks.children("li").slice(tasks.data("limit")).remove();
+    }).always(function() {
+      setTimeout(poll, 5000);
+    });
+  }
+  setTimeout(poll, 5000);
+});
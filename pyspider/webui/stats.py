@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set et sw=4 ts=4 sts=4 ff=unix fenc=utf8:
+# Author: Binux<i@binux.me>
+#         http://binux.me
+# Created on 2014-12-18 15:02:36
+
+import socket
+
+from app import app
+from flask import render_template, request, json, redirect
+from flask.ext import login
+
+
+@app.route('/stats')
+def stats():
+    rpc = app.config['scheduler_rpc']
+    if rpc is None:
+        return json.dumps({})
+
+    try:
+        stats = rpc.stats()
+        rpc_stats = rpc.rpc_stats()
+    except socket.error as e:
+        app.logger.warning('connect to scheduler rpc error: %r', e)
+        return 'connect to scheduler error', 502
+
+    if request.args.get('format') == 'json':
+        stats['rpc'] = rpc_stats
+        return json.dumps(stats), 200, {'Content-Type': 'application/json'}
+    return render_template("stats.html", stats=stats, rpc_stats=rpc_stats,
+                           buckets=sorted(
+                               stats['taskdb'].values()[0]['histogram'],
+                               key=float) if stats['taskdb'] else [])
+
+
+@app.route('/stats/profile', methods=['POST', ])
+def profile():
+    rpc = app.config['scheduler_rpc']
+    if rpc is None:
+        return json.dumps({})
+    if app.config.get('webui_username') and not login.current_user.is_active():
+        return app.login_response
+
+    seconds = int(request.form.get('seconds', 60))
+    rpc.profile(seconds)
+    return redirect('/stats')
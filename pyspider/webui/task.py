@@ -29,33 +29,48 @@ def task(taskid):
                            status_to_string=app.config['taskdb'].status_to_string)
 
 
+def get_active_tasks(project, limit, since=None):
+    rpc = app.config['scheduler_rpc']
+    if since is None:
+        return rpc.get_active_tasks(project, limit)
+    return rpc.get_active_tasks(project, limit, since)
+
+
 @app.route('/tasks')
 def tasks():
-    rpc = app.config['scheduler_rpc']
     taskdb = app.config['taskdb']
     project = request.args.get('project', "")
     limit = int(request.args.get('limit', 100))
+    since = request.args.get('since', None, type=float)
 
     tasks = {}
+    cursor = since or 0
     for updatetime, task in sorted(
-            rpc.get_active_tasks(project, limit), key=lambda x: x[0]):
+            get_active_tasks(project, limit, since), key=lambda x: x[0]):
         task['updatetime'] = updatetime
         tasks['%(project)s:%(taskid)s' % task] = task
+        cursor = max(cursor, updatetime)
 
+    # list items updated after since, for polling
+    template = "task_list.html" if request.args.get('fragment') else "tasks.html"
     return render_template(
-        "tasks.html",
+        template,
         tasks=tasks.values(),
+        project=project,
+        limit=limit,
+        cursor=repr(cursor),
         status_to_string=taskdb.status_to_string
-    )
+    ), 200, {'X-Cursor': repr(cursor)}
 
 
 @app.route('/active_tasks')
 def active_tasks():
-    rpc = app.config['scheduler_rpc']
     taskdb = app.config['taskdb']
-
+    project = request.args.get('project', "")
     limit = int(request.args.get('limit', 100))
-    tasks = rpc.get_active_tasks(limit)
+    since = request.args.get('since', None, type=float)
+
+    tasks = get_active_tasks(project, limit, since)
     result = []
     for updatetime, task in tasks:
         task['updatetime'] = updatetime
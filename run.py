@@ -36,10 +36,21 @@ def connect_rpc(ctx, param, value):
     return xmlrpclib.ServerProxy(value)
 
 
+def connect_scheduler_rpc(ctx, param, value):
+    if value is None:
+        return
+    if ',' not in value:
+        return connect_rpc(ctx, param, value)
+    from pyspider.libs.shard import ShardedSchedulerRPC
+    return ShardedSchedulerRPC([connect_rpc(ctx, param, x.strip()) for x in value.split(',')])
+
+
 @click.group(invoke_without_command=True)
 @click.option('-c', '--config', callback=read_config, type=click.File('r'),
               help='a json file with default values for subcommands. {"webui": {"port":5001}}')
 @click.option('--debug', envvar='DEBUG', is_flag=True, help='debug mode')
+@click.option('--data-path', envvar='DATA_PATH', default='./data',
+              help='data dir of sqlite databases, snapshots and bloom filters')
 @click.option('--queue-maxsize', envvar='QUEUE_MAXSIZE', default=100,
               help='maxsize of queue')
 @click.option('--taskdb', envvar='TASKDB', callback=connect_db,
@@ -49,6 +60,8 @@ def connect_rpc(ctx, param, value):
 @click.option('--resultdb', envvar='RESULTDB', callback=connect_db,
               help='database url for resultdb, default: sqlite')
 @click.option('--amqp-url', help='amqp url for rabbitmq, default: built-in Queue')
+@click.option('--scheduler-shards', envvar='SCHEDULER_SHARDS', default=1,
+              help='number of scheduler shards, projects are split by consistent hashing')
 @click.option('--phantomjs-proxy', help="phantomjs proxy ip:port")
 @click.pass_context
 def cli(ctx, **kwargs):
@@ -70,29 +83,34 @@ def cli(ctx, **kwargs):
                 db, os.environ['MONGODB_PORT_27017_TCP_ADDR'],
                 os.environ['MONGODB_PORT_27017_TCP_PORT'], db)))
         else:
-            kwargs[db] = Get(lambda db=db: connect_database('sqlite+%s:///data/%s.db' % (
-                db, db[:-2])))
+            kwargs[db] = Get(lambda db=db: connect_database('sqlite+%s:///%s/%s.db' % (
+                db, kwargs['data_path'], db[:-2])))
 
     # queue
-    if kwargs.get('amqp_url'):
+    if kwargs.get('amqp_url') or os.environ.get('RABBITMQ_NAME'):
         from pyspider.libs.rabbitmq import Queue
-        for name in ('newtask_queue', 'status_queue', 'scheduler2fetcher',
-                     'fetcher2processor', 'processor2result'):
-            kwargs[name] = Get(lambda name=name: Queue(name, amqp_url=kwargs['amqp_url'],
-                                                       maxsize=kwargs['queue_maxsize']))
-    elif os.environ.get('RABBITMQ_NAME'):
-        from pyspider.libs.rabbitmq import Queue
-        amqp_url = ("amqp://guest:guest@%(RABBITMQ_PORT_5672_TCP_ADDR)s"
-                    ":%(RABBITMQ_PORT_5672_TCP_PORT)s/%%2F" % os.environ)
-        for name in ('newtask_queue', 'status_queue', 'scheduler2fetcher',
-                     'fetcher2processor', 'processor2result'):
-            kwargs[name] = Get(lambda name=name: Queue(name, amqp_url=amqp_url,
-                                                       maxsize=kwargs['queue_maxsize']))
+        amqp_url = kwargs.get('amqp_url') or (
+            "amqp://guest:guest@%(RABBITMQ_PORT_5672_TCP_ADDR)s"
+            ":%(RABBITMQ_PORT_5672_TCP_PORT)s/%%2F" % os.environ)
+        new_queue = lambda name: Queue(name, amqp_url=amqp_url,
+                                       maxsize=kwargs['queue_maxsize'])
+        lazy = True
     else:
         from multiprocessing import Queue
-        for name in ('newtask_queue', 'status_queue', 'scheduler2fetcher',
-                     'fetcher2processor', 'processor2result'):
-            kwargs[name] = Queue(kwargs['queue_maxsize'])
+        new_queue = lambda name: Queue(kwargs['queue_maxsize'])
+        lazy = False
+
+    shards = kwargs['scheduler_shards']
+    for name in ('newtask_queue', 'status_queue', 'scheduler2fetcher',
+                 'fetcher2processor', 'processor2result'):
+        if shards > 1 and name in ('newtask_queue', 'status_queue'):
+            # a queue for each scheduler shard, messages are routed by project
+            from pyspider.libs.shard import ShardedQueue
+            getter = lambda name=name: ShardedQueue(
+                [new_queue('%s.%d' % (name, i)) for i in range(shards)])
+        else:
+            getter = lambda name=name: new_queue(name)
+        kwargs[name] = Get(getter) if lazy else getter()
 
     # phantomjs-proxy
     if kwargs.get('phantomjs_proxy'):
@@ -115,18 +133,54 @@ def cli(ctx, **kwargs):
 @click.option('--inqueue-limit', default=0,
               help='size limit of task queue for each project, '
               'tasks will been ignored when overflow')
+@click.option('--inmemory-limit', default=0,
+              help='tasks more than this limit of each project are spilled to disk '
+              'under data path, 0 for unlimited')
+@click.option('--snapshot-interval', default=5 * 60,
+              help='interval of task queue snapshots under data path for warm restart, '
+              '0 to disable and reload tasks from taskdb on start')
+@click.option('--known-tasks-limit', default=1000000,
+              help='index of known tasks is kept in memory (~150 bytes each) for projects '
+              'having less tasks than this limit, 0 to disable')
 @click.option('--delete-time', default=24 * 60 * 60,
               help='delete time before marked as delete')
 @click.option('--active-tasks', default=100, help='active log size')
+@click.option('--shard', help='i/N, run as the i-th of N scheduler shards (0 based), '
+              'N should equal to --scheduler-shards. xmlrpc port is xmlrpc-port + i')
 @click.pass_context
 def scheduler(ctx, xmlrpc, xmlrpc_host, xmlrpc_port,
-              inqueue_limit, delete_time, active_tasks):
+              inqueue_limit, inmemory_limit, snapshot_interval, known_tasks_limit,
+              delete_time, active_tasks, shard):
     g = ctx.obj
     from pyspider.scheduler import Scheduler
+
+    newtask_queue = g.newtask_queue
+    status_queue = g.status_queue
+    shard_index, shards = 0, 1
+    if shard:
+        try:
+            shard_index, shards = [int(x) for x in shard.split('/')]
+        except ValueError:
+            raise click.BadParameter('shard should be i/N')
+        if shards != g.scheduler_shards or not 0 <= shard_index < shards:
+            raise click.BadParameter('shard %s not in %d scheduler shards'
+                                     % (shard, g.scheduler_shards))
+    elif g.scheduler_shards > 1:
+        raise click.BadParameter('--shard is required with %d scheduler shards'
+                                 % g.scheduler_shards)
+    if shards > 1:
+        newtask_queue = newtask_queue.queues[shard_index]
+        status_queue = status_queue.queues[shard_index]
+        xmlrpc_port += shard_index
+
     scheduler = Scheduler(taskdb=g.taskdb, projectdb=g.projectdb, resultdb=g.resultdb,
-                          newtask_queue=g.newtask_queue, status_queue=g.status_queue,
-                          out_queue=g.scheduler2fetcher)
+                          newtask_queue=newtask_queue, status_queue=status_queue,
+                          out_queue=g.scheduler2fetcher, data_path=g.data_path,
+                          shard=shard_index, shards=shards)
     scheduler.INQUEUE_LIMIT = inqueue_limit
+    scheduler.INMEMORY_LIMIT = inmemory_limit
+    scheduler.SNAPSHOT_INTERVAL = snapshot_interval
+    scheduler.KNOWN_TASKS_LIMIT = known_tasks_limit
     scheduler.DELETE_TIME = delete_time
     scheduler.ACTIVE_TASKS = active_tasks
 
@@ -144,21 +198,59 @@ def scheduler(ctx, xmlrpc, xmlrpc_host, xmlrpc_port,
 @click.option('--xmlrpc-host', default='0.0.0.0')
 @click.option('--xmlrpc-port', envvar='FETCHER_XMLRPC_PORT', default=24444)
 @click.option('--poolsize', default=10, help="max simultaneous fetches")
+@click.option('--prefetch', default=10, help="tasks taken from queue beyond poolsize")
+@click.option('--workers', default=1,
+              help="fetcher processes sharing the queue, counters and xmlrpc endpoint")
 @click.option('--proxy', help="proxy host:port")
 @click.option('--user-agent', help='user agent')
 @click.option('--timeout', help='default fetch timeout')
+@click.option('--max-body-size', type=int,
+              help='bodies larger than it are truncated, no limit by default')
+@click.option('--spill-size', type=int,
+              help='bodies larger than it are passed to processor in temporary files')
+@click.option('--blob-store', help='directory shared with processor, large contents are '
+              'passed through it instead of the queue')
+@click.option('--blob-threshold', type=int, help='contents larger than it are put into blob store')
+@click.option('--blob-max-age', default=24 * 60 * 60,
+              help='seconds blobs are kept, longer than results could wait in queue')
+@click.option('--max-host-connections', type=int,
+              help='max connections kept to a host, 0 for unlimited')
+@click.option('--dns-cache-timeout', type=int, help='seconds dns results are cached')
 @click.pass_context
-def fetcher(ctx, xmlrpc, xmlrpc_host, xmlrpc_port, poolsize, proxy, user_agent, timeout):
+def fetcher(ctx, xmlrpc, xmlrpc_host, xmlrpc_port, poolsize, prefetch, workers, proxy,
+            user_agent, timeout, max_body_size, spill_size, blob_store, blob_threshold,
+            blob_max_age, max_host_connections, dns_cache_timeout):
     g = ctx.obj
     from pyspider.fetcher.tornado_fetcher import Fetcher
-    fetcher = Fetcher(inqueue=g.scheduler2fetcher, outqueue=g.fetcher2processor,
-                      poolsize=poolsize, proxy=proxy)
-    fetcher.phantomjs_proxy = g.phantomjs_proxy
-    if user_agent:
-        fetcher.user_agent = user_agent
-    if timeout:
-        fetcher.default_options = dict(fetcher.default_options)
-        fetcher.default_options['timeout'] = timeout
+
+    def new_fetcher(async=True):
+        fetcher = Fetcher(inqueue=g.scheduler2fetcher if async else None,
+                          outqueue=g.fetcher2processor if async else None,
+                          poolsize=poolsize, proxy=proxy, async=async, prefetch=prefetch,
+                          max_host_connections=max_host_connections,
+                          dns_cache_timeout=dns_cache_timeout)
+        fetcher.phantomjs_proxy = g.phantomjs_proxy
+        if user_agent:
+            fetcher.user_agent = user_agent
+        if timeout:
+            fetcher.default_options = dict(fetcher.default_options)
+            fetcher.default_options['timeout'] = timeout
+        if max_body_size:
+            fetcher.max_body_size = max_body_size
+        if spill_size:
+            fetcher.spill_size = spill_size
+        if blob_store:
+            from pyspider.libs.blob_store import BlobStore
+            fetcher.blob_store = BlobStore(blob_store, max_age=blob_max_age)
+        if blob_threshold:
+            fetcher.blob_threshold = blob_threshold
+        return fetcher
+
+    if workers > 1:
+        from pyspider.fetcher.supervisor import FetcherSupervisor
+        fetcher = FetcherSupervisor(new_fetcher, workers)
+    else:
+        fetcher = new_fetcher()
 
     g.instances.append(fetcher)
     if g.get('testing_mode'):
@@ -170,13 +262,18 @@ def fetcher(ctx, xmlrpc, xmlrpc_host, xmlrpc_port, poolsize, proxy, user_agent,
 
 
 @cli.command()
+@click.option('--bloom-filter/--no-bloom-filter', default=False,
+              help='filter follows sent before (without age and itag) in processor. '
+              'follows dropped by scheduler over its inqueue limit are still filtered '
+              'for 7-14 days')
 @click.pass_context
-def processor(ctx):
+def processor(ctx, bloom_filter):
     g = ctx.obj
     from pyspider.processor import Processor
     processor = Processor(projectdb=g.projectdb,
                           inqueue=g.fetcher2processor, status_queue=g.status_queue,
-                          newtask_queue=g.newtask_queue, result_queue=g.processor2result)
+                          newtask_queue=g.newtask_queue, result_queue=g.processor2result,
+                          bloom_filter=bloom_filter, data_path=g.data_path)
 
     g.instances.append(processor)
     if g.get('testing_mode'):
@@ -206,7 +303,8 @@ def result_worker(ctx):
               help='webui bind to host')
 @click.option('--cdn', default='//cdnjscn.b0.upaiyun.com/libs/',
               help='js/css cdn server')
-@click.option('--scheduler-rpc', callback=connect_rpc, help='xmlrpc path of scheduler')
+@click.option('--scheduler-rpc', callback=connect_scheduler_rpc,
+              help='xmlrpc path of scheduler, comma separated for scheduler shards')
 @click.option('--fetcher-rpc', callback=connect_rpc, help='xmlrpc path of fetcher')
 @click.option('--max-rate', type=float, help='max rate for each project')
 @click.option('--max-burst', type=float, help='max burst for each project')
@@ -246,12 +344,13 @@ def webui(ctx, host, port, cdn, scheduler_rpc, fetcher_rpc,
         app.config['fetch'] = lambda x: umsgpack.unpackb(fetcher_rpc.fetch(x).data)
 
     if isinstance(scheduler_rpc, basestring):
-        scheduler_rpc = connect_rpc(ctx, None, scheduler_rpc)
+        scheduler_rpc = connect_scheduler_rpc(ctx, None, scheduler_rpc)
     if scheduler_rpc is None and os.environ.get('SCHEDULER_NAME'):
         app.config['scheduler_rpc'] = connect_rpc(ctx, None, 'http://%s/' % (
             os.environ['SCHEDULER_PORT_23333_TCP'][len('tcp://'):]))
     elif scheduler_rpc is None:
-        app.config['scheduler_rpc'] = connect_rpc(ctx, None, 'http://localhost:23333/')
+        app.config['scheduler_rpc'] = connect_scheduler_rpc(ctx, None, ','.join(
+            'http://localhost:%d/' % (23333 + i) for i in range(g.scheduler_shards)))
     else:
         app.config['scheduler_rpc'] = scheduler_rpc
 
@@ -301,12 +400,18 @@ def all(ctx, fetcher_num, processor_num, result_worker_num, run_in):
     # scheduler
     scheduler_config = g.config.get('scheduler', {})
     scheduler_config.setdefault('xmlrpc_host', '127.0.0.1')
-    threads.append(run_in(ctx.invoke, scheduler, **scheduler_config))
+    if g.scheduler_shards > 1:
+        for i in range(g.scheduler_shards):
+            threads.append(run_in(ctx.invoke, scheduler, shard='%d/%d' % (i, g.scheduler_shards),
+                                  **scheduler_config))
+    else:
+        threads.append(run_in(ctx.invoke, scheduler, **scheduler_config))
 
     # running webui in main thread to make it exitable
     webui_config = g.config.get('webui', {})
-    webui_config.setdefault('scheduler_rpc', 'http://localhost:%s/'
-                            % g.config.get('scheduler', {}).get('xmlrpc_port', 23333))
+    webui_config.setdefault('scheduler_rpc', ','.join(
+        'http://localhost:%s/' % (scheduler_config.get('xmlrpc_port', 23333) + i)
+        for i in range(g.scheduler_shards)))
     ctx.invoke(webui, **webui_config)
 
     for each in g.instances:
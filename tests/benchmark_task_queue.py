@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set et sw=4 ts=4 sts=4 ff=unix fenc=utf8:
+# Author: Binux<i@binux.me>
+#         http://binux.me
+# Created on 2014-12-12 20:14:36
+
+"""
+benchmark of scheduler.task_queue.TaskQueue against the Queue.Queue based
+implementation it replaced.
+
+    python tests/benchmark_task_queue.py [num_tasks]
+"""
+
+import gc
+import sys
+import time
+import heapq
+import random
+import Queue
+import threading
+from UserDict import DictMixin
+
+sys.path.insert(0, '.')
+from pyspider.scheduler.task_queue import TaskQueue
+from pyspider.scheduler.token_bucket import Bucket
+
+
+class InQueueTask(DictMixin):
+    __slots__ = ('taskid', 'priority', 'exetime')
+    __getitem__ = lambda *x: getattr(*x)
+    __setitem__ = lambda *x: setattr(*x)
+    keys = lambda self: self.__slots__
+
+    def __init__(self, taskid, priority=0, exetime=0):
+        self.taskid = taskid
+        self.priority = priority
+        self.exetime = exetime
+
+    def __cmp__(self, other):
+        if self.exetime == 0 and other.exetime == 0:
+            return -cmp(self.priority, other.priority)
+        else:
+            return cmp(self.exetime, other.exetime)
+
+
+class LegacyPriorityTaskQueue(Queue.Queue):
+
+    def _init(self, maxsize):
+        self.queue = []
+        self.queue_dict = dict()
+
+    def _qsize(self, len=len):
+        return len(self.queue)
+
+    def _put(self, item, heappush=heapq.heappush):
+        heappush(self.queue, item)
+        self.queue_dict[item.taskid] = item
+
+    def _get(self, heappop=heapq.heappop):
+        item = heappop(self.queue)
+        self.queue_dict.pop(item.taskid, None)
+        return item
+
+    def __contains__(self, taskid):
+        return taskid in self.queue_dict
+
+    def __getitem__(self, taskid):
+        return self.queue_dict[taskid]
+
+
+class LegacyTaskQueue(object):
+    processing_timeout = 10 * 60
+
+    def __init__(self, rate=0, burst=0):
+        self.mutex = threading.Lock()
+        self.priority_queue = LegacyPriorityTaskQueue()
+        self.time_queue = LegacyPriorityTaskQueue()
+        self.processing = LegacyPriorityTaskQueue()
+        self.bucket = Bucket(rate=rate, burst=burst)
+
+    def put(self, taskid, priority=0, exetime=0):
+        now = time.time()
+        self.mutex.acquire()
+        if taskid in self.priority_queue:
+            task = self.priority_queue[taskid]
+            if priority > task.priority:
+                task.priority = priority
+        elif taskid in self.time_queue:
+            task = self.time_queue[taskid]
+            if priority > task.priority:
+                task.priority = priority
+            if exetime < task.exetime:
+                task.exetime = exetime
+        else:
+            task = InQueueTask(taskid, priority)
+            if exetime and exetime > now:
+                task.exetime = exetime
+                self.time_queue.put(task)
+            else:
+                self.priority_queue.put(task)
+        self.mutex.release()
+
+    def get(self):
+        if self.bucket.get() < 1:
+            return None
+        now = time.time()
+        self.mutex.acquire()
+        try:
+            task = self.priority_queue.get_nowait()
+            self.bucket.desc()
+        except Queue.Empty:
+            self.mutex.release()
+            return None
+        task.exetime = now + self.processing_timeout
+        self.processing.put(task)
+        self.mutex.release()
+        return task.taskid
+
+    def done(self, taskid):
+        if taskid in self.processing:
+            self.processing[taskid].taskid = None
+
+    def __len__(self):
+        return self.priority_queue.qsize() + self.time_queue.qsize()
+
+    def __contains__(self, taskid):
+        if taskid in self.priority_queue or taskid in self.time_queue:
+            return True
+        if taskid in self.processing and self.processing[taskid].taskid:
+            return True
+        return False
+
+
+def memory_usage():
+    try:
+        for line in open('/proc/self/status'):
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return 0
+
+
+def benchmark(cls, taskids):
+    gc.collect()
+    mem_start = memory_usage()
+    task_queue = cls(rate=10 ** 9, burst=10 ** 9)
+    result = {}
+
+    start = time.time()
+    for taskid in taskids:
+        task_queue.put(taskid, random.randint(0, 10))
+    result['put'] = time.time() - start
+    result['memory'] = memory_usage() - mem_start
+
+    start = time.time()
+    for taskid in taskids[::10]:
+        taskid in task_queue
+        task_queue.put(taskid, 11)
+    result['contains+bump'] = time.time() - start
+
+    start = time.time()
+    for i in xrange(len(taskids)):
+        taskid = task_queue.get()
+        task_queue.done(taskid)
+    result['get+done'] = time.time() - start
+    assert len(task_queue) == 0
+    return result
+
+
+def run_benchmark(name, cls, num):
+    random.seed(0)
+    taskids = [('%032x' % random.getrandbits(128)).decode('ascii') for _ in xrange(num)]
+    result = benchmark(cls, taskids)
+    print '%-8s put: %.2fs contains+bump: %.2fs get+done: %.2fs memory: %.1fMB' % (
+        name, result['put'], result['contains+bump'], result['get+done'],
+        result['memory'] / 1024.0 / 1024)
+
+
+if __name__ == '__main__':
+    from multiprocessing import Process
+
+    num = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    print '%d tasks' % num
+    # run in subprocess to measure memory separately
+    for name, cls in (('legacy', LegacyTaskQueue), ('current', TaskQueue)):
+        process = Process(target=run_benchmark, args=(name, cls, num))
+        process.start()
+        process.join()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set et sw=4 ts=4 sts=4 ff=unix fenc=utf8:
+# Author: Binux<i@binux.me>
+#         http://binux.me
+# Created on 2014-12-19 18:02:11
+
+import os
+import time
+import shutil
+import unittest2 as unittest
+
+from pyspider.libs.blob_store import BlobStore, open_blob
+
+
+class TestBlobStore(unittest.TestCase):
+
+    path = './data/tests/blobs'
+
+    def setUp(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+        self.store = BlobStore(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def test_10_put(self):
+        handle = self.store.put('hello')
+        self.assertEqual(handle['size'], 5)
+        self.assertEqual(self.store.get(handle['key']), 'hello')
+        self.assertEqual(open_blob(handle)[1:3], 'el')
+        # content addressed
+        self.assertEqual(self.store.put('hello'), handle)
+        self.assertEqual(self.store.get(self.store.put('')['key']), '')
+
+        filename = os.path.join(self.path, 'tmp')
+        with open(filename, 'wb') as fp:
+            fp.write('hello')
+        self.assertEqual(self.store.put_file(filename), handle)
+        self.assertFalse(os.path.exists(filename))
+
+    def test_20_gc(self):
+        old = self.store.put('old')
+        new = self.store.put('new')
+        path = os.path.join(self.path, old['key'][:2], old['key'])
+        os.utime(path, (time.time() - 2 * 86400, time.time() - 2 * 86400))
+        self.assertEqual(self.store.gc(), 1)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(self.store.get(new['key']), 'new')
+
+    def test_30_missing(self):
+        from pyspider.libs.response import rebuild_response
+
+        handle = self.store.put('hello')
+        os.remove(os.path.join(self.path, handle['key'][:2], handle['key']))
+        response = rebuild_response({'status_code': 200, 'content': '', 'content_blob': handle})
+        self.assertIn('content blob missing', response.error)
+        self.assertFalse(response.isok())
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set et sw=4 ts=4 sts=4 ff=unix fenc=utf8:
+# Author: Binux<i@binux.me>
+#         http://binux.me
+# Created on 2014-12-10 22:41:08
+
+import os
+import time
+import shutil
+import unittest2 as unittest
+
+from pyspider.libs.bloomfilter import BloomFilter, ScalableBloomFilter, RotatingBloomFilter
+
+
+class TestBloomFilter(unittest.TestCase):
+
+    def test_10_bloom_filter(self):
+        bloom_filter = BloomFilter(capacity=1000, error_rate=0.001)
+        for i in range(1000):
+            self.assertFalse(bloom_filter.add('key%d' % i))
+        for i in range(1000):
+            self.assertIn('key%d' % i, bloom_filter)
+        self.assertTrue(bloom_filter.add('key1'))
+        self.assertTrue(bloom_filter.full())
+        self.assertEqual(len(bloom_filter), 1000)
+
+        false_positive = sum(1 for i in range(10000) if 'other%d' % i in bloom_filter)
+        self.assertLess(false_positive, 50)
+
+    def test_20_scalable_bloom_filter(self):
+        bloom_filter = ScalableBloomFilter(initial_capacity=100, error_rate=0.001)
+        for i in range(1000):
+            bloom_filter.add(u'中文%d' % i)
+        self.assertGreater(len(bloom_filter.filters), 1)
+        self.assertGreaterEqual(bloom_filter.capacity, 1000)
+        for i in range(1000):
+            self.assertIn(u'中文%d' % i, bloom_filter)
+
+        false_positive = sum(1 for i in range(10000) if 'other%d' % i in bloom_filter)
+        self.assertLess(false_positive, 50)
+
+    def test_30_rotating_bloom_filter(self):
+        bloom_filter = RotatingBloomFilter(period=0.1, initial_capacity=100)
+        self.assertFalse(bloom_filter.add('a'))
+        time.sleep(0.1)
+        self.assertFalse(bloom_filter.add('b'))
+        self.assertIn('a', bloom_filter)
+        time.sleep(0.1)
+        self.assertNotIn('a', bloom_filter)
+        self.assertIn('b', bloom_filter)
+
+    def test_40_dump_and_load(self):
+        shutil.rmtree('./data/tests', ignore_errors=True)
+        os.makedirs('./data/tests')
+        path = './data/tests/bloom'
+        bloom_filter = RotatingBloomFilter(initial_capacity=100)
+        bloom_filter.add('a')
+        self.assertTrue(bloom_filter.dump(path))
+        bloom_filter = RotatingBloomFilter.load(path)
+        self.assertIn('a', bloom_filter)
+        self.assertNotIn('b', bloom_filter)
+        self.assertIsNone(RotatingBloomFilter.load('./data/tests/not_exists'))
+        shutil.rmtree('./data/tests', ignore_errors=True)
@@ -99,6 +99,20 @@ class TaskDBCase(object):
         self.assertIn('track', task)
         self.assertNotIn('project', task)
 
+    def test_26_get_tasks(self):
+        tasks = list(self.taskdb.get_tasks('project', ['taskid', 'taskid1', 'taskid2']))
+        self.assertEqual(len(tasks), 2)
+        self.assertEqual(set(x['taskid'] for x in tasks), set(['taskid', 'taskid2']))
+        self.assertEqual(tasks[0]['schedule'], self.sample_task['schedule'])
+
+        tasks = list(self.taskdb.get_tasks('project', ['taskid2'], fields=['taskid', 'status']))
+        self.assertEqual(len(tasks), 1)
+        self.assertEqual(tasks[0]['status'], self.taskdb.FAILED)
+        self.assertNotIn('project', tasks[0])
+
+        self.assertEqual(list(self.taskdb.get_tasks('project', [])), [])
+        self.assertEqual(list(self.taskdb.get_tasks('not_exists', ['taskid'])), [])
+
     def test_30_status_count(self):
         status = self.taskdb.status_count('abc')
         self.assertEqual(status, {})
@@ -131,6 +145,26 @@ class TaskDBCase(object):
         self.assertEqual(tasks[0]['taskid'], 'taskid')
         self.assertNotIn('project', tasks[0])
 
+    def test_55_insert_many_and_update_many(self):
+        tasks = []
+        for i in range(5):
+            task = dict(self.sample_task)
+            task['taskid'] = 'taskid%d' % i
+            tasks.append(task)
+        self.taskdb.insert_many('many_project', tasks)
+        self.assertEqual(self.taskdb.status_count('many_project'), {self.taskdb.FAILED: 5})
+
+        self.taskdb.update_many('many_project', [
+            {'taskid': 'taskid1', 'status': self.taskdb.SUCCESS},
+            {'taskid': 'taskid2', 'status': self.taskdb.SUCCESS, 'track': {}},
+        ])
+        self.assertEqual(self.taskdb.status_count('many_project'),
+                         {self.taskdb.FAILED: 3, self.taskdb.SUCCESS: 2})
+        task = self.taskdb.get_task('many_project', 'taskid2')
+        self.assertEqual(task['track'], {})
+        self.assertEqual(task['schedule'], self.sample_task['schedule'])
+        self.taskdb.drop('many_project')
+
     def test_60_relist_projects(self):
         if hasattr(self.taskdb, '_list_project'):
             self.taskdb._list_project()
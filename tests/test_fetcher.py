@@ -5,7 +5,9 @@
 #         http://binux.me
 # Created on 2014-02-15 22:10:35
 
+import os
 import time
+import shutil
 import umsgpack
 import xmlrpclib
 import unittest2 as unittest
@@ -99,6 +101,17 @@ class TestFetcher(unittest.TestCase):
         self.assertIn('content', result)
         self.assertEqual(result['content'], 'hello')
 
+    def test_35_queue_latency(self):
+        data = dict(self.sample_task_http)
+        data['url'] = 'data:,hello'
+        start = time.time()
+        for i in range(5):
+            self.inqueue.put(data)
+            task, result = self.outqueue.get()
+            self.assertEqual(result['content'], 'hello')
+        # tasks are fetched as soon as they arrive, not on a 100ms tick
+        self.assertLess(time.time() - start, 0.1)
+
     def test_40_with_rpc(self):
         data = dict(self.sample_task_http)
         data['url'] = 'data:,hello'
@@ -107,6 +120,25 @@ class TestFetcher(unittest.TestCase):
         self.assertIn('content', result)
         self.assertEqual(result['content'], 'hello')
 
+    def test_45_rpc_threads(self):
+        import threading
+
+        data = dict(self.sample_task_http)
+        data['url'] = 'data:,hello'
+        threads = set()
+
+        def on_fetch(type, task):
+            threads.add(threading.current_thread())
+        self.fetcher.on_fetch = on_fetch
+        try:
+            workers = [utils.run_in_thread(self.fetcher.sync_fetch, data) for i in range(5)]
+            for each in workers:
+                each.join()
+        finally:
+            del self.fetcher.on_fetch
+        # fetches from rpc threads are run in ioloop thread
+        self.assertEqual(threads, set([self.thread]))
+
     def test_50_base64_data(self):
         request = dict(self.sample_task_http)
         request['fetch']['method'] = 'POST'
@@ -118,3 +150,295 @@ class TestFetcher(unittest.TestCase):
         self.assertIn(' d0 ', result['content'])
         self.assertIn(' ce ', result['content'])
         self.assertIn(' c4 ', result['content'])
+
+
+class TestFetcherSupervisor(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        from pyspider.fetcher.supervisor import FetcherSupervisor
+
+        self.inqueue = Queue(100)
+        self.outqueue = Queue(100)
+        def new_fetcher(async=True):
+            fetcher = Fetcher(self.inqueue if async else None,
+                              self.outqueue if async else None, async=async)
+            fetcher.user_agent = 'supervised'
+            return fetcher
+        self.supervisor = FetcherSupervisor(new_fetcher, workers=2)
+        self.supervisor.REPORT_INTERVAL = 0.2
+        self.rpc = xmlrpclib.ServerProxy('http://localhost:%d' % 24445)
+        self.xmlrpc_thread = utils.run_in_thread(self.supervisor.xmlrpc_run, port=24445)
+        self.thread = utils.run_in_thread(self.supervisor.run)
+
+    @classmethod
+    def tearDownClass(self):
+        self.rpc._quit()
+        self.thread.join()
+        for process in self.supervisor._processes:
+            assert not process.is_alive()
+
+    def test_10_workers(self):
+        for i in range(20):
+            self.inqueue.put({'taskid': 'taskid%d' % i, 'project': 'project',
+                              'url': 'data:,hello%d' % i})
+        results = [self.outqueue.get(timeout=5) for i in range(20)]
+        self.assertEqual(sorted(x[1]['content'] for x in results),
+                         sorted('hello%d' % i for i in range(20)))
+
+        time.sleep(1)
+        self.assertEqual(self.supervisor.counter('5m', 'sum')['project'][200], 20)
+        self.assertEqual(self.rpc.size(), 0)
+        workers = self.rpc.workers()
+        self.assertEqual(len(workers), 2)
+        self.assertTrue(all(x['alive'] for x in workers))
+
+    def test_20_restart(self):
+        self.supervisor._processes[0].terminate()
+        time.sleep(1)
+        self.assertTrue(self.supervisor._processes[0].is_alive())
+
+    def test_30_sync_fetch(self):
+        result = umsgpack.unpackb(self.rpc.fetch({'url': 'data:,hello'}).data)
+        self.assertEqual(result['content'], 'hello')
+        # built with settings of workers
+        self.assertEqual(self.supervisor._sync_fetcher.user_agent, 'supervised')
+        self.assertFalse(self.supervisor._sync_fetcher.async)
+
+    def test_40_merge_counter(self):
+        from pyspider.fetcher.supervisor import FetcherSupervisor
+
+        supervisor = FetcherSupervisor(None, workers=2)
+        supervisor._reports = {
+            0: {'counter': {('5m', 'avg'): {'project': {'time': 1.0, 200: 2}},
+                            ('5m', 'sum'): {'project': {200: 2}}},
+                'hosts': {'a.com': {'requests': 1, 'reused': 0, 'dns': 0.1, 'connect': 0.1,
+                                    'tls': 0, 'wait': 0.5}}},
+            1: {'counter': {('5m', 'avg'): {'project': {'time': 3.0}},
+                            ('5m', 'sum'): {'project': {200: 3}}},
+                'hosts': {'a.com': {'requests': 3, 'reused': 3, 'dns': 0, 'connect': 0,
+                                    'tls': 0, 'wait': 1.5}}},
+        }
+        self.assertEqual(supervisor.counter('5m', 'avg'), {'project': {'time': 2.0, 200: 2}})
+        self.assertEqual(supervisor.counter('5m', 'sum'), {'project': {200: 5}})
+        stats = supervisor.host_stats()['a.com']
+        self.assertEqual(stats['requests'], 4)
+        self.assertEqual(stats['reused'], 3)
+        self.assertAlmostEqual(stats['wait'], 0.5)
+
+
+class TestFetcherSupervisorCrash(unittest.TestCase):
+
+    def test_give_up(self):
+        from pyspider.fetcher.supervisor import FetcherSupervisor
+
+        def new_fetcher(async=True):
+            raise ImportError('broken')
+        supervisor = FetcherSupervisor(new_fetcher, workers=1)
+        supervisor.REPORT_INTERVAL = 0.1
+        supervisor.RESTART_DELAY = 0.1
+        supervisor.FAST_CRASH_LIMIT = 3
+        thread = utils.run_in_thread(supervisor.run)
+        for i in range(50):
+            if supervisor._crashes[0] > supervisor.FAST_CRASH_LIMIT:
+                break
+            time.sleep(0.1)
+        supervisor.quit()
+        thread.join()
+        self.assertIsNone(supervisor._processes[0])
+        self.assertEqual(supervisor._crashes[0], 4)
+
+
+class TestFetcherBody(unittest.TestCase):
+
+    port = 24446
+
+    @classmethod
+    def setUpClass(self):
+        import SocketServer
+        import BaseHTTPServer
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            # keep-alive
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                size = int(self.path.strip('/'))
+                self.send_response(200)
+                self.send_header('Content-Length', str(size))
+                self.end_headers()
+                for i in range(0, size, 65536):
+                    self.wfile.write('x' * min(65536, size - i))
+
+            def log_message(self, *args):
+                pass
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+            def handle_error(self, request, client_address):
+                # connections aborted by fetcher
+                pass
+
+        self.server = Server(('127.0.0.1', self.port), Handler)
+        self.thread = utils.run_in_thread(self.server.serve_forever)
+        self.fetcher = Fetcher(None, None, async=False)
+
+    @classmethod
+    def tearDownClass(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def fetch(self, size, **kwargs):
+        return self.fetcher.fetch({
+            'taskid': 'taskid',
+            'project': 'project',
+            'url': 'http://127.0.0.1:%d/%d' % (self.port, size),
+            'fetch': kwargs,
+        })[1]
+
+    def test_10_body(self):
+        # no limit by default
+        result = self.fetch(12 * 1024 * 1024)
+        self.assertEqual(result['status_code'], 200)
+        self.assertEqual(len(result['content']), 12 * 1024 * 1024)
+        self.assertNotIn('truncated', result)
+
+    def test_20_truncate(self):
+        result = self.fetch(1000000, max_body_size=1000)
+        self.assertEqual(result['status_code'], 200)
+        self.assertEqual(result['content'], 'x' * 1000)
+        self.assertTrue(result['truncated'])
+        self.assertEqual(self.fetcher._cnt['5m']['project']['truncated'].sum, 1)
+
+        result = self.fetch(1000000, max_body_size=1000, body_overflow='abort')
+        self.assertEqual(result['status_code'], 599)
+        self.assertIn('max_body_size', result['error'])
+
+    def test_25_reserve(self):
+        from pyspider.fetcher.tornado_fetcher import BodyBuffer
+
+        body = BodyBuffer()
+        body.reserve(4000000000)
+        self.assertEqual(len(body.buffer), BodyBuffer.RESERVE_LIMIT)
+        body.write('x' * (BodyBuffer.RESERVE_LIMIT + 10))
+        self.assertEqual(len(body.getvalue()), BodyBuffer.RESERVE_LIMIT + 10)
+
+    def test_30_spill(self):
+        from pyspider.libs.response import rebuild_response
+
+        result = self.fetch(300000, spill_size=100000)
+        self.assertEqual(result['content'], '')
+        path = result['content_file']
+        self.assertTrue(os.path.exists(path))
+        response = rebuild_response(result)
+        self.assertEqual(response.content, 'x' * 300000)
+        self.assertFalse(os.path.exists(path))
+
+    def test_40_blob_store(self):
+        from pyspider.libs.blob_store import BlobStore
+        from pyspider.libs.response import rebuild_response
+
+        shutil.rmtree('./data/tests/blobs', ignore_errors=True)
+        outqueue = Queue(10)
+        fetcher = Fetcher(None, outqueue, async=False)
+        fetcher.blob_store = BlobStore('./data/tests/blobs')
+        for size, kwargs in ((100, {}), (300000, {}), (300000, {'spill_size': 100000})):
+            task = {
+                'taskid': 'taskid',
+                'project': 'project',
+                'url': 'http://127.0.0.1:%d/%d' % (self.port, size),
+                'fetch': kwargs,
+            }
+            fetcher.fetch(task)
+            task, result = outqueue.get()
+            if size > fetcher.blob_threshold:
+                self.assertEqual(result['content'], '')
+                self.assertEqual(result['content_blob']['size'], size)
+                self.assertNotIn('content_file', result)
+            self.assertEqual(result['content_size'], size)
+            response = rebuild_response(result)
+            self.assertEqual(len(response.content_buffer), size)
+            self.assertEqual(response.content, 'x' * size)
+        shutil.rmtree('./data/tests/blobs', ignore_errors=True)
+
+    def test_45_blob_gc(self):
+        import threading
+        from pyspider.libs.blob_store import BlobStore
+
+        fetcher = Fetcher(None, None, async=False)
+        fetcher.blob_store = BlobStore('./data/tests/blobs')
+        started = threading.Event()
+        finish = threading.Event()
+        calls = []
+
+        def slow_gc():
+            calls.append(1)
+            started.set()
+            finish.wait()
+        fetcher.blob_store.gc = slow_gc
+        thread = utils.run_in_thread(fetcher._gc)
+        started.wait()
+        # still running, skipped
+        fetcher._gc()
+        finish.set()
+        thread.join()
+        self.assertEqual(len(calls), 1)
+        fetcher._gc()
+        self.assertEqual(len(calls), 2)
+        shutil.rmtree('./data/tests/blobs', ignore_errors=True)
+
+    def test_46_spill_gc(self):
+        from pyspider.fetcher.tornado_fetcher import BodyBuffer
+
+        spill_dir = './data/tests/spill'
+        shutil.rmtree(spill_dir, ignore_errors=True)
+        os.makedirs(spill_dir)
+        fetcher = Fetcher(None, None, async=False)
+        fetcher.spill_dir = spill_dir
+        for name in ('old', 'new', 'other'):
+            prefix = name == 'other' and 'other-' or BodyBuffer.SPILL_PREFIX
+            with open(os.path.join(spill_dir, prefix + name), 'w') as fp:
+                fp.write(name)
+        old = time.time() - fetcher.SPILL_MAX_AGE - 10
+        for name in (BodyBuffer.SPILL_PREFIX + 'old', 'other-other'):
+            os.utime(os.path.join(spill_dir, name), (old, old))
+        fetcher._gc()
+        self.assertEqual(sorted(os.listdir(spill_dir)),
+                         ['other-other', BodyBuffer.SPILL_PREFIX + 'new'])
+        shutil.rmtree(spill_dir, ignore_errors=True)
+
+    def test_50_connection_reuse(self):
+        from pyspider.fetcher.tornado_fetcher import host_stats
+
+        fetcher = Fetcher(None, None, async=False, max_host_connections=1,
+                          dns_cache_timeout=10)
+        for i in range(3):
+            task, result = fetcher.fetch({
+                'taskid': 'taskid',
+                'project': 'project',
+                'url': 'http://127.0.0.1:%d/%d' % (self.port, 100),
+            })
+            self.assertEqual(result['status_code'], 200)
+            self.assertEqual(set(result['time_info']),
+                             set(['dns', 'connect', 'tls', 'wait', 'reused']))
+            self.assertEqual(result['time_info']['reused'], i > 0)
+
+        self.assertNotIn('_host', fetcher._cnt['5m'].to_dict('sum'))
+        stats = host_stats(fetcher._host_stats.to_dict())
+        host = '127.0.0.1:%d' % self.port
+        self.assertEqual(stats[host]['requests'], 3)
+        self.assertEqual(stats[host]['reused'], 2)
+        self.assertGreaterEqual(stats[host]['wait'], 0)
+        self.assertEqual(fetcher.host_stats(), stats)
+
+    def test_60_host_stats_size(self):
+        from pyspider.fetcher.tornado_fetcher import HostStats
+
+        host_stats = HostStats(size=2)
+        time_info = {'dns': 0.1, 'connect': 0.1, 'tls': 0, 'wait': 0.2, 'reused': False}
+        for host in ('a', 'b', 'a', 'c'):
+            host_stats.event(host, time_info)
+        self.assertEqual(len(host_stats), 2)
+        self.assertEqual(sorted(host_stats.to_dict()), ['a', 'c'])
+        self.assertEqual(host_stats.to_dict()['a']['requests'], 2)
@@ -156,13 +156,46 @@ class TestProjectModule(unittest.TestCase):
         self.assertIn('on_cronjob1', logstr)
         self.assertIn('on_cronjob2', logstr)
 
+        # coalesced ticks of (50, 130]
+        task['fetch']['save'] = {'tick': 130, 'last_tick': 50}
+        fetch_result['save'] = task['fetch']['save']
+        ret = self.instance.run(self.module, task, fetch_result)
+        logstr = ret.logstr()
+        self.assertIn('on_cronjob1', logstr)
+        self.assertIn('on_cronjob2', logstr)
+
+    def test_15_cron_due(self):
+        from pyspider.libs.base_handler import cron_due, every, BaseHandler
+
+        self.assertTrue(cron_due(10, 20))
+        self.assertFalse(cron_due(10, 21))
+        self.assertTrue(cron_due(0.3, 0.9))
+        self.assertFalse(cron_due(0.3, 1.0))
+        self.assertTrue(cron_due(60, 130, 110))
+        self.assertFalse(cron_due(60, 170, 130))
+        self.assertFalse(cron_due(0.3, 1.1, 0.9))
+        self.assertTrue(cron_due(0.3, 1.2, 1.1))
+        self.assertTrue(cron_due(0.1, 1760000000.3))
+        self.assertFalse(cron_due(0.2, 1760000000.3))
+        self.assertTrue(cron_due(0.2, 1760000000.4, 1760000000.3))
+
+        class Handler(BaseHandler):
+            @every(seconds=0.3)
+            def a(self, response):
+                pass
+
+            @every(seconds=0.5)
+            def b(self, response):
+                pass
+        self.assertEqual(Handler.min_tick, 0.1)
+
     def test_20_get_info(self):
         task = {
             'taskid': '_on_get_info',
             'project': self.project,
             'url': 'data:,_on_get_info',
             'fetch': {
-                'save': ['min_tick', ],
+                'save': ['min_tick', 'retry_policy'],
             },
             'process': {
                 'callback': '_on_get_info',
@@ -176,6 +209,7 @@ class TestProjectModule(unittest.TestCase):
         for each in ret.follows:
             self.assertEqual(each['url'], 'data:,on_get_info')
             self.assertEqual(each['fetch']['save']['min_tick'], 10)
+            self.assertIsNone(each['fetch']['save']['retry_policy'])
 
 import shutil
 import inspect
@@ -272,7 +306,7 @@ class TestProcessor(unittest.TestCase):
     def test_40_index_page(self):
         task = None
         while not self.newtask_queue.empty():
-            task = self.newtask_queue.get()
+            task = self.newtask_queue.get()[-1]
         self.assertIsNotNone(task)
 
         fetch_result = {
@@ -292,7 +326,57 @@ class TestProcessor(unittest.TestCase):
         time.sleep(1)
         self.assertFalse(self.status_queue.empty())
         self.assertFalse(self.newtask_queue.empty())
-        task = self.newtask_queue.get()
-        self.assertEqual(task['url'], 'http://binux.me/')
-        task = self.newtask_queue.get()
-        self.assertTrue(task['url'].startswith('http://binux.me/%'), task['url'])
+        # follows of a response are sent in one message
+        tasks = self.newtask_queue.get()
+        self.assertEqual(len(tasks), 2)
+        self.assertEqual(tasks[0]['url'], 'http://binux.me/')
+        self.assertTrue(tasks[1]['url'].startswith('http://binux.me/%'), tasks[1]['url'])
+
+
+class TestProcessorBloomFilter(unittest.TestCase):
+
+    def setUp(self):
+        shutil.rmtree('./data/tests/', ignore_errors=True)
+        os.makedirs('./data/tests/')
+
+    def tearDown(self):
+        shutil.rmtree('./data/tests/', ignore_errors=True)
+
+    def test_follow_seen(self):
+        _projectdb = projectdb.ProjectDB(':memory:')
+        processor = Processor(_projectdb, None, None, None, None, bloom_filter=True,
+                              data_path='./data/tests/')
+        project = {
+            'name': 'test_bloom',
+            'group': 'group',
+            'status': 'RUNNING',
+            'script': inspect.getsource(sample_handler),
+        }
+        processor._update_project(project)
+        task = {'taskid': 'taskid', 'project': 'test_bloom', 'url': 'http://binux.me/'}
+
+        # not seen until sent
+        self.assertFalse(processor._follow_seen(task))
+        self.assertFalse(processor._follow_seen(task))
+        processor._follow_sent([task])
+        self.assertTrue(processor._follow_seen(task))
+        processor._dump_bloom_filters()
+
+        # dumped filter is discarded when script is changed
+        processor._bloom_filters.clear()
+        self.assertTrue(processor._follow_seen(task))
+        processor._update_project(dict(project, script=project['script'] + '\n'))
+        self.assertFalse(processor._follow_seen(task))
+
+        # and removed when project is marked to delete
+        processor._follow_sent([task])
+        processor._dump_bloom_filters()
+        processor._update_project(dict(project, group='group,delete'))
+        self.assertFalse(os.path.exists(processor._bloom_filter_path('test_bloom')))
+        self.assertFalse(processor._follow_seen(task))
+
+        # follows of stopped project are dropped by scheduler, not marked as seen
+        processor._update_project(dict(project, status='STOP'))
+        processor._follow_sent([task])
+        processor._update_project(project)
+        self.assertFalse(processor._follow_seen(task))
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set et sw=4 ts=4 sts=4 ff=unix fenc=utf8:
+# Author: Binux<i@binux.me>
+#         http://binux.me
+# Created on 2014-12-16 10:42:18
+
+import time
+import xmlrpclib
+import threading
+import unittest2 as unittest
+
+from pyspider.libs.rpc import ThreadingXMLRPCServer, post_frames
+from pyspider.libs.utils import run_in_thread
+
+
+class TestThreadingXMLRPCServer(unittest.TestCase):
+
+    port = 23340
+
+    @classmethod
+    def setUpClass(self):
+        self.server = ThreadingXMLRPCServer(('127.0.0.1', self.port), allow_none=True,
+                                            logRequests=False, max_workers=3)
+        self.server.register_function(lambda x: time.sleep(x) or True, 'sleep')
+        self.server.register_function(lambda: 'pong', 'ping')
+        self.server.register_stream(lambda frames: sum(frames), '/sum')
+        self.server.timeout = 0.1
+        self.quit = False
+
+        def run():
+            while not self.quit:
+                self.server.handle_request()
+            self.server.server_close()
+        self.thread = run_in_thread(run)
+
+    @classmethod
+    def tearDownClass(self):
+        self.quit = True
+        self.thread.join(1)
+
+    def rpc(self):
+        return xmlrpclib.ServerProxy('http://127.0.0.1:%d' % self.port)
+
+    def sleep(self, seconds):
+        return self.rpc().sleep(seconds)
+
+    def test_10_concurrent(self):
+        slow = threading.Thread(target=self.sleep, args=(0.5, ))
+        slow.start()
+        time.sleep(0.05)
+        start = time.time()
+        self.assertEqual(self.rpc().ping(), 'pong')
+        self.assertLess(time.time() - start, 0.2)
+        slow.join()
+
+    def test_20_bounded_workers(self):
+        threads = [threading.Thread(target=self.sleep, args=(0.3, )) for _ in range(3)]
+        for each in threads:
+            each.start()
+        time.sleep(0.05)
+        start = time.time()
+        self.assertEqual(self.rpc().ping(), 'pong')
+        self.assertGreater(time.time() - start, 0.2)
+        for each in threads:
+            each.join()
+
+    def test_30_stream(self):
+        self.assertEqual(post_frames('http://127.0.0.1:%d/sum' % self.port, range(10)), 45)
+        with self.assertRaises(Exception):
+            post_frames('http://127.0.0.1:%d/sum' % self.port, ['a', 1])
+
+    def test_40_rpc_stats(self):
+        stats = self.rpc().rpc_stats()
+        self.assertGreaterEqual(stats['ping']['calls'], 2)
+        self.assertGreaterEqual(stats['sleep']['max'], 0.3)
+        self.assertLess(stats['ping']['avg'], 0.1)
+        self.assertIn('/sum', stats)
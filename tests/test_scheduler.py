@@ -53,9 +53,269 @@ class TestTaskQueue(unittest.TestCase):
         self.assertEqual(self.task_queue.get(), None)
 
 
+class TestHostTaskQueue(unittest.TestCase):
+
+    def test_host_concurrency(self):
+        task_queue = TaskQueue(rate=100000, burst=100000)
+        task_queue.update_host('a.com', concurrency=1)
+        task_queue.put('a1', 3, host='a.com')
+        task_queue.put('a2', 2, host='a.com')
+        task_queue.put('b1', 1)
+        self.assertEqual(task_queue.get(), 'a1')
+        self.assertEqual(task_queue.get(), 'b1')
+        self.assertIsNone(task_queue.get())
+        self.assertEqual(len(task_queue), 1)
+        self.assertIn('a2', task_queue)
+        # waiting for processing tasks
+        self.assertGreater(task_queue.wait_time(), 500)
+
+        task_queue.put('a2', 5, host='a.com')
+        self.assertEqual(task_queue.hosts['a.com'].parked['a2'][1], 5)
+        task_queue.done('a1')
+        task_queue.check_update()
+        self.assertEqual(task_queue.get(), 'a2')
+        self.assertEqual(task_queue.hosts['a.com'].processing, 1)
+        task_queue.done('a2')
+        self.assertEqual(task_queue.hosts['a.com'].processing, 0)
+
+    def test_host_rate(self):
+        task_queue = TaskQueue(rate=100000, burst=100000)
+        task_queue.update_host('a.com', rate=10, burst=1)
+        task_queue.put('a1', 0, host='a.com')
+        task_queue.put('a2', 0, host='a.com')
+        self.assertEqual(task_queue.get(), 'a1')
+        self.assertIsNone(task_queue.get())
+        self.assertAlmostEqual(task_queue.wait_time(), 0.1, delta=0.02)
+        time.sleep(0.11)
+        task_queue.check_update()
+        self.assertEqual(task_queue.get(), 'a2')
+
+    def test_host_update_journal(self):
+        task_queue = TaskQueue(rate=100000, burst=100000)
+        records = []
+        task_queue._journal_write = records.append
+        for i in range(3):
+            task_queue.update_host('a.com', rate=10, burst=1)
+        task_queue.update_host('a.com', rate=5, burst=1)
+        self.assertEqual(records, [('host', 'a.com', 10, 1, 0), ('host', 'a.com', 5, 1, 0)])
+        self.assertEqual(task_queue.hosts['a.com'].bucket.rate, 5)
+
+
+from pyspider.scheduler.task_queue import PriorityTaskQueue, TimeTaskQueue
+
+
+class TestPriorityTaskQueue(unittest.TestCase):
+
+    def test_priority_queue(self):
+        queue = PriorityTaskQueue()
+        queue.put('a1', 1)
+        queue.put('a2', 2)
+        queue.put('a3', 3)
+        queue.put(u'a0', 0)
+        self.assertEqual(len(queue), 4)
+        self.assertIn('a0', queue)
+
+        # priority bump and lazy deletion
+        queue.put('a1', 5)
+        queue.put('a3', 0)
+        self.assertTrue(queue.remove('a2'))
+        self.assertFalse(queue.remove('a2'))
+        self.assertEqual(len(queue), 3)
+        self.assertEqual(queue.top, ('a1', 5, 0))
+        self.assertEqual(queue.get()[0], 'a1')
+        self.assertEqual(queue.get()[0], 'a3')
+        self.assertEqual(queue.get()[0], 'a0')
+        self.assertIsNone(queue.get())
+        self.assertEqual(len(queue), 0)
+
+    def test_time_queue(self):
+        queue = TimeTaskQueue()
+        for i in range(3000):
+            queue.put('a%d' % i, 0, 3000 - i)
+        for i in range(3000):
+            queue.put('a%d' % i, 0, 1)
+        self.assertEqual(len(queue), 3000)
+        self.assertLess(len(queue.queue), 6000)
+        queue.put('b', 0, 0)
+        self.assertEqual(queue.get(), ('b', 0, 0))
+        self.assertEqual(queue.get()[2], 1)
+
+
+class TestSpillTaskQueue(unittest.TestCase):
+
+    def setUp(self):
+        shutil.rmtree('./data/tests', ignore_errors=True)
+        os.makedirs('./data/tests')
+
+    def tearDown(self):
+        shutil.rmtree('./data/tests', ignore_errors=True)
+
+    def test_spill(self):
+        path = './data/tests/task_queue.db'
+        task_queue = TaskQueue(rate=100000, burst=100000, memory_limit=10, spill_path=path)
+        task_queue.refill_batch = 5
+        for i in range(30):
+            task_queue.put('a%d' % i, i % 10)
+        task_queue.put('b1', 100, time.time() + 0.1)
+        task_queue.put('b2', 100)
+        task_queue.put(u'a20', 50)
+        self.assertEqual(len(task_queue.priority_queue), 10)
+        self.assertEqual(len(task_queue), 32)
+        self.assertIn('a25', task_queue)
+        self.assertTrue(os.path.exists(path))
+
+        result = []
+        while True:
+            taskid = task_queue.get()
+            if taskid is None:
+                break
+            result.append(taskid)
+        self.assertEqual(result[:2], ['b2', 'a20'])
+        self.assertEqual(len(result), 31)
+        self.assertEqual(len(task_queue), 1)
+        priority = [task_queue.processing[x][1] for x in result]
+        self.assertEqual(priority[2:], sorted(priority[2:], reverse=True))
+
+        time.sleep(0.1)
+        task_queue.check_update()
+        self.assertEqual(task_queue.get(), 'b1')
+        self.assertEqual(len(task_queue), 0)
+
+        task_queue.close()
+        self.assertFalse(os.path.exists(path))
+
+    def test_spill_memory_limit(self):
+        task_queue = TaskQueue(rate=100000, burst=100000, memory_limit=10,
+                               spill_path='./data/tests/task_queue.db')
+        in_memory = lambda: len(task_queue.priority_queue) + len(task_queue.time_queue)
+        for i in range(10):
+            task_queue.put('delayed%d' % i, 0, time.time() + 60)
+        for i in range(20):
+            task_queue.put('ready%d' % i, i)
+        self.assertEqual(len(task_queue.disk_queue), 20)
+
+        # delayed tasks are swapped out for ready ones
+        self.assertEqual(task_queue.get(), 'ready19')
+        self.assertLessEqual(in_memory(), 10)
+
+        # higher priority tasks on disk are swapped with the lowest in memory
+        for i in range(5):
+            task_queue.put('high%d' % i, 100)
+        task_queue.check_update()
+        self.assertLessEqual(in_memory(), 10)
+        for i in range(10):
+            task_queue.check_update()
+            self.assertLessEqual(in_memory(), 10)
+        self.assertEqual(len(task_queue), 34)
+        self.assertTrue(task_queue.get().startswith('high'))
+        task_queue.close()
+
+
 from pyspider.scheduler.token_bucket import Bucket
 
 
+class TestSnapshotTaskQueue(unittest.TestCase):
+
+    def setUp(self):
+        shutil.rmtree('./data/tests', ignore_errors=True)
+        os.makedirs('./data/tests')
+
+    def tearDown(self):
+        shutil.rmtree('./data/tests', ignore_errors=True)
+
+    def test_snapshot(self):
+        snapshot = './data/tests/task_queue.snapshot'
+        journal = './data/tests/task_queue.journal'
+        task_queue = TaskQueue(rate=100000, burst=100000, memory_limit=5,
+                               spill_path='./data/tests/task_queue.db')
+        task_queue.update_host('a.com', concurrency=1)
+        for i in range(10):
+            task_queue.put('a%d' % i, i)
+        task_queue.put('b1', 100, time.time() + 60)
+        task_queue.put('h1', 50, host='a.com')
+        task_queue.put('h2', 40, host='a.com')
+        self.assertEqual(task_queue.get(), 'h1')
+        self.assertEqual(task_queue.snapshot(snapshot, journal), 12)
+
+        # changes after snapshot are in journal
+        self.assertEqual(task_queue.get(), 'a9')
+        self.assertEqual(task_queue.get(), 'a8')
+        task_queue.done('a9')
+        task_queue.put('c1', 10)
+        task_queue.put('a0', 20)
+        task_queue.check_update()
+        # partially written record
+        with open(journal, 'ab') as fp:
+            fp.write('\x80\x02(U')
+        task_queue.close()
+
+        restored = TaskQueue(rate=100000, burst=100000, memory_limit=5,
+                             spill_path='./data/tests/task_queue.db')
+        self.assertTrue(restored.restore(snapshot, journal))
+        self.assertEqual(len(restored), 11)
+        self.assertIn('b1', restored)
+        self.assertIn('a8', restored)
+        self.assertIn('h1', restored)
+        self.assertIn('a9', restored.processing_done)
+        self.assertEqual(restored.hosts['a.com'].processing, 1)
+        self.assertEqual(restored.get(), 'a0')
+        self.assertEqual(restored.get(), 'c1')
+        # h2 is parked while h1 is processing
+        self.assertEqual(restored.get(), 'a7')
+        restored.done('h1')
+        restored.check_update()
+        self.assertEqual(restored.get(), 'h2')
+        restored.close()
+
+        # journal is appendable after tail truncated
+        restored = TaskQueue(rate=100000, burst=100000)
+        self.assertTrue(restored.restore(snapshot, journal))
+        self.assertNotIn('c1', restored.priority_queue)
+        self.assertIn('c1', restored.processing)
+        restored.close()
+
+        with open(snapshot, 'wb') as fp:
+            fp.write('broken')
+        self.assertFalse(TaskQueue().restore(snapshot, journal))
+        self.assertFalse(TaskQueue().restore('./data/tests/not_exists', journal))
+
+
+class TestActiveTasks(unittest.TestCase):
+
+    def test_active_tasks(self):
+        from pyspider.scheduler.active_tasks import ActiveTasks
+
+        active_tasks = ActiveTasks(size=10)
+        active_tasks.add_project('a', 3)
+        active_tasks.add_project('b', 3)
+        active_tasks.add({'taskid': 'x', 'project': 'c'}, 1)
+        for i in range(12):
+            task = {'taskid': 't%d' % i, 'project': 'ab'[i % 2], 'url': 'url', 'track': {}}
+            active_tasks.add(task, i + 1)
+            task['url'] = 'changed'
+            task['track']['fetch'] = {}
+        self.assertEqual(len(active_tasks), 10)
+
+        result = active_tasks.get(limit=5)
+        self.assertEqual([x[0] for x in result], [12, 11, 10, 9, 8])
+        self.assertEqual(result[0][1], {'taskid': 't11', 'project': 'b', 'url': 'url',
+                                        'track': {}})
+        result[0][1]['url'] = 'changed'
+        self.assertEqual(active_tasks.get(limit=1)[0][1]['url'], 'url')
+
+        self.assertEqual([x[1]['taskid'] for x in active_tasks.get('a')],
+                         ['t10', 't8', 't6'])
+        self.assertEqual([x[0] for x in active_tasks.get(since=9)], [12, 11, 10])
+        self.assertEqual([x[0] for x in active_tasks.get('b', since=9)], [12, 10])
+        self.assertEqual(active_tasks.get(since=12), [])
+
+        active_tasks.add_project('a', 5)
+        self.assertEqual(len(active_tasks.get('a')), 3)
+        active_tasks.drop_project('a')
+        self.assertEqual([x[0] for x in active_tasks.get(limit=3)], [12, 10, 8])
+        self.assertEqual(active_tasks.get('a'), [])
+
+
 class TestBucket(unittest.TestCase):
 
     def test_bucket(self):
@@ -64,13 +324,70 @@ class TestBucket(unittest.TestCase):
         time.sleep(0.1)
         self.assertEqual(bucket.get(), 1000)
         bucket.desc(100)
-        self.assertEqual(bucket.get(), 900)
+        self.assertAlmostEqual(bucket.get(), 900, delta=1)
         time.sleep(0.1)
         self.assertAlmostEqual(bucket.get(), 910, delta=2)
         time.sleep(0.1)
         self.assertAlmostEqual(bucket.get(), 920, delta=2)
 
+    def test_acquire(self):
+        bucket = Bucket(1000, 10)
+        self.assertEqual(bucket.acquire(4), 4)
+        self.assertEqual(bucket.acquire(100), 6)
+        self.assertEqual(bucket.acquire(), 0)
+        bucket.release(2)
+        self.assertEqual(bucket.acquire(5), 2)
+
+        # fractions of token are not lost between calls
+        bucket = Bucket(100, 100)
+        bucket.set(0)
+        got = 0
+        start = time.time()
+        while time.time() - start < 0.5:
+            got += bucket.acquire(100)
+            time.sleep(0.001)
+        self.assertAlmostEqual(got, 50, delta=3)
+
+    def test_get_many(self):
+        task_queue = TaskQueue(rate=1, burst=5)
+        task_queue.update_host('a.com', concurrency=1)
+        for i in range(3):
+            task_queue.put('a%d' % i, i)
+        task_queue.put('h1', 10, host='a.com')
+        task_queue.put('h2', 9, host='a.com')
+        self.assertEqual(task_queue.get_many(10), ['h1', 'a2', 'a1', 'a0'])
+        self.assertEqual(len(task_queue), 1)
+        # token of parked task is given back
+        self.assertAlmostEqual(task_queue.bucket.get(), 1, delta=0.1)
+        self.assertEqual(task_queue.get_many(10), [])
+        task_queue.done('h1')
+        task_queue.check_update()
+        self.assertEqual(task_queue.get_many(10), ['h2'])
+
+    def test_wait_time(self):
+        bucket = Bucket(10, 1)
+        self.assertEqual(bucket.wait_time(), 0)
+        bucket.desc()
+        self.assertAlmostEqual(bucket.wait_time(), 0.1, delta=0.01)
+        self.assertEqual(Bucket(0, 0).wait_time(), float('inf'))
+        self.assertAlmostEqual(bucket.wait_time(1), 0.1, delta=0.01)
+        self.assertEqual(bucket.wait_time(2), float('inf'))
+        bucket = Bucket(10, 10)
+        bucket.set(0)
+        self.assertAlmostEqual(bucket.wait_time(5), 0.5, delta=0.01)
+        self.assertAlmostEqual(bucket.next_time(5), time.time() + 0.5, delta=0.01)
 
+        task_queue = TaskQueue(rate=10, burst=1)
+        self.assertEqual(task_queue.wait_time(), float('inf'))
+        task_queue.put('a1', 0, time.time() + 0.5)
+        self.assertAlmostEqual(task_queue.wait_time(), 0.5, delta=0.01)
+        task_queue.put('a2', 0)
+        self.assertEqual(task_queue.wait_time(), 0)
+        self.assertEqual(task_queue.get(), 'a2')
+        self.assertAlmostEqual(task_queue.wait_time(), 0.5, delta=0.01)
+
+
+import heapq
 import xmlrpclib
 from multiprocessing import Queue
 from pyspider.scheduler.scheduler import Scheduler
@@ -78,6 +395,566 @@ from pyspider.database.sqlite import taskdb, projectdb, resultdb
 from pyspider.libs.utils import run_in_thread
 
 
+class TestSchedulerLoading(unittest.TestCase):
+
+    def setUp(self):
+        shutil.rmtree('./data/tests', ignore_errors=True)
+        os.makedirs('./data/tests')
+
+    def tearDown(self):
+        shutil.rmtree('./data/tests', ignore_errors=True)
+
+    def test_loading(self):
+        _taskdb = taskdb.TaskDB('./data/tests/task.db')
+        _projectdb = projectdb.ProjectDB('./data/tests/project.db')
+        _projectdb.insert('test_project', {
+            'name': 'test_project',
+            'group': 'group',
+            'status': 'RUNNING',
+            'script': '',
+            'rate': 1.0,
+            'burst': 10,
+        })
+        tasks = [{'taskid': 'a%d' % i, 'project': 'test_project', 'url': 'url',
+                  'status': _taskdb.ACTIVE, 'schedule': {'priority': i}}
+                 for i in range(250)]
+        tasks.append({'taskid': 'b1', 'project': 'test_project', 'url': 'url',
+                      'status': _taskdb.SUCCESS, 'lastcrawltime': 1})
+        _taskdb.insert_many('test_project', tasks)
+
+        scheduler = Scheduler(taskdb=_taskdb, projectdb=_projectdb,
+                              newtask_queue=Queue(10), status_queue=Queue(10),
+                              out_queue=Queue(10), data_path='./data/tests/')
+        scheduler.LOAD_PAGE_SIZE = 100
+        scheduler._load_projects()
+        self.assertIn('test_project', scheduler.task_queue)
+        self.assertIn('test_project', scheduler.loading_progress())
+        self.assertEqual(scheduler.loading_progress()['test_project']['total'], 250)
+
+        # changed while loading
+        scheduler.update_task({'taskid': 'a0', 'project': 'test_project',
+                               'status': _taskdb.SUCCESS, 'lastcrawltime': time.time()})
+
+        for i in range(50):
+            scheduler._check_loading()
+            if not scheduler._loading:
+                break
+            time.sleep(0.1)
+        self.assertEqual(scheduler.loading_progress(), {})
+        self.assertEqual(len(scheduler.task_queue['test_project']), 249)
+        self.assertNotIn('a0', scheduler.task_queue['test_project'])
+        known_tasks = scheduler.known_tasks['test_project']
+        self.assertEqual(len(known_tasks), 251)
+        self.assertEqual(known_tasks[scheduler._task_digest('a0')][0], _taskdb.SUCCESS)
+        self.assertEqual(known_tasks[scheduler._task_digest('b1')], (_taskdb.SUCCESS, 1))
+
+        # warm restart from snapshot written after loading
+        scheduler.task_queue['test_project'].bucket.set(10)
+        self.assertEqual(scheduler.task_queue['test_project'].get(), 'a249')
+        scheduler.task_queue['test_project'].check_update()
+        scheduler.task_queue['test_project'].close()
+        scheduler._flush_tasks()
+
+        scheduler = Scheduler(taskdb=_taskdb, projectdb=_projectdb,
+                              newtask_queue=Queue(10), status_queue=Queue(10),
+                              out_queue=Queue(10), data_path='./data/tests/')
+        scheduler._load_projects()
+        task_queue = scheduler.task_queue['test_project']
+        self.assertEqual(len(task_queue), 248)
+        self.assertIn('a249', task_queue.processing)
+        task_queue.bucket.set(10)
+        self.assertEqual(task_queue.get(), 'a248')
+        for i in range(50):
+            scheduler._check_loading()
+            if not scheduler._loading:
+                break
+            time.sleep(0.1)
+        self.assertEqual(len(scheduler.known_tasks['test_project']), 251)
+        self.assertEqual(len(task_queue), 247)
+
+        # tasks added to taskdb by others are not in the stale snapshot
+        scheduler._snapshot('test_project')
+        task_queue.close()
+        _taskdb.insert_many('test_project', [{
+            'taskid': 'c%d' % i, 'project': 'test_project', 'url': 'url',
+            'status': _taskdb.ACTIVE} for i in range(3)])
+        scheduler = Scheduler(taskdb=_taskdb, projectdb=_projectdb,
+                              newtask_queue=Queue(10), status_queue=Queue(10),
+                              out_queue=Queue(10), data_path='./data/tests/')
+        scheduler._load_projects()
+        task_queue = scheduler.task_queue['test_project']
+        self.assertEqual(len(task_queue), 247)
+        for i in range(50):
+            scheduler._check_loading()
+            if not scheduler._loading:
+                break
+            time.sleep(0.1)
+        self.assertEqual(len(task_queue), 250)
+        self.assertIn('c0', task_queue)
+        self.assertIn('a248', task_queue.processing)
+
+        # snapshot is removed when project stopped
+        scheduler._drop_task_queue('test_project')
+        self.assertFalse(os.path.exists('./data/tests/task_queue.test_project.snapshot'))
+
+    def test_loading_failed(self):
+        _taskdb = taskdb.TaskDB('./data/tests/task.db')
+        _projectdb = projectdb.ProjectDB('./data/tests/project.db')
+        _projectdb.insert('test_project', {
+            'name': 'test_project',
+            'group': 'group',
+            'status': 'RUNNING',
+            'script': '',
+            'rate': 1.0,
+            'burst': 10,
+        })
+        _taskdb.insert_many('test_project', [{
+            'taskid': 'a%d' % i, 'project': 'test_project', 'url': 'url',
+            'status': _taskdb.ACTIVE} for i in range(250)])
+
+        failures = [1]
+
+        def copy():
+            copied = taskdb.TaskDB('./data/tests/task.db')
+            load_tasks = copied.load_tasks
+
+            def broken_load_tasks(*args, **kwargs):
+                for i, task in enumerate(load_tasks(*args, **kwargs)):
+                    if i == 150 and failures:
+                        failures.pop()
+                        raise Exception('lost connection')
+                    yield task
+            copied.load_tasks = broken_load_tasks
+            return copied
+        _taskdb.copy = copy
+
+        scheduler = Scheduler(taskdb=_taskdb, projectdb=_projectdb,
+                              newtask_queue=Queue(10), status_queue=Queue(10),
+                              out_queue=Queue(10), data_path='./data/tests/')
+        scheduler.LOAD_PAGE_SIZE = 100
+        scheduler.LOAD_RETRY_INTERVAL = 0.1
+        scheduler._load_projects()
+        for i in range(50):
+            scheduler._check_loading()
+            if not scheduler._loading:
+                break
+            time.sleep(0.1)
+        self.assertEqual(scheduler.loading_progress(), {})
+        self.assertEqual(len(scheduler.task_queue['test_project']), 250)
+        self.assertEqual(len(scheduler.known_tasks['test_project']), 250)
+
+    def test_known_tasks_limit(self):
+        _taskdb = taskdb.TaskDB('./data/tests/task.db')
+        _projectdb = projectdb.ProjectDB('./data/tests/project.db')
+        for project in ('p1', 'p2'):
+            _projectdb.insert(project, {
+                'name': project,
+                'group': 'group',
+                'status': 'RUNNING',
+                'script': '',
+                'rate': 1.0,
+                'burst': 10,
+            })
+        _taskdb.insert_many('p1', [{'taskid': 'a%d' % i, 'project': 'p1', 'url': 'url',
+                                    'status': _taskdb.ACTIVE} for i in range(150)])
+        _taskdb.insert_many('p2', [{'taskid': 'a%d' % i, 'project': 'p2', 'url': 'url',
+                                    'status': _taskdb.ACTIVE} for i in range(100)])
+
+        scheduler = Scheduler(taskdb=_taskdb, projectdb=_projectdb,
+                              newtask_queue=Queue(10), status_queue=Queue(10),
+                              out_queue=Queue(10), data_path='./data/tests/')
+        scheduler.KNOWN_TASKS_LIMIT = 100
+        scheduler._load_projects()
+        for i in range(50):
+            scheduler._check_loading()
+            if not scheduler._loading:
+                break
+            time.sleep(0.1)
+        self.assertEqual(len(scheduler.task_queue['p1']), 150)
+        self.assertNotIn('p1', scheduler.known_tasks)
+        self.assertEqual(len(scheduler.known_tasks['p2']), 100)
+
+        scheduler.insert_task({'taskid': 'b', 'project': 'p2', 'url': 'url'})
+        self.assertNotIn('p2', scheduler.known_tasks)
+
+
+class TestSchedulerCronjob(unittest.TestCase):
+
+    def test_cronjob(self):
+        scheduler = Scheduler(taskdb=taskdb.TaskDB(':memory:'), projectdb=None,
+                              newtask_queue=Queue(10),
+                              status_queue=Queue(10), out_queue=Queue(10),
+                              data_path='./data/tests/')
+        sent = []
+        scheduler.send_task = sent.append
+        for name, min_tick in (('a', 0.2), ('b', 60), ('c', 0)):
+            scheduler.projects[name] = {'name': name, 'status': 'RUNNING',
+                                        'min_tick': min_tick}
+            scheduler._update_cronjob(name)
+        self.assertEqual(sorted(scheduler._cron_jobs), ['a', 'b'])
+        self.assertLessEqual(scheduler._loop_timeout(), 0.2)
+
+        time.sleep(0.25)
+        self.assertEqual(scheduler._check_cronjob(), 1)
+        self.assertEqual(sent[0]['project'], 'a')
+        tick = sent[0]['fetch']['save']['tick']
+        self.assertAlmostEqual(round(tick / 0.2), tick / 0.2, delta=1e-3)
+        self.assertNotIn('last_tick', sent[0]['fetch']['save'])
+        self.assertEqual(scheduler._check_cronjob(), 0)
+
+        # stall of 5 ticks is coalesced
+        time.sleep(1)
+        self.assertEqual(scheduler._check_cronjob(), 1)
+        save = sent[1]['fetch']['save']
+        self.assertEqual(save['last_tick'], tick)
+        self.assertAlmostEqual(save['tick'] - tick, 1, delta=0.21)
+
+        # b is due
+        min_tick, next_tick, last_tick = scheduler._cron_jobs['b']
+        scheduler._cron_jobs['b'] = (min_tick, next_tick - 60, last_tick)
+        heapq.heappush(scheduler._cron_heap, (next_tick - 60, 'b'))
+        self.assertEqual(scheduler._check_cronjob(), 1)
+        self.assertEqual(sent[2]['project'], 'b')
+        self.assertEqual(sent[2]['fetch']['save']['tick'] % 60, 0)
+
+        scheduler.projects['a']['status'] = 'STOP'
+        scheduler._update_cronjob('a')
+        time.sleep(0.2)
+        self.assertEqual(scheduler._check_cronjob(), 0)
+
+
+class TestRetryPolicy(unittest.TestCase):
+
+    def track(self, status_code=None, exception_type=None):
+        return {
+            'fetch': {'ok': not status_code, 'status_code': status_code},
+            'process': {'ok': not exception_type, 'exception_type': exception_type},
+        }
+
+    def test_10_policy(self):
+        from pyspider.scheduler.retry_policy import RetryPolicy
+
+        policy = RetryPolicy({'jitter': 0})
+        self.assertEqual(policy.next_retry(self.track(exception_type='KeyError'), 0, 3),
+                         ('default', 0))
+        self.assertEqual(policy.next_retry(self.track(exception_type='KeyError'), 2, 3),
+                         ('default', 24 * 60 * 60))
+        self.assertEqual(policy.next_retry(self.track(599), 1, 3), ('599', 60))
+        self.assertEqual(policy.next_retry(self.track(503), 2, 3), ('5xx', 20 * 60))
+        self.assertEqual(policy.next_retry(self.track(404), 0, 3), ('404', None))
+        self.assertEqual(policy.next_retry(self.track(599), 3, 3), ('599', None))
+
+        # default class keeps delays of before: 0, 1h, 24h, 48h, 96h without jitter
+        policy = RetryPolicy()
+        track = self.track(exception_type='KeyError')
+        self.assertEqual([policy.next_retry(track, i, 5)[1] for i in range(5)],
+                         [0, 60 * 60, 24 * 60 * 60, 48 * 60 * 60, 96 * 60 * 60])
+
+        policy = RetryPolicy({
+            'no_retry': [403],
+            'classes': {503: {'retries': 1}, 'KeyError': {'first_delay': 10}},
+        })
+        self.assertEqual(policy.next_retry(self.track(404), 0, 3)[0], 'default')
+        self.assertEqual(policy.next_retry(self.track(403), 0, 3), ('403', None))
+        self.assertEqual(policy.next_retry(self.track(503), 1, 3), ('503', None))
+        cls, delay = policy.next_retry(self.track(exception_type='KeyError'), 0, 3)
+        self.assertEqual(cls, 'KeyError')
+        self.assertAlmostEqual(delay, 10, delta=1)
+
+    def test_20_scheduler(self):
+        scheduler = Scheduler(taskdb=taskdb.TaskDB(':memory:'), projectdb=None,
+                              newtask_queue=Queue(10),
+                              status_queue=Queue(10), out_queue=Queue(10),
+                              data_path='./data/tests/')
+        scheduler.projects['a'] = {'name': 'a', 'status': 'RUNNING', 'retry_policy': {
+            'circuit_breaker': {'threshold': 2, 'cooldown': 60},
+        }}
+        scheduler.task_queue['a'] = TaskQueue()
+        scheduler.put_task = lambda task: None
+        for i in range(3):
+            scheduler.taskdb.insert('a', 'task%d' % i, {
+                'taskid': 'task%d' % i, 'project': 'a', 'url': 'http://a.com/%d' % i,
+                'status': 1, 'schedule': {},
+            })
+
+        def fail(i, status_code):
+            return scheduler.on_task_failed({
+                'taskid': 'task%d' % i, 'project': 'a', 'url': 'http://a.com/%d' % i,
+                'track': self.track(status_code),
+            })
+
+        self.assertEqual(fail(0, 404)['status'], scheduler.taskdb.FAILED)
+        task = fail(1, 599)
+        self.assertLess(task['schedule']['exetime'], time.time() + 60)
+        # second failure of host opens the breaker
+        task = fail(2, 599)
+        self.assertGreater(task['schedule']['exetime'], time.time() + 50)
+        self.assertTrue(scheduler._breakers[('a', 'a.com')].is_open())
+        self.assertEqual(scheduler._cnt['1h']['a']['retry_by']['599'].sum, 2)
+        self.assertEqual(scheduler._cnt['1h']['a']['no_retry']['404'].sum, 1)
+
+        scheduler.on_task_done({'taskid': 'task1', 'project': 'a',
+                                'url': 'http://a.com/1'})
+        self.assertNotIn(('a', 'a.com'), scheduler._breakers)
+
+    def test_30_breakers_limit(self):
+        scheduler = Scheduler(taskdb=taskdb.TaskDB(':memory:'), projectdb=None,
+                              newtask_queue=Queue(10),
+                              status_queue=Queue(10), out_queue=Queue(10),
+                              data_path='./data/tests/')
+        scheduler.BREAKERS_LIMIT = 2
+        scheduler.projects['a'] = {'name': 'a', 'status': 'RUNNING'}
+        scheduler.task_queue['a'] = TaskQueue()
+        scheduler.put_task = lambda task: None
+        for i in range(3):
+            scheduler.taskdb.insert('a', 'task%d' % i, {
+                'taskid': 'task%d' % i, 'project': 'a', 'url': 'http://%d.com/' % i,
+                'status': 1, 'schedule': {},
+            })
+            scheduler.on_task_failed({
+                'taskid': 'task%d' % i, 'project': 'a', 'url': 'http://%d.com/' % i,
+                'track': self.track(599),
+            })
+        # least recently failed host is dropped
+        self.assertEqual(scheduler._breakers.keys(), [('a', '1.com'), ('a', '2.com')])
+
+        scheduler._breakers[('a', '1.com')].last_failure -= 10 * 60
+        scheduler._check_breakers()
+        self.assertEqual(scheduler._breakers.keys(), [('a', '2.com')])
+
+
+class TestSchedulerIngest(unittest.TestCase):
+
+    def setUp(self):
+        shutil.rmtree('./data/tests', ignore_errors=True)
+        os.makedirs('./data/tests')
+
+    def tearDown(self):
+        shutil.rmtree('./data/tests', ignore_errors=True)
+
+    def test_ingest(self):
+        from pyspider.libs.rpc import post_frames
+
+        _taskdb = taskdb.TaskDB('./data/tests/task.db')
+        _projectdb = projectdb.ProjectDB('./data/tests/project.db')
+        _projectdb.insert('test_project', {
+            'name': 'test_project',
+            'group': 'group',
+            'status': 'RUNNING',
+            'script': '',
+            'rate': 1.0,
+            'burst': 10,
+        })
+        _taskdb.insert('test_project', 'old', {
+            'taskid': 'old', 'project': 'test_project', 'url': 'url',
+            'status': _taskdb.SUCCESS, 'lastcrawltime': time.time(),
+            'schedule': {'age': 0}})
+        scheduler = Scheduler(taskdb=_taskdb, projectdb=_projectdb,
+                              newtask_queue=Queue(10), status_queue=Queue(10),
+                              out_queue=Queue(10), data_path='./data/tests/')
+        scheduler._load_projects()
+        for i in range(50):
+            scheduler._check_loading()
+            if not scheduler._loading:
+                break
+            time.sleep(0.1)
+
+        run_in_thread(scheduler.xmlrpc_run, port=23334)
+        time.sleep(0.2)
+        try:
+            batches = [[{'taskid': 'a%d' % (i * 100 + j), 'project': 'test_project',
+                         'url': 'url'} for j in range(100)] for i in range(5)]
+            batches.append([{'taskid': 'old', 'project': 'test_project', 'url': 'url',
+                             'schedule': {'age': 0}}, {'taskid': 'x'}])
+            self.assertEqual(post_frames('http://localhost:23334/ingest', batches),
+                             {'accepted': 501, 'total': 502})
+            rpc = xmlrpclib.ServerProxy('http://localhost:23334')
+            self.assertEqual(rpc.newtasks([{'taskid': 'a0', 'project': 'test_project',
+                                            'url': 'url'}]), 1)
+        finally:
+            scheduler.quit()
+
+        self.assertEqual(scheduler._check_request(), 502)
+        self.assertEqual(len(scheduler.task_queue['test_project']), 501)
+        scheduler._flush_tasks()
+        self.assertEqual(_taskdb.status_count('test_project'),
+                         {_taskdb.ACTIVE: 501})
+
+
+class TestSchedulerFlush(unittest.TestCase):
+
+    def setUp(self):
+        shutil.rmtree('./data/tests', ignore_errors=True)
+        os.makedirs('./data/tests')
+
+    def tearDown(self):
+        shutil.rmtree('./data/tests', ignore_errors=True)
+
+    def test_flush_failed(self):
+        _taskdb = taskdb.TaskDB('./data/tests/task.db')
+        scheduler = Scheduler(taskdb=_taskdb,
+                              projectdb=projectdb.ProjectDB('./data/tests/project.db'),
+                              newtask_queue=Queue(10), status_queue=Queue(10),
+                              out_queue=Queue(10), data_path='./data/tests/')
+        insert_many = _taskdb.insert_many
+
+        def gone_away(project, tasks):
+            raise Exception('database gone away')
+        _taskdb.insert_many = gone_away
+        scheduler.insert_task({'taskid': 'a', 'project': 'p1', 'url': 'url',
+                               'status': _taskdb.ACTIVE})
+        scheduler.insert_task({'taskid': 'b', 'project': 'p1', 'url': 'url',
+                               'status': _taskdb.ACTIVE})
+        scheduler._flush_tasks()
+        self.assertEqual(len(scheduler._write_buffer), 2)
+
+        # newer update is merged into the unwritten insert
+        scheduler.update_task({'taskid': 'a', 'project': 'p1', 'status': _taskdb.SUCCESS})
+        _taskdb.insert_many = insert_many
+        scheduler._flush_tasks()
+        self.assertEqual(len(scheduler._write_buffer), 0)
+        self.assertEqual(_taskdb.get_task('p1', 'a')['status'], _taskdb.SUCCESS)
+        self.assertEqual(_taskdb.get_task('p1', 'b')['status'], _taskdb.ACTIVE)
+
+    def test_flush_rejected_task(self):
+        _taskdb = taskdb.TaskDB('./data/tests/task.db')
+        scheduler = Scheduler(taskdb=_taskdb,
+                              projectdb=projectdb.ProjectDB('./data/tests/project.db'),
+                              newtask_queue=Queue(10), status_queue=Queue(10),
+                              out_queue=Queue(10), data_path='./data/tests/')
+        scheduler.WRITE_BUFFER_LIMIT = 3
+        insert_many = _taskdb.insert_many
+
+        def reject_bad(project, tasks):
+            if any(task['taskid'] == 'bad' for task in tasks):
+                raise Exception('duplicate key')
+            insert_many(project, tasks)
+        _taskdb.insert_many = reject_bad
+        for taskid in ('a', 'bad', 'b'):
+            scheduler.insert_task({'taskid': taskid, 'project': 'p1', 'url': 'url',
+                                   'status': _taskdb.ACTIVE})
+        # other tasks of the batch are written
+        self.assertEqual(scheduler._write_buffer.keys(), [('p1', 'bad')])
+        self.assertIsNotNone(_taskdb.get_task('p1', 'a'))
+        self.assertIsNotNone(_taskdb.get_task('p1', 'b'))
+
+        for i in range(scheduler.WRITE_RETRY_LIMIT - 1):
+            scheduler.insert_task({'taskid': 'c%d' % i, 'project': 'p1', 'url': 'url',
+                                   'status': _taskdb.ACTIVE})
+            scheduler._flush_tasks()
+        self.assertEqual(len(scheduler._write_buffer), 0)
+        self.assertIsNone(_taskdb.get_task('p1', 'bad'))
+
+    def test_flush_backpressure(self):
+        _taskdb = taskdb.TaskDB('./data/tests/task.db')
+        newtask_queue = Queue(10)
+        scheduler = Scheduler(taskdb=_taskdb,
+                              projectdb=projectdb.ProjectDB('./data/tests/project.db'),
+                              newtask_queue=newtask_queue, status_queue=Queue(10),
+                              out_queue=Queue(10), data_path='./data/tests/')
+        scheduler.WRITE_BUFFER_LIMIT = 2
+        insert_many = _taskdb.insert_many
+
+        def gone_away(project, tasks):
+            raise Exception('database gone away')
+        _taskdb.insert_many = gone_away
+        for taskid in ('a', 'b'):
+            scheduler.insert_task({'taskid': taskid, 'project': 'p1', 'url': 'url',
+                                   'status': _taskdb.ACTIVE})
+        self.assertTrue(scheduler._write_blocked())
+        newtask_queue.put({'taskid': 'c', 'project': 'p1', 'url': 'url'})
+        self.assertEqual(scheduler._check_request(), 0)
+        self.assertEqual(newtask_queue.qsize(), 1)
+
+        # failures are not counted when nothing can be written
+        for i in range(scheduler.WRITE_RETRY_LIMIT):
+            scheduler._flush_tasks()
+        self.assertEqual(len(scheduler._write_buffer), 2)
+
+        _taskdb.insert_many = insert_many
+        scheduler._flush_tasks()
+        self.assertEqual(len(scheduler._write_buffer), 0)
+        self.assertFalse(scheduler._write_blocked())
+
+
+class TestSchedulerDispatch(unittest.TestCase):
+
+    def setUp(self):
+        shutil.rmtree('./data/tests', ignore_errors=True)
+        os.makedirs('./data/tests')
+
+    def tearDown(self):
+        shutil.rmtree('./data/tests', ignore_errors=True)
+
+    def test_weighted_round_robin(self):
+        import Queue as _Queue
+        _projectdb = projectdb.ProjectDB('./data/tests/project.db')
+        for name, weight in (('p1', 1), ('p2', 2), ('p3', None)):
+            _projectdb.insert(name, {
+                'name': name,
+                'group': 'group',
+                'status': 'RUNNING',
+                'script': '',
+                'rate': 100000,
+                'burst': 100000,
+                'weight': weight,
+            })
+        out_queue = _Queue.Queue(100)
+        scheduler = Scheduler(taskdb=taskdb.TaskDB('./data/tests/task.db'),
+                              projectdb=_projectdb, newtask_queue=Queue(10),
+                              status_queue=Queue(10), out_queue=out_queue,
+                              data_path='./data/tests/')
+        scheduler.DISPATCH_QUANTUM = 10
+        scheduler._load_projects()
+        while not out_queue.empty():
+            out_queue.get()
+        for project in ('p1', 'p2', 'p3'):
+            for i in range(1000):
+                task = {'taskid': '%s_%d' % (project, i), 'project': project, 'url': 'url'}
+                scheduler.on_new_request(task)
+
+        # a round sends 20 tasks, consumer takes 10 to keep out_queue saturated
+        result = {'p1': 0, 'p2': 0, 'p3': 0}
+        for i in range(100):
+            scheduler._check_select()
+            for j in range(10):
+                result[out_queue.get_nowait()['project']] += 1
+        self.assertAlmostEqual(result['p2'] * 1.0 / result['p1'], 2, delta=0.2)
+        self.assertAlmostEqual(result['p3'] * 1.0 / result['p1'], 1, delta=0.1)
+
+        stats = scheduler.dispatch_stats()
+        self.assertEqual(stats['p2']['weight'], 2)
+        self.assertEqual(stats['p3']['weight'], 1)
+        self.assertGreater(stats['p1']['dispatched'], 0)
+        self.assertGreater(stats['p1']['skipped'], 0)
+
+    def test_ghost_task(self):
+        _projectdb = projectdb.ProjectDB('./data/tests/project.db')
+        _projectdb.insert('p1', {
+            'name': 'p1',
+            'group': 'group',
+            'status': 'RUNNING',
+            'script': '',
+            'rate': 100000,
+            'burst': 100000,
+        })
+        scheduler = Scheduler(taskdb=taskdb.TaskDB('./data/tests/task.db'),
+                              projectdb=_projectdb, newtask_queue=Queue(10),
+                              status_queue=Queue(10), out_queue=Queue(10),
+                              data_path='./data/tests/')
+        scheduler._load_projects()
+        # restored from journal but not in taskdb
+        task_queue = scheduler.task_queue['p1']
+        task_queue.put('ghost', 0)
+        self.assertEqual(scheduler._dispatch_project('p1', 10), 0)
+        self.assertIn('ghost', task_queue.processing_done)
+        # not retried after processing timeout
+        task_queue.processing.put('ghost', 0, 0)
+        task_queue.check_update()
+        self.assertNotIn('ghost', task_queue.processing)
+        self.assertNotIn('ghost', task_queue.priority_queue)
+
+
 class TestScheduler(unittest.TestCase):
     taskdb_path = './data/tests/task.db'
     projectdb_path = './data/tests/project.db'
@@ -114,9 +991,9 @@ class TestScheduler(unittest.TestCase):
                                   resultdb=get_resultdb())
             scheduler.UPDATE_PROJECT_INTERVAL = 0.1
             scheduler.LOOP_INTERVAL = 0.1
+            scheduler.FLUSH_INTERVAL = 0.1
             scheduler.INQUEUE_LIMIT = 10
             Scheduler.DELETE_TIME = 0
-            scheduler._last_tick = int(time.time())  # not dispatch cronjob
             run_in_thread(scheduler.xmlrpc_run, port=self.scheduler_xmlrpc_port)
             scheduler.run()
 
@@ -291,6 +1168,54 @@ class TestScheduler(unittest.TestCase):
         time.sleep(0.1)
         self.assertEqual(self.rpc.size(), 0)
 
+    def test_84_newtasks_via_rpc(self):
+        self.assertEqual(self.rpc.newtasks([{
+            'taskid': 'taskid',
+            'project': 'test_project',
+            'url': 'url',
+            'schedule': {
+                'age': 30,
+            },
+        }, {
+            'taskid': 'taskid',
+            'project': 'no_project',
+            'url': 'url',
+        }]), 1)
+        time.sleep(0.1)
+        self.assertEqual(self.rpc.size(), 0)
+
+    def test_86_newtask_batch_message(self):
+        self.newtask_queue.put([{
+            'taskid': 'taskid',
+            'project': 'test_project',
+            'url': 'url',
+            'schedule': {
+                'age': 30,
+            },
+        }, {
+            'taskid': 'taskid_batch',
+            'project': 'test_project',
+            'url': 'url_batch',
+        }])
+        task = self.scheduler2fetcher.get(timeout=5)
+        self.assertEqual(task['taskid'], 'taskid_batch')
+
+        self.status_queue.put([{
+            'taskid': 'taskid_batch',
+            'project': 'test_project',
+            'url': 'url_batch',
+            'track': {
+                'fetch': {
+                    'ok': True
+                },
+                'process': {
+                    'ok': True
+                },
+            }
+        }])
+        time.sleep(0.2)
+        self.assertEqual(self.rpc.size(), 0)
+
     def test_90_newtask_with_itag(self):
         time.sleep(0.1)
         self.newtask_queue.put({
@@ -364,6 +1289,21 @@ class TestScheduler(unittest.TestCase):
         })
         time.sleep(0.2)
 
+    def test_b10_stats(self):
+        stats = self.rpc.stats()
+        self.assertGreater(stats['phases']['check_select']['calls'], 10)
+        self.assertGreaterEqual(stats['phases']['wait']['max'], 0)
+        self.assertIn('get_task', stats['taskdb'])
+        self.assertEqual(sum(stats['taskdb']['get_task']['histogram'].values()),
+                         stats['taskdb']['get_task']['calls'])
+
+        path = self.rpc.profile(0.3)
+        self.assertTrue(path.startswith('./data/tests/'))
+        self.assertEqual(self.rpc.stats()['profiling'], path)
+        time.sleep(0.8)
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(self.rpc.stats()['profiling'], '')
+
     def test_x10_inqueue_limit(self):
         self.projectdb.insert('test_inqueue_project', {
             'name': 'test_inqueue_project',
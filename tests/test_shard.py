@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# vim: set et sw=4 ts=4 sts=4 ff=unix fenc=utf8:
+# Author: Binux<i@binux.me>
+#         http://binux.me
+# Created on 2014-12-14 17:05:41
+
+import os
+import shutil
+import unittest2 as unittest
+from Queue import Queue
+
+from pyspider.libs.shard import HashRing, shard_of, ShardedQueue, ShardedSchedulerRPC
+
+
+class TestHashRing(unittest.TestCase):
+
+    def test_10_hash_ring(self):
+        ring = HashRing(range(4))
+        keys = ['project%d' % i for i in range(2000)]
+        nodes = [ring.get_node(x) for x in keys]
+        for i in range(4):
+            self.assertGreater(nodes.count(i), 300)
+        self.assertEqual(ring.get_node(u'中文'), ring.get_node(u'中文'.encode('utf8')))
+
+        # only keys on new node are moved
+        ring5 = HashRing(range(5))
+        moved = [x for x, node in zip(keys, nodes) if ring5.get_node(x) != node]
+        self.assertLess(len(moved), 600)
+        for key in moved:
+            self.assertEqual(ring5.get_node(key), 4)
+
+    def test_20_shard_of(self):
+        self.assertEqual(shard_of('project', 1), 0)
+        self.assertEqual(shard_of('project', 3), HashRing(range(3)).get_node('project'))
+
+
+class FakeRPC(object):
+
+    def __init__(self, projects):
+        self.projects = projects
+
+    def size(self):
+        return len(self.projects)
+
+    def counter(self, _time, _type):
+        return dict((x, {'pending': 1}) for x in self.projects)
+
+    def newtask(self, task):
+        return task['project'] in self.projects
+
+    def newtasks(self, tasks):
+        return len([x for x in tasks if self.newtask(x)])
+
+    def stats(self):
+        return {
+            'phases': {'wait': {'calls': len(self.projects), 'avg': 1.0, 'max': 2.0,
+                                'items': 0}},
+            'taskdb': {'get_task': {'calls': 1, 'avg': 0.5, 'histogram': {'1': 1}}},
+            'profiling': '',
+        }
+
+    def get_active_tasks(self, project, limit, since=-1):
+        result = []
+        for i, each in enumerate(self.projects):
+            if project and project != each or i <= since:
+                continue
+            result.append((i, {'project': each}))
+        return result[:limit]
+
+
+class TestSharded(unittest.TestCase):
+
+    def test_10_sharded_queue(self):
+        queue = ShardedQueue([Queue(), Queue(), Queue()])
+        for i in range(30):
+            queue.put({'project': 'project%d' % i})
+        self.assertEqual(queue.qsize(), 30)
+        for i, each in enumerate(queue.queues):
+            while not each.empty():
+                self.assertEqual(shard_of(each.get()['project'], 3), i)
+        self.assertTrue(queue.empty())
+
+        queue.put([{'project': 'project%d' % i} for i in range(30)])
+        for i, each in enumerate(queue.queues):
+            tasks = each.get()
+            self.assertTrue(all(shard_of(x['project'], 3) == i for x in tasks))
+            self.assertTrue(each.empty())
+
+    def test_20_sharded_rpc(self):
+        projects = [[], [], []]
+        for i in range(10):
+            project = 'project%d' % i
+            projects[shard_of(project, 3)].append(project)
+        rpc = ShardedSchedulerRPC([FakeRPC(x) for x in projects])
+
+        self.assertEqual(rpc.size(), 10)
+        self.assertEqual(len(rpc.counter('5m', 'sum')), 10)
+        for i in range(10):
+            self.assertTrue(rpc.newtask({'project': 'project%d' % i}))
+        self.assertEqual(rpc.newtasks([{'project': 'project%d' % i} for i in range(10)]), 10)
+        self.assertEqual(len(rpc.get_active_tasks('', 5)), 5)
+        self.assertEqual(rpc.get_active_tasks('project1', 5)[0][1]['project'], 'project1')
+        self.assertTrue(all(x[0] > 0 for x in rpc.get_active_tasks('', 10, 0)))
+
+        stats = rpc.stats()
+        self.assertEqual(stats['phases']['wait']['calls'], 10)
+        self.assertEqual(stats['phases']['wait']['avg'], 1.0)
+        self.assertEqual(stats['taskdb']['get_task']['histogram'], {'1': 3})
+
+
+class TestShardedScheduler(unittest.TestCase):
+
+    def setUp(self):
+        shutil.rmtree('./data/tests', ignore_errors=True)
+        os.makedirs('./data/tests')
+
+    def tearDown(self):
+        shutil.rmtree('./data/tests', ignore_errors=True)
+
+    def test_10_own_project(self):
+        from pyspider.scheduler.scheduler import Scheduler
+        from pyspider.database.sqlite import taskdb, projectdb
+
+        _projectdb = projectdb.ProjectDB('./data/tests/project.db')
+        for i in range(10):
+            _projectdb.insert('project%d' % i, {
+                'name': 'project%d' % i,
+                'group': 'group',
+                'status': 'TODO',
+                'script': '',
+                'rate': 1,
+                'burst': 1,
+            })
+
+        schedulers = []
+        for i in range(2):
+            scheduler = Scheduler(taskdb=taskdb.TaskDB('./data/tests/task.db'),
+                                  projectdb=_projectdb, newtask_queue=Queue(),
+                                  status_queue=Queue(), out_queue=Queue(),
+                                  data_path='./data/tests/', shard=i, shards=2)
+            scheduler._load_projects()
+            schedulers.append(scheduler)
+        self.assertEqual(len(schedulers[0].projects) + len(schedulers[1].projects), 10)
+        for i, scheduler in enumerate(schedulers):
+            for project in scheduler.projects:
+                self.assertEqual(shard_of(project, 2), i)
+
+        schedulers[0]._cnt['all'].value(('project_x', 'pending'), 1)
+        schedulers[0]._dump_cnt()
+        self.assertTrue(os.path.exists('./data/tests/scheduler.0.all'))
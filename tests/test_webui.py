@@ -24,6 +24,7 @@ class TestWebUI(unittest.TestCase):
         os.makedirs('./data/tests')
 
         ctx = run.cli.make_context('test', [
+            '--data-path', './data/tests',
             '--taskdb', 'sqlite+taskdb:///data/tests/task.db',
             '--projectdb', 'sqlite+projectdb:///data/tests/projectdb.db',
             '--resultdb', 'sqlite+resultdb:///data/tests/resultdb.db',
@@ -212,6 +213,32 @@ class TestWebUI(unittest.TestCase):
         self.assertEqual(rv.status_code, 200)
         self.assertIn('SUCCESS</span>', rv.data)
 
+        cursor = rv.headers['X-Cursor']
+        rv = self.app.get('/tasks?project=test_project&fragment=1&since=%s' % cursor)
+        self.assertEqual(rv.status_code, 200)
+        self.assertNotIn('<li', rv.data)
+        self.assertEqual(rv.headers['X-Cursor'], cursor)
+
+    def test_a22_active_tasks(self):
+        rv = self.app.get('/active_tasks')
+        self.assertEqual(rv.status_code, 200)
+        tasks = json.loads(rv.data)
+        self.assertGreater(len(tasks), 0)
+        since = tasks[min(1, len(tasks) - 1)]['updatetime']
+        rv = self.app.get('/active_tasks?project=test_project&since=%r' % since)
+        self.assertEqual(rv.status_code, 200)
+        self.assertLess(len(json.loads(rv.data)), len(tasks))
+
+    def test_a23_stats(self):
+        rv = self.app.get('/stats')
+        self.assertEqual(rv.status_code, 200)
+        self.assertIn('check_select', rv.data)
+        self.assertIn('get_task', rv.data)
+
+        rv = self.app.get('/stats?format=json')
+        self.assertEqual(rv.status_code, 200)
+        self.assertIn('newtask', json.loads(rv.data)['rpc'])
+
     def test_a24_task(self):
         rv = self.app.get(self.task_url)
         self.assertEqual(rv.status_code, 200)